@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Compare the time taken to write the transactions, outputs and deltas of a restored account to
+the wallet database, with and without the database in bulk restore mode.
+
+    python3 contrib/benchmarks/bulk_restore.py [transaction count] [interval ms]
+
+The rows are written the way the initial synchronisation of an account writes them, with each
+transaction, output and delta written separately as it is processed, and the transactions
+processed at an interval as they arrive from the server. The writes are then committed in small
+batches, and the time the writer spends committing them is what bulk restore mode saves. The
+time includes the checkpoint and integrity check that end the bulk restore mode.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import List
+
+CONTRIB_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CONTRIB_PATH, "..", ".."))
+
+from bitcoinx import double_sha256
+
+from electrumsv.constants import (DerivationType, KeyInstanceFlag, ScriptType,
+    TransactionOutputFlag, TxFlags)
+from electrumsv.wallet_database.migration import create_database_file
+from electrumsv.wallet_database.sqlite_support import DatabaseContext, SynchronousWriter
+from electrumsv.wallet_database.tables import (AccountRow, AccountTable, KeyInstanceRow,
+    KeyInstanceTable, TransactionDeltaRow, TransactionDeltaTable, TransactionOutputRow,
+    TransactionOutputTable, TransactionRow, TransactionTable, TxData)
+
+
+KEY_COUNT = 1000
+
+
+def setup_database(wallet_path: str) -> DatabaseContext:
+    create_database_file(wallet_path)
+    db_context = DatabaseContext(wallet_path)
+    with AccountTable(db_context) as table:
+        table.create([ AccountRow(1, None, ScriptType.P2PKH, "account") ])
+    with KeyInstanceTable(db_context) as table:
+        table.create([ KeyInstanceRow(i+1, 1, None, DerivationType.PUBLIC_KEY_HASH,
+            b'{}', ScriptType.P2PKH, KeyInstanceFlag.IS_ACTIVE, None)
+            for i in range(KEY_COUNT) ])
+    with SynchronousWriter() as writer:
+        db_context.queue_write(lambda db: None, writer.get_callback())
+        assert writer.succeeded()
+    return db_context
+
+
+def make_transactions(transaction_count: int) -> List[bytes]:
+    rng = random.Random(1)
+    return [ rng.getrandbits(250 * 8).to_bytes(250, "little")
+        for i in range(transaction_count) ]
+
+
+def restore(db_context: DatabaseContext, transactions: List[bytes], interval: float,
+        bulk_restore: bool) -> float:
+    transaction_table = TransactionTable(db_context)
+    output_table = TransactionOutputTable(db_context)
+    delta_table = TransactionDeltaTable(db_context)
+    start_time = time.perf_counter()
+    if bulk_restore:
+        db_context.begin_bulk_restore()
+    for i, bytedata in enumerate(transactions):
+        tx_hash = double_sha256(bytedata)
+        keyinstance_id = i % KEY_COUNT + 1
+        transaction_table.create([ TransactionRow(tx_hash,
+            TxData(height=i+1, position=1, fee=200, date_added=1, date_updated=1), bytedata,
+            TxFlags.StateSettled, None) ])
+        output_table.create([ TransactionOutputRow(tx_hash, 0, 1000, keyinstance_id,
+            TransactionOutputFlag.NONE) ])
+        delta_table.create_or_update_relative_values([ TransactionDeltaRow(tx_hash,
+            keyinstance_id, 1000) ])
+        if interval:
+            time.sleep(interval)
+    if bulk_restore:
+        db_context.end_bulk_restore()
+    else:
+        with SynchronousWriter() as writer:
+            db_context.queue_write(lambda db: None, writer.get_callback())
+            assert writer.succeeded()
+    elapsed_time = time.perf_counter() - start_time
+    transaction_table.close()
+    output_table.close()
+    delta_table.close()
+    return elapsed_time
+
+
+def main() -> None:
+    transaction_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    interval_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    transactions = make_transactions(transaction_count)
+
+    temp_path = tempfile.mkdtemp()
+    try:
+        timings = []
+        commit_times = []
+        for bulk_restore in (False, True):
+            db_context = setup_database(os.path.join(temp_path, f"wallet{len(timings)}"))
+            try:
+                timings.append(restore(db_context, transactions, interval_ms / 1000,
+                    bulk_restore))
+                statistics = db_context.get_write_statistics()
+            finally:
+                db_context.close()
+            commit_time = statistics.batch_count * statistics.average_commit_ms / 1000
+            commit_times.append(commit_time)
+            print(f"{'bulk restore:' if bulk_restore else 'normal:':14} "
+                f"{timings[-1]:8.2f} seconds, {statistics.batch_count:6} commits taking "
+                f"{commit_time:6.2f} seconds")
+    finally:
+        shutil.rmtree(temp_path)
+
+    print(f"transactions:  {transaction_count}, every {interval_ms} ms")
+    print(f"commit saving: {commit_times[0] / commit_times[1]:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Compare the hit rates of the transaction bytedata cache policies, by replaying a trace of cache
+accesses against each of them.
+
+    python3 contrib/benchmarks/cache_replay.py [cache size kb] [trace file]
+
+A trace file has a line for each access, with the transaction hash in hex and the size of its
+bytedata. A miss is followed by adding the bytedata to the cache, as the transaction cache does
+after reading it from the database. Without a trace file, a synthetic trace is used where a
+working set of unsettled transactions is accessed over and over, and every so often the whole
+history is walked as when it is exported.
+"""
+
+import os
+import random
+import sys
+import time
+from typing import List, Tuple
+
+CONTRIB_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CONTRIB_PATH, "..", ".."))
+
+from electrumsv.util.cache import CachePolicy, LRUCache
+
+
+HISTORY_COUNT = 20000
+WORKING_SET_COUNT = 500
+WORKING_SET_ACCESSES = 40000
+SCAN_INTERVAL = 2000
+
+
+def read_trace(trace_path: str) -> List[Tuple[bytes, int]]:
+    trace = []
+    with open(trace_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                tx_id, size_text = line.split()
+                trace.append((bytes.fromhex(tx_id), int(size_text)))
+    return trace
+
+
+def make_trace() -> List[Tuple[bytes, int]]:
+    rng = random.Random(1)
+    sizes = [ int(rng.lognormvariate(6, 1)) + 100 for i in range(HISTORY_COUNT) ]
+    keys = [ i.to_bytes(32, "little") for i in range(HISTORY_COUNT) ]
+    working_set = rng.sample(range(HISTORY_COUNT), WORKING_SET_COUNT)
+    trace = []
+    for access_count in range(WORKING_SET_ACCESSES):
+        index = working_set[min(int(rng.expovariate(1 / 100)), WORKING_SET_COUNT-1)]
+        trace.append((keys[index], sizes[index]))
+        if access_count % SCAN_INTERVAL == SCAN_INTERVAL - 1:
+            trace.extend(zip(keys, sizes))
+    return trace
+
+
+def replay(trace: List[Tuple[bytes, int]], cache_size: int, policy: CachePolicy) -> LRUCache:
+    cache = LRUCache(max_size=cache_size, policy=policy)
+    values = {}
+    for key, size in trace:
+        if cache.get(key) is None:
+            value = values.get(size)
+            if value is None:
+                value = values[size] = bytes(size)
+            cache.set(key, value)
+    return cache
+
+
+def main() -> None:
+    cache_size = (int(sys.argv[1]) if len(sys.argv) > 1 else 2048) * 1024
+    trace = read_trace(sys.argv[2]) if len(sys.argv) > 2 else make_trace()
+
+    print(f"accesses:      {len(trace)}")
+    print(f"cache size:    {cache_size // 1024} KB")
+    for policy in (CachePolicy.LRU, CachePolicy.SEGMENTED_LRU):
+        start_time = time.perf_counter()
+        stats = replay(trace, cache_size, policy).get_stats()
+        elapsed_time = time.perf_counter() - start_time
+        hit_rate = 100 * stats.hits / (stats.hits + stats.misses)
+        print(f"{policy.name + ':':14} {hit_rate:6.2f}% hits, {stats.evictions} evictions, "
+            f"{stats.current_size // 1024} KB used, {elapsed_time:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
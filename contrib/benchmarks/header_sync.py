@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Compare the time taken to catch up on the block headers after the checkpoint, requesting one
+chunk at a time, with requesting several chunks at a time from one or more sessions.
+
+    python3 contrib/benchmarks/header_sync.py [header count] [latency ms]
+
+The headers are served by a local stub server that delays each response by the latency, to
+stand in for the network. They are for a made up regtest chain, so mining them is quick and
+the difficulty is not checked when they are connected.
+"""
+
+from contextlib import AsyncExitStack
+from functools import partial
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+CONTRIB_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CONTRIB_PATH, "..", ".."))
+
+from aiorpcx import (connect_rs, JSONRPC, NewlineFramer, RPCError, RPCSession, serve_rs,
+    sleep)
+from bitcoinx import CheckPoint, bits_to_work, pack_le_uint32
+
+from electrumsv.app_state import AppStateProxy
+from electrumsv.constants import MAX_INCOMING_ELECTRUMX_MESSAGE_SIZE
+from electrumsv.logs import logs
+from electrumsv.network import HEADER_CHUNK_SIZE, SVServer, SVSession
+from electrumsv.networks import Net, SVRegTestnet
+from electrumsv.regtest_support import HeadersRegTestMod
+from electrumsv.simple_config import SimpleConfig
+
+
+CHECKPOINT_HEIGHT = 200
+REGTEST_BITS = 0x207fffff
+
+
+def mine_header(prev_hash: bytes, timestamp: int) -> bytes:
+    coin = Net.COIN
+    nonce = 0
+    while True:
+        raw_header = (pack_le_uint32(1) + prev_hash + bytes(32) + pack_le_uint32(timestamp) +
+            pack_le_uint32(REGTEST_BITS) + pack_le_uint32(nonce))
+        header = coin.deserialized_header(raw_header, -1)
+        if header.hash_value() <= header.target():
+            return raw_header
+        nonce += 1
+
+
+def make_chain(count: int):
+    checkpoint_header = mine_header(bytes(32), 1600000000)
+    checkpoint = CheckPoint(raw_header=checkpoint_header, height=CHECKPOINT_HEIGHT,
+        prev_work=CHECKPOINT_HEIGHT * bits_to_work(REGTEST_BITS))
+    raw_headers = []
+    prev_hash = Net.COIN.header_hash(checkpoint_header)
+    for i in range(count):
+        raw_header = mine_header(prev_hash, 1600000000 + (i + 1) * 600)
+        raw_headers.append(raw_header)
+        prev_hash = Net.COIN.header_hash(raw_header)
+    return checkpoint, raw_headers
+
+
+class StubServerSession(RPCSession):
+    raw_headers = []
+    latency = 0.0
+
+    def default_framer(self) -> NewlineFramer:
+        return NewlineFramer(max_size=MAX_INCOMING_ELECTRUMX_MESSAGE_SIZE)
+
+    async def handle_request(self, request):
+        if request.method != 'blockchain.block.headers':
+            raise RPCError(JSONRPC.METHOD_NOT_FOUND, f'unknown method {request.method}')
+        height, count, _cp_height = request.args
+        await sleep(self.latency)
+        start = height - CHECKPOINT_HEIGHT - 1
+        raw_chunk = b''.join(self.raw_headers[start:start + min(count, HEADER_CHUNK_SIZE)])
+        return { 'count': len(raw_chunk) // 80, 'hex': raw_chunk.hex(),
+            'max': HEADER_CHUNK_SIZE }
+
+
+async def sync_sequential(sessions, start_height: int, end_height: int) -> None:
+    height = start_height - 1
+    while height < end_height:
+        height = await sessions[0]._request_chunk(height + 1,
+            min(HEADER_CHUNK_SIZE, end_height - height))
+
+
+async def sync_pipelined(sessions, start_height: int, end_height: int) -> None:
+    await sessions[0]._request_chunks(start_height, end_height)
+
+
+async def run_sync(sync, port: int, session_count: int, headers_path: str, checkpoint,
+        tip_height: int) -> float:
+    if os.path.exists(headers_path):
+        os.remove(headers_path)
+    app_state.headers = HeadersRegTestMod.from_file(Net.COIN, headers_path, checkpoint)
+    network = types.SimpleNamespace(sessions=[])
+    server = SVServer.unique('127.0.0.1', port, 't')
+    logger = logs.get_logger("benchmark")
+    tip = Net.COIN.deserialized_header(StubServerSession.raw_headers[-1], tip_height)
+    async with AsyncExitStack() as stack:
+        for _i in range(session_count):
+            session = await stack.enter_async_context(connect_rs('127.0.0.1', port,
+                session_factory=partial(SVSession, network, server, logger)))
+            session.tip = tip
+            network.sessions.append(session)
+        start_time = time.perf_counter()
+        await sync(network.sessions, CHECKPOINT_HEIGHT + 1, tip_height)
+        elapsed_time = time.perf_counter() - start_time
+    assert app_state.headers.longest_chain().tip.height == tip_height
+    return elapsed_time
+
+
+async def run_benchmarks(headers_path: str, checkpoint, tip_height: int):
+    server = await serve_rs(StubServerSession, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        return [
+            await run_sync(sync_sequential, port, 1, headers_path, checkpoint, tip_height),
+            await run_sync(sync_pipelined, port, 1, headers_path, checkpoint, tip_height),
+            await run_sync(sync_pipelined, port, 3, headers_path, checkpoint, tip_height),
+        ]
+    finally:
+        server.close()
+
+
+def main() -> None:
+    global app_state
+    header_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20160
+    latency_ms = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    Net.set_to(SVRegTestnet)
+    checkpoint, raw_headers = make_chain(header_count)
+    Net._net.CHECKPOINT = checkpoint
+    StubServerSession.raw_headers = raw_headers
+    StubServerSession.latency = latency_ms / 1000
+
+    app_state = AppStateProxy(SimpleConfig(), 'qt')
+    app_state.async_.__enter__()
+    temp_path = tempfile.mkdtemp()
+    try:
+        headers_path = os.path.join(temp_path, "headers")
+        timings = app_state.async_.spawn_and_wait(run_benchmarks, headers_path, checkpoint,
+            CHECKPOINT_HEIGHT + header_count)
+    finally:
+        app_state.async_.__exit__(None, None, None)
+        shutil.rmtree(temp_path)
+
+    sequential_time, pipelined_time, multiple_time = timings
+    print(f"headers:       {header_count}")
+    print(f"latency:       {latency_ms} ms")
+    print(f"sequential:    {sequential_time:8.2f} seconds, "
+        f"{header_count / sequential_time:10,.0f} headers/second")
+    print(f"pipelined:     {pipelined_time:8.2f} seconds, "
+        f"{header_count / pipelined_time:10,.0f} headers/second")
+    print(f"3 sessions:    {multiple_time:8.2f} seconds, "
+        f"{header_count / multiple_time:10,.0f} headers/second")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Compare the memory used to cache transaction metadata as a dictionary of entry objects, with
+that used by the columnar `TransactionCacheEntries` mapping the transaction cache uses.
+
+    python3 contrib/benchmarks/transaction_cache_memory.py [transaction count]
+
+The transaction hashes are created before measuring, as both approaches share them.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, List
+
+CONTRIB_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CONTRIB_PATH, "..", ".."))
+
+from electrumsv.constants import TxFlags
+from electrumsv.wallet_database.cache import TransactionCacheEntries, TransactionCacheEntry
+from electrumsv.wallet_database.tables import TxData
+
+
+def measure(factory: Callable[[], Any], tx_hashes: List[bytes]) -> int:
+    flags = TxFlags.StateSettled | TxFlags.HasByteData | TxFlags.HasHeight | \
+        TxFlags.HasPosition | TxFlags.HasFee
+    date_now = int(time.time())
+    tracemalloc.start()
+    try:
+        entries = factory()
+        for i, tx_hash in enumerate(tx_hashes):
+            entries[tx_hash] = TransactionCacheEntry(TxData(height=500000 + i // 2000,
+                position=i % 2000, fee=200 + i, date_added=date_now + i,
+                date_updated=date_now + i), flags)
+        size, _peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tx_hashes = [ os.urandom(32) for i in range(count) ]
+
+    dict_size = measure(dict, tx_hashes)
+    columnar_size = measure(TransactionCacheEntries, tx_hashes)
+    print(f"transactions:  {count}")
+    print(f"dict:          {dict_size / (1024 * 1024):8.1f} MiB ({dict_size / count:.0f} "
+        "bytes/entry)")
+    print(f"columnar:      {columnar_size / (1024 * 1024):8.1f} MiB ({columnar_size / count:.0f} "
+        "bytes/entry)")
+    print(f"reduction:     {100 * (1 - columnar_size / dict_size):8.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Compare the size of a wallet database and the time taken to read its transactions, with and
+without the transaction bytedata compressed.
+
+    python3 contrib/benchmarks/transaction_compression.py [transaction count] [threshold]
+
+The transactions are made up, but are shaped like those of a typical wallet. They spend P2PKH
+outputs and pay to P2PKH outputs, so they share the script templates and differ in the
+signatures, public keys and hashes, which do not compress. Some also carry a data output with
+JSON text in it, which does compress.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+CONTRIB_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CONTRIB_PATH, "..", ".."))
+
+from bitcoinx import double_sha256, pack_le_int32, pack_le_int64, pack_le_uint32, pack_varint
+
+from electrumsv.constants import TxFlags
+from electrumsv.wallet_database.migration import create_database_file
+from electrumsv.wallet_database.sqlite_support import DatabaseContext, SynchronousWriter
+from electrumsv.wallet_database.tables import TransactionTable, TxData
+
+
+READ_BATCH_SIZE = 100
+DATA_OUTPUT_CHANCE = 0.2
+
+
+def make_transaction(rng: random.Random) -> bytes:
+    input_count = rng.choice([ 1, 1, 1, 2, 2, 3 ])
+    output_count = rng.choice([ 1, 2, 2, 2, 3 ])
+    data_output = rng.random() < DATA_OUTPUT_CHANCE
+    raw = pack_le_int32(1) + pack_varint(input_count)
+    for i in range(input_count):
+        signature = bytes([ 0x30, 0x44 ]) + os.urandom(68) + bytes([ 0x41 ])
+        public_key = bytes([ rng.choice([ 2, 3 ]) ]) + os.urandom(32)
+        script_sig = (bytes([ len(signature) ]) + signature + bytes([ len(public_key) ]) +
+            public_key)
+        raw += (os.urandom(32) + pack_le_uint32(rng.randrange(4)) + pack_varint(len(script_sig)) +
+            script_sig + pack_le_uint32(0xffffffff))
+    raw += pack_varint(output_count + (1 if data_output else 0))
+    for i in range(output_count):
+        script_pubkey = bytes([ 0x76, 0xa9, 0x14 ]) + os.urandom(20) + bytes([ 0x88, 0xac ])
+        raw += (pack_le_int64(rng.randrange(1, 10000000)) + pack_varint(len(script_pubkey)) +
+            script_pubkey)
+    if data_output:
+        data = ("[" + ",".join(f'{{"id":{rng.randrange(100000)},"name":"item","value":'
+            f'{rng.randrange(1000)}}}' for i in range(rng.randrange(10, 100))) + "]").encode()
+        script_pubkey = bytes([ 0x00, 0x6a, 0x4d ]) + len(data).to_bytes(2, "little") + data
+        raw += pack_le_int64(0) + pack_varint(len(script_pubkey)) + script_pubkey
+    raw += pack_le_uint32(0)
+    return raw
+
+
+def write_database(wallet_path: str, transactions: List[bytes],
+        compression_threshold: Optional[int]) -> int:
+    create_database_file(wallet_path)
+    db_context = DatabaseContext(wallet_path)
+    table = TransactionTable(db_context, compression_threshold)
+    rows = []
+    for i, bytedata in enumerate(transactions):
+        metadata = TxData(height=i+1, fee=200, position=0, date_added=1, date_updated=1)
+        rows.append((double_sha256(bytedata), metadata, bytedata, TxFlags.StateSettled, None))
+    with SynchronousWriter() as writer:
+        table.create(rows, completion_callback=writer.get_callback())
+        assert writer.succeeded()
+    table.close()
+    db = db_context.acquire_connection()
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.execute("VACUUM")
+    db_context.release_connection(db)
+    db_context.close()
+    return os.path.getsize(wallet_path + ".sqlite")
+
+
+def read_database(wallet_path: str, transactions: List[bytes]) -> float:
+    tx_hashes = [ double_sha256(bytedata) for bytedata in transactions ]
+    random.Random(2).shuffle(tx_hashes)
+    db_context = DatabaseContext(wallet_path)
+    table = TransactionTable(db_context)
+    start_time = time.perf_counter()
+    read_count = 0
+    for i in range(0, len(tx_hashes), READ_BATCH_SIZE):
+        read_count += len(table.read(tx_hashes=tx_hashes[i:i+READ_BATCH_SIZE]))
+    elapsed_time = time.perf_counter() - start_time
+    assert read_count == len(tx_hashes)
+    table.close()
+    db_context.close()
+    return elapsed_time
+
+
+def main() -> None:
+    transaction_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    compression_threshold = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+
+    rng = random.Random(1)
+    transactions = [ make_transaction(rng) for i in range(transaction_count) ]
+    bytedata_size = sum(len(bytedata) for bytedata in transactions)
+
+    temp_path = tempfile.mkdtemp()
+    try:
+        plain_path = os.path.join(temp_path, "plain")
+        compressed_path = os.path.join(temp_path, "compressed")
+        plain_size = write_database(plain_path, transactions, None)
+        compressed_size = write_database(compressed_path, transactions, compression_threshold)
+        plain_time = read_database(plain_path, transactions)
+        compressed_time = read_database(compressed_path, transactions)
+    finally:
+        shutil.rmtree(temp_path)
+
+    print(f"transactions:  {transaction_count} ({bytedata_size} bytes)")
+    print(f"threshold:     {compression_threshold} bytes")
+    print(f"plain:         {plain_size:12} bytes, read in {plain_time:6.2f} seconds")
+    print(f"compressed:    {compressed_size:12} bytes, read in {compressed_time:6.2f} seconds")
+    print(f"disk saving:   {100 * (1 - compressed_size / plain_size):8.1f}%")
+    print(f"read cost:     {100 * (compressed_time / plain_time - 1):8.1f}%")
+
+
+if __name__ == "__main__":
+    main()
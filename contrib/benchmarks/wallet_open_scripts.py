@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Compare the time taken to open a wallet and prepare the script hashes of its keys for
+subscription, with and without the key scripts stored in the wallet database.
+
+    python3 contrib/benchmarks/wallet_open_scripts.py [key count]
+
+The first open has no stored scripts, as with a wallet that predates them, and derives every
+script. The second open reads the scripts the first one stored.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+CONTRIB_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(CONTRIB_PATH, "..", ".."))
+
+from electrumsv.app_state import AppStateProxy
+from electrumsv.constants import RECEIVING_SUBPATH, ScriptType
+from electrumsv.keystore import from_seed
+from electrumsv.simple_config import SimpleConfig
+from electrumsv.storage import WalletStorage
+from electrumsv.wallet import StandardAccount, Wallet
+from electrumsv.wallet_database.tables import AccountRow
+
+
+SEED_WORDS = 'cycle rocket west magnet parrot shuffle foot correct salt library feed song'
+
+
+def create_wallet(wallet_path: str, key_count: int) -> None:
+    wallet = Wallet(WalletStorage(wallet_path))
+    masterkey_row = wallet.create_masterkey_from_keystore(from_seed(SEED_WORDS, ''))
+    account_row = wallet.add_accounts([ AccountRow(-1, masterkey_row.masterkey_id,
+        ScriptType.P2PKH, 'benchmark') ])[0]
+    account = StandardAccount(wallet, account_row, [], [])
+    account.create_keys(key_count, RECEIVING_SUBPATH)
+    # Remove the scripts stored for the new keys, if any.
+    wallet._db_context.queue_write(lambda db: db.execute("DELETE FROM KeyInstanceScripts"))
+    wallet.stop()
+
+
+def open_wallet(wallet_path: str) -> float:
+    start_time = time.perf_counter()
+    wallet = Wallet(WalletStorage(wallet_path))
+    for account in wallet.get_accounts():
+        account.get_possible_script_hashes(account.existing_active_keys())
+    elapsed_time = time.perf_counter() - start_time
+    # Closing the storage waits for the stored scripts to be written.
+    wallet.stop()
+    return elapsed_time
+
+
+def main() -> None:
+    key_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    app_state = AppStateProxy(SimpleConfig(), 'qt')
+    app_state.async_.__enter__()
+    temp_path = tempfile.mkdtemp()
+    try:
+        wallet_path = os.path.join(temp_path, "benchmark")
+        create_wallet(wallet_path, key_count)
+        derived_time = open_wallet(wallet_path)
+        stored_time = open_wallet(wallet_path)
+    finally:
+        app_state.async_.__exit__(None, None, None)
+        shutil.rmtree(temp_path)
+
+    print(f"keys:          {key_count}")
+    print(f"derived:       {derived_time:8.2f} seconds")
+    print(f"stored:        {stored_time:8.2f} seconds")
+    print(f"reduction:     {100 * (1 - stored_time / derived_time):8.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -23,7 +23,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Sequence, Union
+from typing import Optional, Sequence, Tuple, Union
 
 from bitcoinx import (Ops, hash_to_hex_str, sha256, Address, classify_output_script,
     OP_RETURN_Output, P2MultiSig_Output, P2PK_Output, P2PKH_Address, P2SH_Address, Script,
@@ -236,6 +236,14 @@ def scripthash_bytes(script: Script) -> bytes:
 def scripthash_hex(item: Script) -> str:
     return hash_to_hex_str(scripthash_bytes(item))
 
+def history_status(history: Sequence[Tuple[str, int]]) -> Optional[str]:
+    '''The status of a script hash history, as given by the server in subscription responses and
+    notifications. history is a sequence of (tx_id, tx_height) pairs in server order.'''
+    if not history:
+        return None
+    status = ''.join(f'{tx_id}:{tx_height}:' for tx_id, tx_height in history)
+    return sha256(status.encode()).hex()
+
 def msg_magic(message):
     length = bfh(var_int(len(message)))
     return b"\x18Bitcoin Signed Message:\n" + length + message
@@ -22,7 +22,7 @@ class StorageKind(IntEnum):
 
 DATABASE_EXT = ".sqlite"
 MIGRATION_FIRST = 22
-MIGRATION_CURRENT = 23
+MIGRATION_CURRENT = 26
 
 class TxFlags(IntFlag):
     Unset = 0
@@ -33,6 +33,12 @@ class TxFlags(IntFlag):
     HasPosition = 1 << 6
     HasByteData = 1 << 12
     HasProofData = 1 << 13
+    # The stored bytedata is zlib compressed. This is only ever set in the database, and is
+    # removed from the flags the transaction table reads.
+    CompressedByteData = 1 << 14
+    # The bytedata of a settled transaction whose outputs were all spent has been dropped, and
+    # has to be fetched from the network again to be seen.
+    PrunedByteData = 1 << 15
 
     # A transaction received over the p2p network which is unconfirmed and in the mempool.
     StateCleared = 1 << 20
@@ -147,6 +153,14 @@ class KeyInstanceFlag(IntFlag):
     ALLOCATED_MASK = IS_PAYMENT_REQUEST
 
 
+class StatusPriority(IntEnum):
+    # The order script hash status notifications are processed in, most urgent first.
+    PAYMENT_REQUEST = 0
+    FRESH = 1
+    USED = 2
+    CHANGE = 3
+
+
 class TransactionOutputFlag(IntFlag):
     NONE = 0
 
@@ -177,6 +191,8 @@ MAX_INCOMING_ELECTRUMX_MESSAGE_SIZE = 10_000_000
 MINIMUM_TXDATA_CACHE_SIZE_MB = 0
 DEFAULT_TXDATA_CACHE_SIZE_MB = 32
 MAXIMUM_TXDATA_CACHE_SIZE_MB = 2147483647 # Maximum the spinbox widget can handle :-()
+# The parsed transactions take several times the memory of their bytedata.
+DEFAULT_TXOBJECT_CACHE_SIZE_MB = 16
 
 DEFAULT_COSIGNER_COUNT = 2
 MAXIMUM_COSIGNER_COUNT = 15
@@ -34,6 +34,7 @@ from .app_state import app_state
 from .commands import known_commands, Commands
 from .exchange_rate import FxTask
 from .jsonrpc import VerifyingJSONRPCServer
+from .keystore import shutdown_derivation_pool
 from .logs import logs
 from .network import Network
 from .simple_config import SimpleConfig
@@ -355,4 +356,5 @@ class Daemon(DaemonThread):
         logger.warning("stopping")
         super().stop()
         self.stop_wallets()
+        shutdown_derivation_pool()
         remove_lockfile(get_lockfile(self.config))
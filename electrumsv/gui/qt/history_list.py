@@ -185,6 +185,9 @@ class HistoryView(MyTreeWidget):
         else:
             account_id, tx_hash = item.data(0, Qt.UserRole)
             account = self._wallet.get_account(account_id)
+            if account.is_transaction_pruned(tx_hash):
+                self._show_pruned_transaction(account, tx_hash)
+                return
             tx = account.get_transaction(tx_hash)
             if tx is not None:
                 self._main_window.show_transaction(account, tx)
@@ -192,6 +195,20 @@ class HistoryView(MyTreeWidget):
                 MessageBox.show_error(_("The full transaction is not yet present in your wallet."+
                     " Please try again when it has been obtained from the network."))
 
+    def _show_pruned_transaction(self, account: AbstractAccount, tx_hash: bytes,
+            label: Optional[str]=None) -> None:
+        # The wallet no longer has the transaction, so it is fetched from the network again.
+        try:
+            tx = account.fetch_pruned_transaction(tx_hash)
+        except Exception:
+            self._main_window.logger.exception("failed to fetch pruned transaction")
+            tx = None
+        if tx is not None:
+            self._main_window.show_transaction(account, tx, label)
+        else:
+            MessageBox.show_error(_("The full transaction was pruned from your wallet, and "
+                "could not be obtained from the network. Please try again when connected."))
+
     def update_tx_labels(self) -> None:
         root = self.invisibleRootItem()
         child_count = root.childCount()
@@ -237,7 +254,9 @@ class HistoryView(MyTreeWidget):
         tx_URL = web.BE_URL(self.config, 'tx', tx_id)
         height, _conf, _timestamp = account.get_tx_height(tx_hash)
         tx = account.get_transaction(tx_hash)
-        if not tx: return # this happens sometimes on account synch when first starting up.
+        is_pruned = tx is None and account.is_transaction_pruned(tx_hash)
+        # This happens sometimes on account synch when first starting up.
+        if not tx and not is_pruned: return
         is_unconfirmed = height <= 0
         pr_key = account.invoices.paid.get(tx_hash)
 
@@ -250,8 +269,12 @@ class HistoryView(MyTreeWidget):
             menu.addAction(_("Edit {}").format(column_title),
                 lambda: self.currentItem() and self.editItem(self.currentItem(), column))
         label = account.get_transaction_label(tx_hash) or None
-        menu.addAction(_("Details"), lambda: self._main_window.show_transaction(account,
-            tx, label))
+        if is_pruned:
+            menu.addAction(_("Details"), lambda: self._show_pruned_transaction(account, tx_hash,
+                label))
+        else:
+            menu.addAction(_("Details"), lambda: self._main_window.show_transaction(account,
+                tx, label))
         if is_unconfirmed and tx:
             child_tx = account.cpfp(tx, 0)
             if child_tx:
@@ -267,7 +290,7 @@ class HistoryView(MyTreeWidget):
 
 def get_tx_status(account: AbstractAccount, tx_hash: bytes, height: int, conf: int,
         timestamp: Union[bool, int]) -> TxStatus:
-    if not account.have_transaction_data(tx_hash):
+    if not account.have_transaction_data(tx_hash) and not account.is_transaction_pruned(tx_hash):
         return TxStatus.MISSING
 
     metadata = account.get_transaction_metadata(tx_hash)
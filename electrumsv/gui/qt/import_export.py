@@ -202,7 +202,7 @@ class LabelImporter(QDialog):
         # We do not actually know what transactions belong to an account, transactions are
         # currently cached on a larger entire wallet basis.
         for tx_hash, tx_description in result.transaction_labels.items():
-            if not self._wallet._transaction_cache.is_cached(tx_hash):
+            if self._wallet._transaction_cache.get_flags(tx_hash) is None:
                 self._tx_state[tx_hash] = LabelState.UNKNOWN
             else:
                 existing_description = account.get_transaction_label(tx_hash)
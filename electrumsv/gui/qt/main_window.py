@@ -2154,16 +2154,28 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin):
         maximum_txcachesize_label = QLabel()
         hits_label = QLabel()
         misses_label = QLabel()
+        evictions_label = QLabel()
+        current_txobjectcachesize_label = QLabel()
+        maximum_txobjectcachesize_label = QLabel()
+        object_hits_label = QLabel()
+        object_misses_label = QLabel()
 
         def update_txcachesizes():
             nonlocal current_txcachesize_label, maximum_txcachesize_label
-            nonlocal hits_label, misses_label
-            cache = self._wallet._transaction_cache._bytedata_cache
-            current_size, max_size = cache.get_sizes()
-            current_txcachesize_label.setText(str(current_size))
-            maximum_txcachesize_label.setText(str(max_size))
-            hits_label.setText(str(cache.hits))
-            misses_label.setText(str(cache.misses))
+            nonlocal hits_label, misses_label, evictions_label
+            stats = self._wallet._transaction_cache._bytedata_cache.get_stats()
+            current_txcachesize_label.setText(str(stats.current_size))
+            maximum_txcachesize_label.setText(str(stats.maximum_size))
+            hits_label.setText(str(stats.hits))
+            misses_label.setText(str(stats.misses))
+            evictions_label.setText(str(stats.evictions))
+
+            object_cache = self._wallet._transaction_cache._transaction_object_cache
+            current_size, max_size = object_cache.get_sizes()
+            current_txobjectcachesize_label.setText(str(current_size))
+            maximum_txobjectcachesize_label.setText(str(max_size))
+            object_hits_label.setText(str(object_cache.hits))
+            object_misses_label.setText(str(object_cache.misses))
         update_txcachesizes()
 
         memory_usage_form = FormSectionWidget(minimum_label_width=100)
@@ -2172,7 +2184,16 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin):
         memory_usage_form.add_row(_("Maximum usage"), maximum_txcachesize_label)
         memory_usage_form.add_row(_("Cache hits"), hits_label)
         memory_usage_form.add_row(_("Cache misses"), misses_label)
+        memory_usage_form.add_row(_("Cache evictions"), evictions_label)
         vbox.addWidget(memory_usage_form)
+
+        object_memory_usage_form = FormSectionWidget(minimum_label_width=100)
+        object_memory_usage_form.add_title(_("Parsed transaction cache"))
+        object_memory_usage_form.add_row(_("Estimated usage"), current_txobjectcachesize_label)
+        object_memory_usage_form.add_row(_("Maximum usage"), maximum_txobjectcachesize_label)
+        object_memory_usage_form.add_row(_("Cache hits"), object_hits_label)
+        object_memory_usage_form.add_row(_("Cache misses"), object_misses_label)
+        vbox.addWidget(object_memory_usage_form)
         vbox.addStretch(1)
         vbox.addLayout(Buttons(CloseButton(dialog)))
 
@@ -24,6 +24,10 @@
 from collections import defaultdict
 import hashlib
 import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import threading
 from typing import Any, cast, Dict, List, Optional, Sequence, Tuple, Union
 from unicodedata import normalize
 
@@ -48,6 +52,51 @@ from .wallet_database.tables import KeyInstanceRow, MasterKeyRow
 
 logger = logs.get_logger("keystore")
 
+# Batches of at least this many keys are derived in worker processes, each given a chunk of at
+# least `DERIVATION_CHUNK_MINIMUM` keys.
+DERIVATION_PROCESS_MINIMUM = 2000
+DERIVATION_CHUNK_MINIMUM = 500
+
+_derivation_pool: Optional[multiprocessing.pool.Pool] = None
+_derivation_pool_size = os.cpu_count() or 1
+_derivation_pool_lock = threading.Lock()
+
+
+def _derive_child_public_keys(xpub: str, indexes: Sequence[int]) -> List[bytes]:
+    # Public key objects cannot be pickled, so their serialised form is returned.
+    xpubkey = bip32_key_from_string(xpub)
+    return [ xpubkey.child_safe(n).to_bytes() for n in indexes ]
+
+
+def _get_derivation_pool() -> Optional[multiprocessing.pool.Pool]:
+    global _derivation_pool, _derivation_pool_size
+    with _derivation_pool_lock:
+        if _derivation_pool is None and _derivation_pool_size > 1:
+            # The application has other threads by the time keys are derived, and forking it
+            # could leave the workers waiting on locks those threads held. They are started
+            # afresh instead.
+            try:
+                _derivation_pool = multiprocessing.get_context("spawn").Pool(
+                    _derivation_pool_size)
+            except OSError:
+                logger.exception("unable to start key derivation processes")
+                _derivation_pool_size = 1
+        return _derivation_pool
+
+
+def shutdown_derivation_pool() -> None:
+    """
+    Stop the key derivation worker processes, if they were started. They are started again if
+    more keys are derived.
+    """
+    global _derivation_pool
+    with _derivation_pool_lock:
+        if _derivation_pool is not None:
+            _derivation_pool.terminate()
+            _derivation_pool.join()
+            _derivation_pool = None
+
+
 class KeyStore:
     derivation_type = DerivationType.NONE
     label: Optional[str] = None
@@ -355,7 +404,7 @@ class DerivablePaths:
 class Xpub(DerivablePaths):
     def __init__(self) -> None:
         self.xpub: Optional[str] = None
-        self._child_xpubs: Dict[Sequence[int], str] = {}
+        self._child_xpubs: Dict[Sequence[int], BIP32PublicKey] = {}
 
     def get_master_public_key(self) -> Optional[str]:
         return self.xpub
@@ -363,16 +412,39 @@ class Xpub(DerivablePaths):
     def get_fingerprint(self) -> bytes:
         return bip32_key_from_string(self.xpub).fingerprint()
 
-    def derive_pubkey(self, derivation_path: Sequence[int]) -> PublicKey:
-        parent_path = derivation_path[:-1]
-        xpub = self._child_xpubs.get(parent_path)
-        if xpub is None:
+    def _get_child_xpubkey(self, derivation_path: Sequence[int]) -> BIP32PublicKey:
+        derivation_path = tuple(derivation_path)
+        xpubkey = self._child_xpubs.get(derivation_path)
+        if xpubkey is None:
             xpubkey = bip32_key_from_string(self.xpub)
-            for n in parent_path:
+            for n in derivation_path:
                 xpubkey = xpubkey.child_safe(n)
-            xpub = xpubkey.to_extended_key_string()
-            self._child_xpubs[parent_path] = xpub
-        return self.get_pubkey_from_xpub(xpub, derivation_path[-1:])
+            self._child_xpubs[derivation_path] = xpubkey
+        return xpubkey
+
+    def derive_pubkey(self, derivation_path: Sequence[int]) -> PublicKey:
+        return self._get_child_xpubkey(derivation_path[:-1]).child_safe(derivation_path[-1])
+
+    def derive_pubkeys(self, parent_path: Sequence[int],
+            indexes: Sequence[int]) -> List[PublicKey]:
+        """
+        Derive the public keys for the given child indexes of the parent path. Large batches
+        are split across worker processes.
+        """
+        xpubkey = self._get_child_xpubkey(parent_path)
+        if len(indexes) >= DERIVATION_PROCESS_MINIMUM:
+            pool = _get_derivation_pool()
+            if pool is not None:
+                xpub = xpubkey.to_extended_key_string()
+                chunk_size = max(DERIVATION_CHUNK_MINIMUM,
+                    -(-len(indexes) // _derivation_pool_size))
+                chunk_results = pool.starmap(_derive_child_public_keys,
+                    [ (xpub, indexes[i:i+chunk_size])
+                    for i in range(0, len(indexes), chunk_size) ])
+                return [ PublicKey.from_bytes(public_key_bytes)
+                    for public_key_bytes_list in chunk_results
+                    for public_key_bytes in public_key_bytes_list ]
+        return [ xpubkey.child_safe(n) for n in indexes ]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub: str, sequence: Sequence[int]) -> PublicKey:
@@ -588,6 +660,10 @@ class Old_KeyStore(DerivablePaths, Deterministic_KeyStore):
         assert len(derivation_path) == 2
         return self.get_pubkey_from_mpk(self.mpk, derivation_path)
 
+    def derive_pubkeys(self, parent_path: Sequence[int],
+            indexes: Sequence[int]) -> List[PublicKey]:
+        return [ self.derive_pubkey(tuple(parent_path) + (n,)) for n in indexes ]
+
     def get_private_key_from_stretched_exponent(self, derivation_path: Sequence[int],
             secexp) -> bytes:
         assert len(derivation_path) == 2
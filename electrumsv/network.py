@@ -21,23 +21,25 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-from collections import defaultdict
+from collections import defaultdict, deque
 from contextlib import suppress
 from enum import IntEnum
 from functools import partial
+import heapq
 import os
 import random
 import re
 import ssl
 import stat
 import time
-from typing import Any, Dict, List, Optional
+from typing import (Any, Awaitable, Callable, Coroutine, Deque, Dict, Iterable, List, Optional, Set,
+    Tuple)
 
 import certifi
 from aiorpcx import (
-    connect_rs, RPCSession, Notification, BatchError, RPCError, CancelledError, SOCKSError,
-    TaskTimeout, TaskGroup, handler_invocation, sleep, ignore_after, timeout_after,
-    SOCKS4a, SOCKS5, SOCKSProxy, SOCKSUserAuth, NewlineFramer
+    connect_rs, JSONRPC, RPCSession, Notification, BatchError, RPCError, CancelledError,
+    SOCKSError, TaskTimeout, TaskGroup, handler_invocation, sleep, ignore_after, timeout_after,
+    run_in_thread, SOCKS4a, SOCKS5, SOCKSProxy, SOCKSUserAuth, NewlineFramer
 )
 from bitcoinx import (
     MissingHeader, IncorrectBits, InsufficientPoW, hex_str_to_hash, hash_to_hex_str,
@@ -45,8 +47,8 @@ from bitcoinx import (
 )
 
 from .app_state import app_state
-from .bitcoin import scripthash_hex
-from .constants import TxFlags, MAX_INCOMING_ELECTRUMX_MESSAGE_SIZE
+from .bitcoin import history_status
+from .constants import StatusPriority, TxFlags, MAX_INCOMING_ELECTRUMX_MESSAGE_SIZE
 from .i18n import _
 from .logs import logs
 from .transaction import Transaction
@@ -65,6 +67,42 @@ REQUEST_MERKLE_PROOF = 'blockchain.transaction.get_merkle'
 SCRIPTHASH_HISTORY = 'blockchain.scripthash.get_history'
 SCRIPTHASH_SUBSCRIBE = 'blockchain.scripthash.subscribe'
 SCRIPTHASH_UNSUBSCRIBE = 'blockchain.scripthash.unsubscribe'
+# The number of transactions requested in each batch, and the number of batches in flight for
+# each session fetching them.
+TX_REQUEST_BATCH_SIZE = 50
+TX_REQUEST_BATCH_WINDOW = 4
+# The number of merkle proofs requested in each batch, and the number of batches in flight for
+# each session fetching them.
+PROOF_REQUEST_BATCH_SIZE = 100
+PROOF_REQUEST_BATCH_WINDOW = 4
+# The number of fetches a session has in flight at a time, and the number of sessions a fetch
+# is tried on before it is given up on.
+SESSION_FETCH_LIMIT = 4
+FETCH_ATTEMPTS = 3
+# The number of script hashes subscribed to in the first batch, the bounds the batch size adapts
+# within, and the number of batches in flight.
+SUBSCRIPTION_BATCH_SIZE = 100
+SUBSCRIPTION_BATCH_SIZE_MIN = 10
+SUBSCRIPTION_BATCH_SIZE_MAX = 1000
+SUBSCRIPTION_BATCH_WINDOW = 4
+# Subscription batches answered in fewer seconds than the lower latency grow the batch size, and
+# those taking longer than the upper latency shrink it.
+SUBSCRIPTION_LATENCY_LOW = 1.0
+SUBSCRIPTION_LATENCY_HIGH = 5.0
+# The seconds to wait before the first retry of subscriptions the server refused as too costly.
+# The wait doubles with each further refusal.
+SUBSCRIPTION_RETRY_DELAY = 2.0
+SUBSCRIPTION_RETRY_DELAY_MAX = 60.0
+# The number of headers requested in each chunk, and the number of chunks in flight when
+# catching up to a tip.
+HEADER_CHUNK_SIZE = 2016
+HEADER_CHUNK_WINDOW = 4
+# The number of headers connected to the chain at a time, before other tasks are let run.
+HEADER_CONNECT_SLICE = 200
+# The number of script hash histories fetched at a time for status notifications.
+STATUS_FETCH_WINDOW = 8
+# The error codes a server uses to refuse a request because of the session's resource usage.
+RATE_LIMIT_ERROR_CODES = { JSONRPC.EXCESSIVE_RESOURCE_USAGE, JSONRPC.SERVER_BUSY }
 BROADCAST_TX_MSG_LIST = (
     ('dust', _('very small "dust" payments')),
     (('Missing inputs', 'Inputs unavailable', 'bad-txns-inputs-spent'),
@@ -120,11 +158,19 @@ def _require_string(obj):
     return obj
 
 
-def _history_status(history) -> Optional[str]:
-    if not history:
-        return None
-    status = ''.join(f'{tx_id}:{tx_height}:' for tx_id, tx_height in history)
-    return sha256(status.encode()).hex()
+def _verify_chunk(coin, raw_chunk: bytes) -> None:
+    '''Checks that the headers of a chunk link to each other, and that each has proof of work
+    meeting its bits. Whether the bits are those the chain requires is left to connecting them.
+
+    Raises: MissingHeader, InsufficientPoW'''
+    prev_hash = None
+    for start in range(0, len(raw_chunk), HEADER_SIZE):
+        header = coin.deserialized_header(raw_chunk[start:start + HEADER_SIZE], -1)
+        if prev_hash is not None and header.prev_hash != prev_hash:
+            raise MissingHeader('prev_hash does not connect')
+        if header.hash_value() > header.target():
+            raise InsufficientPoW(header)
+        prev_hash = header.hash
 
 
 def _root_from_proof(hash, branch, index):
@@ -330,13 +376,172 @@ class SVProxy(SOCKSProxy):
         return ', '.join((repr(self.address), self.kind(), repr(self.auth)))
 
 
+class SubscriptionRegistry:
+    '''The script hashes subscribed to on the server, and the accounts that need each of them.
+
+    A server subscription is shared by all the accounts that need the script hash, and is only
+    released when none of them do. Each operation costs in proportion to the number of script
+    hashes it is given, not the number subscribed to.
+    '''
+
+    def __init__(self) -> None:
+        # script_hash -> accounts needing it; the number of accounts is its reference count.
+        self._accounts_by_script_hash: Dict[str, Set[Any]] = {}
+        # account -> script hashes.  Also acts as the set of registered accounts.
+        self._script_hashes_by_account: Dict[Any, Set[str]] = {}
+
+    def has_account(self, account) -> bool:
+        return account in self._script_hashes_by_account
+
+    def add(self, account, script_hashes: Iterable[str]) -> List[str]:
+        '''Registers the account if needed and adds the script hashes it needs. Returns the
+        script hashes the account did not already have.'''
+        account_script_hashes = self._script_hashes_by_account.setdefault(account, set())
+        added_script_hashes = []
+        for script_hash in script_hashes:
+            if script_hash in account_script_hashes:
+                continue
+            account_script_hashes.add(script_hash)
+            self._accounts_by_script_hash.setdefault(script_hash, set()).add(account)
+            added_script_hashes.append(script_hash)
+        return added_script_hashes
+
+    def remove(self, account, script_hashes: Iterable[str]) -> List[str]:
+        '''Removes the script hashes the account no longer needs. Returns the script hashes that
+        no account needs any more, and that can be unsubscribed from.'''
+        account_script_hashes = self._script_hashes_by_account.get(account)
+        if account_script_hashes is None:
+            return []
+        released_script_hashes = []
+        for script_hash in script_hashes:
+            if script_hash not in account_script_hashes:
+                continue
+            account_script_hashes.remove(script_hash)
+            if self._release(account, script_hash):
+                released_script_hashes.append(script_hash)
+        return released_script_hashes
+
+    def remove_account(self, account) -> List[str]:
+        '''Unregisters the account and removes all its script hashes. Returns the script hashes
+        that no account needs any more.'''
+        account_script_hashes = self._script_hashes_by_account.pop(account, None)
+        if account_script_hashes is None:
+            return []
+        return [ script_hash for script_hash in account_script_hashes
+            if self._release(account, script_hash) ]
+
+    def clear_account(self, account) -> List[str]:
+        '''Removes all the account's script hashes and leaves it registered. Returns the script
+        hashes that no account needs any more.'''
+        released_script_hashes = self.remove_account(account)
+        self._script_hashes_by_account[account] = set()
+        return released_script_hashes
+
+    def _release(self, account, script_hash: str) -> bool:
+        accounts = self._accounts_by_script_hash[script_hash]
+        accounts.remove(account)
+        if accounts:
+            return False
+        del self._accounts_by_script_hash[script_hash]
+        return True
+
+    def get_accounts(self, script_hash: str) -> Set[Any]:
+        return self._accounts_by_script_hash.get(script_hash, set())
+
+    def count(self) -> int:
+        '''The number of script hashes subscribed to on behalf of any account.'''
+        return len(self._accounts_by_script_hash)
+
+    def account_count(self, account) -> int:
+        '''The number of script hashes subscribed to on behalf of the account.'''
+        return len(self._script_hashes_by_account.get(account, ()))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'total': self.count(),
+            'accounts': { str(account): len(script_hashes)
+                for account, script_hashes in self._script_hashes_by_account.items() },
+        }
+
+
+class StatusQueue:
+    '''Script hash status notifications waiting to be processed.
+
+    Only the latest status of each script hash is kept. Notifications are taken in priority
+    order, and oldest first within a priority. At most `window` are processed at a time, and
+    never more than one for the same script hash, so that the history fetches they lead to do
+    not race each other.
+    '''
+
+    def __init__(self, window: int) -> None:
+        self._window = window
+        # script_hash -> (priority, sequence, time queued, status)
+        self._pending: Dict[str, Tuple[int, int, float, str]] = {}
+        # The pending script hashes that are not in flight, as (priority, sequence, script_hash).
+        # Entries whose sequence no longer matches the pending entry are stale and skipped.
+        self._heap: List[Tuple[int, int, str]] = []
+        self._in_flight: Set[str] = set()
+        self._sequence = 0
+        self._coalesced_count = 0
+        self._changed_event = app_state.async_.event()
+
+    def put_nowait(self, script_hash: str, status: str, priority: int) -> None:
+        entry = self._pending.get(script_hash)
+        if entry is not None:
+            self._coalesced_count += 1
+            # The notification keeps its place unless the new one is more urgent.
+            if entry[0] <= priority:
+                self._pending[script_hash] = entry[:3] + (status,)
+                return
+            queued_time = entry[2]
+        else:
+            queued_time = time.monotonic()
+        self._sequence += 1
+        self._pending[script_hash] = priority, self._sequence, queued_time, status
+        if script_hash not in self._in_flight:
+            heapq.heappush(self._heap, (priority, self._sequence, script_hash))
+            self._changed_event.set()
+
+    async def get(self) -> Tuple[str, str]:
+        '''Waits for a notification that can be processed, returning its script hash and status.
+        The caller must call `task_done` with the script hash when it has been processed.'''
+        while True:
+            if len(self._in_flight) < self._window:
+                while self._heap:
+                    _priority, sequence, script_hash = heapq.heappop(self._heap)
+                    entry = self._pending.get(script_hash)
+                    if entry is None or entry[1] != sequence:
+                        continue
+                    del self._pending[script_hash]
+                    self._in_flight.add(script_hash)
+                    return script_hash, entry[3]
+            self._changed_event.clear()
+            await self._changed_event.wait()
+
+    def task_done(self, script_hash: str) -> None:
+        self._in_flight.discard(script_hash)
+        # A notification that arrived while this one was processed can now be taken.
+        entry = self._pending.get(script_hash)
+        if entry is not None:
+            heapq.heappush(self._heap, (entry[0], entry[1], script_hash))
+        self._changed_event.set()
+
+    def status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            'depth': len(self._pending),
+            'in_flight': len(self._in_flight),
+            'oldest_age': max((now - entry[2] for entry in self._pending.values()), default=0.0),
+            'coalesced': self._coalesced_count,
+        }
+
+
 class SVSession(RPCSession):
 
     ca_path = certifi.where()
     _connecting_tips = {}
     _need_checkpoint_headers = True
-    # account -> list of script hashes.  Also acts as a list of registered accounts
-    _subs_by_account = {}
+    _subscriptions = SubscriptionRegistry()
     # script_hash -> keyinstance_id
     _keyinstance_map = {}
 
@@ -351,6 +556,8 @@ class SVSession(RPCSession):
         self.server = server
         self.tip = None
         self.ptuple = (0, )
+        # The number of fetches the network has in flight on this session.
+        self.fetch_count = 0
 
     def set_throttled(self, flag: bool) -> None:
         if flag:
@@ -398,9 +605,10 @@ class SVSession(RPCSession):
             return app_state.headers.connect(raw_header)
 
     @classmethod
-    def _connect_chunk(cls, start_height, raw_chunk):
+    def _connect_chunk(cls, start_height, raw_chunk, flush=True):
         '''It is assumed that if the last header of the raw chunk is before the checkpoint height
-        then it has been checked for validity.
+        then it has been checked for validity. A caller connecting several chunks in a row can
+        flush the headers file once after the last of them.
         '''
         headers_obj = app_state.headers
         checkpoint = headers_obj.checkpoint
@@ -440,7 +648,8 @@ class SVSession(RPCSession):
 
             return chain or headers_obj.longest_chain()
         finally:
-            headers_obj.flush()
+            if flush:
+                headers_obj.flush()
 
     async def _negotiate_protocol(self):
         '''Raises: RPCError, TaskTimeout'''
@@ -498,6 +707,116 @@ class SVSession(RPCSession):
         self.logger.info(f'connected {rec_count:,d} headers up to height {last_height:,d}')
         return last_height
 
+    async def _fetch_chunk(self, height: int, count: int) -> bytes:
+        '''Requests a chunk of headers after the checkpoint. The headers are checked in a worker
+        thread to link to each other and have valid proof of work, so that invalid chunks are
+        refused before they are connected on the event loop. The chunk may be shorter than
+        requested.
+
+        Raises: RPCError, TaskTimeout, DisconnectSessionError'''
+        method = 'blockchain.block.headers'
+        result = await self.send_request(method, (height, count, 0))
+        try:
+            rec_count = result['count']
+            assert 0 < rec_count <= count, f'received {rec_count} headers'
+            raw_chunk = bytes.fromhex(result['hex'])
+            assert len(raw_chunk) == HEADER_SIZE * rec_count
+            await run_in_thread(_verify_chunk, Net.COIN, raw_chunk)
+        except (AssertionError, KeyError, TypeError, ValueError, InsufficientPoW,
+                MissingHeader) as e:
+            raise DisconnectSessionError(f'{method} failed: {e}', blacklist=True)
+        return raw_chunk
+
+    async def _fetch_chunk_or_none(self, session: 'SVSession', height: int,
+            count: int) -> Optional[bytes]:
+        '''Fetches a chunk from the given session. Failures of other sessions are logged and
+        give None, so the chunk can be fetched from this session instead. Other sessions that
+        serve invalid chunks are disconnected and blacklisted.'''
+        try:
+            return await session._fetch_chunk(height, count)
+        except (RPCError, TaskTimeout, DisconnectSessionError) as e:
+            if session is self:
+                raise
+            session.logger.warning(f'failed fetching headers from height {height:,d}: {e}')
+            if isinstance(e, DisconnectSessionError):
+                await session.disconnect(str(e), blacklist=True)
+        except CancelledError:
+            # Requests pending on a session are cancelled when it disconnects.
+            if session is self or not session.is_closing():
+                raise
+        return None
+
+    async def _request_chunks(self, start_height: int, end_height: int) -> None:
+        '''Connects the headers after the checkpoint from start_height up to and including
+        end_height. Several chunks are in flight at a time, spread across this and any other
+        sessions that have the headers, and they are connected in order as they arrive. The
+        headers file is flushed once at the end rather than after each chunk. Other sessions that
+        serve headers that do not connect are disconnected, and blacklisted if they are invalid.
+
+        Raises: RPCError, TaskTimeout, DisconnectSessionError'''
+        window = app_state.config.get('header_chunk_window', HEADER_CHUNK_WINDOW)
+        self.logger.info(f'requesting {end_height + 1 - start_height:,d} headers from height '
+            f'{start_height:,d}')
+        pending: Deque[Tuple[int, int, SVSession, Any]] = deque()
+        next_height = start_height
+        chunk_index = 0
+        try:
+            async with TaskGroup() as group:
+                while pending or next_height <= end_height:
+                    while len(pending) < window and next_height <= end_height:
+                        count = min(HEADER_CHUNK_SIZE, end_height + 1 - next_height)
+                        sessions = [ self ] + [ session for session in self._network.sessions
+                            if session is not self and not session.is_closing()
+                            and session.tip is not None
+                            and session.tip.height >= next_height + count - 1 ]
+                        session = sessions[chunk_index % len(sessions)]
+                        chunk_index += 1
+                        task = await group.spawn(self._fetch_chunk_or_none(session, next_height,
+                            count))
+                        pending.append((next_height, count, session, task))
+                        next_height += count
+
+                    height, count, session, task = pending.popleft()
+                    raw_chunk = await task
+                    # Short responses and chunks from other sessions that do not connect are
+                    # completed from this session.
+                    while count:
+                        if raw_chunk is None:
+                            raw_chunk = await self._fetch_chunk(height, count)
+                            session = self
+                        try:
+                            await self._connect_chunk_slices(height, raw_chunk)
+                        except (IncorrectBits, InsufficientPoW, MissingHeader) as e:
+                            reason = f'blockchain.block.headers failed: {e}'
+                            if session is self:
+                                raise DisconnectSessionError(reason, blacklist=True)
+                            # Headers that do not connect may be from a server following another
+                            # fork. Its other chunks in flight are cancelled and fetched from here.
+                            await session.disconnect(reason,
+                                blacklist=not isinstance(e, MissingHeader))
+                            raw_chunk = None
+                            continue
+                        rec_count = len(raw_chunk) // HEADER_SIZE
+                        height += rec_count
+                        count -= rec_count
+                        raw_chunk = None
+                    self.logger.info(f'connected headers up to height {height - 1:,d}')
+        finally:
+            app_state.headers.flush()
+
+    async def _connect_chunk_slices(self, height: int, raw_chunk: bytes) -> None:
+        '''Connects a verified chunk after the checkpoint a slice at a time, letting other tasks
+        run in between, so that the event loop is not held for the whole chunk. The headers file
+        is not flushed.
+
+        Raises: IncorrectBits, InsufficientPoW, MissingHeader'''
+        slice_size = HEADER_CONNECT_SLICE * HEADER_SIZE
+        for start in range(0, len(raw_chunk), slice_size):
+            if start:
+                await sleep(0)
+            self.chain = self._connect_chunk(height + start // HEADER_SIZE,
+                raw_chunk[start:start + slice_size], flush=False)
+
     async def _subscribe_headers(self):
         '''Raises: RPCError, TaskTimeout, DisconnectSessionError'''
         self._handlers[HEADERS_SUBSCRIBE] = self._on_new_tip
@@ -588,14 +907,25 @@ class SVSession(RPCSession):
 
         height = await self._request_headers_at_heights(heights)
         # Catch up
-        while height < tip.height:
-            height = await self._request_chunk(height + 1, 2016)
+        if height < tip.height:
+            await self._request_chunks(height + 1, tip.height)
 
     async def _subscribe_to_script_hash(self, script_hash: str) -> None:
         '''Raises: RPCError, TaskTimeout'''
         status = await self.send_request(SCRIPTHASH_SUBSCRIBE, [script_hash])
         await self._on_queue_status_changed(script_hash, status)
 
+    async def _subscribe_to_script_hashes(self, script_hashes: List[str]) -> List[Any]:
+        '''Subscribes to the script hashes as a batch. The results are the statuses in the same
+        order as the script hashes, with an exception in place of any that the server errored on.
+
+        Raises: TaskTimeout
+        '''
+        async with self.send_batch() as batch:
+            for script_hash in script_hashes:
+                batch.add_request(SCRIPTHASH_SUBSCRIBE, [script_hash])
+        return list(batch.results)
+
     async def _unsubscribe_from_script_hash(self, script_hash: str) -> bool:
         return await self.send_request(SCRIPTHASH_UNSUBSCRIBE, [script_hash])
 
@@ -607,14 +937,13 @@ class SVSession(RPCSession):
         keyinstance_id, script_type = keydata
 
         # Accounts needing a notification.
-        accounts = [account for account, subs in self._subs_by_account.items()
-            if script_hash in subs and
-            _history_status(account.get_key_history(keyinstance_id, script_type)) != status]
+        accounts = [account for account in self._subscriptions.get_accounts(script_hash)
+            if account.get_key_status(keyinstance_id, script_type) != status]
         if not accounts:
             return
 
         # Status has changed; get history
-        result = await self.request_history(script_hash)
+        result = await self._fetch_history(script_hash, status)
         self.logger.debug(f'received history of {keyinstance_id} length {len(result)}')
         try:
             history = [(item['tx_hash'], item['height']) for item in result]
@@ -623,12 +952,12 @@ class SVSession(RPCSession):
             assert len(set(tx_hash for tx_hash, tx_height in history)) == len(history), \
                 f'server history for {keyinstance_id} has duplicate transactions'
         except (AssertionError, KeyError) as e:
-            self._network._on_status_queue.put_nowait((script_hash, status))  # re-queue
+            await self._on_queue_status_changed(script_hash, status)  # re-queue
             raise DisconnectSessionError(f'bad history returned: {e}')
 
         # Check the status; it can change legitimately between initial notification and
         # history request
-        hstatus = _history_status(history)
+        hstatus = history_status(history)
         if hstatus != status:
             self.logger.warning(
                 f'history status mismatch {hstatus} vs {status} for {keyinstance_id}')
@@ -640,6 +969,25 @@ class SVSession(RPCSession):
 
             await account.set_key_history(keyinstance_id, script_type, history, tx_fees)
 
+    async def _fetch_history(self, script_hash: str, status: str) -> Any:
+        '''Fetches the history from whichever session is least busy. Another server may not yet
+        have the history this one gave the status of, in which case it is fetched from this one.
+
+        Raises: RPCError, TaskTimeout'''
+        session, result = await self._network._fetch(f'history of {script_hash}',
+            lambda session: session.request_history(script_hash))
+        if session is self:
+            return result
+        if session is not None:
+            try:
+                if history_status([ (item['tx_hash'], item['height'])
+                        for item in result ]) == status:
+                    return result
+            except (KeyError, TypeError):
+                pass
+            session.logger.debug(f'history of {script_hash} does not match main server status')
+        return await self.request_history(script_hash)
+
     async def _main_server_batch(self):
         '''Raises: DisconnectSessionError, BatchError, TaskTimeout'''
         async with timeout_after(10):
@@ -788,95 +1136,169 @@ class SVSession(RPCSession):
         '''Raises: RPCError, TaskTimeout'''
         return await self.send_request('blockchain.transaction.get', [tx_id])
 
+    async def request_txs(self, tx_ids: List[str]) -> List[Any]:
+        '''Requests the transactions as a batch. The results are in the same order as the ids,
+        with an exception in place of any that the server errored on.
+
+        Raises: TaskTimeout
+        '''
+        async with self.send_batch() as batch:
+            for tx_id in tx_ids:
+                batch.add_request('blockchain.transaction.get', [tx_id])
+        return list(batch.results)
+
     async def request_proof(self, *args):
         '''Raises: RPCError, TaskTimeout'''
         return await self.send_request(REQUEST_MERKLE_PROOF, args)
 
+    async def request_proofs(self, requests: List[Tuple[str, int]]) -> List[Any]:
+        '''Requests the merkle proofs for the (tx_id, height) pairs as a batch. The results are
+        in the same order as the requests, with an exception in place of any that the server
+        errored on.
+
+        Raises: TaskTimeout
+        '''
+        async with self.send_batch() as batch:
+            for tx_id, tx_height in requests:
+                batch.add_request(REQUEST_MERKLE_PROOF, [tx_id, tx_height])
+        return list(batch.results)
+
     async def request_history(self, script_hash):
         '''Raises: RPCError, TaskTimeout'''
         return await self.send_request(SCRIPTHASH_HISTORY, [script_hash])
 
     async def _on_queue_status_changed(self, script_hash: str, status: str) -> None:
-        item = (script_hash, status)
-        self._network._on_status_queue.put_nowait(item)
+        self._network._on_status_queue.put_nowait(script_hash, status,
+            self._get_status_priority(script_hash))
+
+    def _get_status_priority(self, script_hash: str) -> StatusPriority:
+        keydata = self._keyinstance_map.get(script_hash)
+        if keydata is None:
+            return StatusPriority.CHANGE
+        keyinstance_id = keydata[0]
+        return min((account.get_key_status_priority(keyinstance_id)
+            for account in self._subscriptions.get_accounts(script_hash)),
+            default=StatusPriority.CHANGE)
 
     async def subscribe_to_triples(self, account, triples) -> None:
         '''triples is an iterable of (keyinstance_id, script_type, script_hash) triples.
 
+        The subscriptions are sent in batches with a bounded number in flight, so that a large
+        account neither floods the server nor has a task per script hash. The batch size grows
+        while the server answers quickly and shrinks when it slows down, and subscriptions the
+        server refuses for excessive resource usage are retried after a growing delay.
+
         Raises: RPCError, TaskTimeout'''
         # Set notification handler
         self._handlers[SCRIPTHASH_SUBSCRIBE] = self._on_queue_status_changed
-        if account not in self._subs_by_account:
-            self._subs_by_account[account] = []
-        # Take reference so account can be unsubscribed asynchronously without conflict
-        subs = self._subs_by_account[account]
-        async with TaskGroup() as group:
-            for keyinstance_id, script_type, script_hash in triples:
-                subs.append(script_hash)
-                # Send request even if already subscribed, as our user expects a response
-                # to trigger other actions and won't get one if we swallow it.
-                self._keyinstance_map[script_hash] = keyinstance_id, script_type
-                await group.spawn(self._subscribe_to_script_hash(script_hash))
-
-            # ensure GUI doesn't keep showing synchronizing...(100/101) when there are only 100 subs
-            account.request_count += len(set(triples) - set(subs))
-            account.progress_event.set()
+        script_hashes = []
+        for keyinstance_id, script_type, script_hash in triples:
+            # Send request even if already subscribed, as our user expects a response
+            # to trigger other actions and won't get one if we swallow it.
+            self._keyinstance_map[script_hash] = keyinstance_id, script_type
+            script_hashes.append(script_hash)
+        added_script_hashes = self._subscriptions.add(account, script_hashes)
+        assert len(added_script_hashes) == len(script_hashes), \
+            "account subscribed to the same keys twice"
+        self.logger.debug(f'{self._subscriptions.account_count(account):,d} subscriptions for '
+            f'{account}, {self._subscriptions.count():,d} in total')
+        if not script_hashes:
+            return
 
-            while await group.next_done():
-                account.response_count += 1
+        account.request_count += len(script_hashes)
+        account.progress_event.set()
+
+        config = app_state.config
+        batch_size = config.get('subscription_batch_size', SUBSCRIPTION_BATCH_SIZE)
+        batch_window = config.get('subscription_batch_window', SUBSCRIPTION_BATCH_WINDOW)
+        retry_delay = SUBSCRIPTION_RETRY_DELAY
+
+        async def _subscribe_batch(batch_hashes: List[str]) -> bool:
+            nonlocal batch_size, retry_delay
+            while batch_hashes:
+                start_time = time.monotonic()
+                results = await self._subscribe_to_script_hashes(batch_hashes)
+                elapsed_time = time.monotonic() - start_time
+
+                refused_hashes = []
+                for script_hash, result in zip(batch_hashes, results):
+                    if isinstance(result, RPCError) and result.code in RATE_LIMIT_ERROR_CODES:
+                        refused_hashes.append(script_hash)
+                    elif isinstance(result, Exception):
+                        raise result
+                    else:
+                        await self._on_queue_status_changed(script_hash, result)
+                account.response_count += len(batch_hashes) - len(refused_hashes)
                 account.progress_event.set()
 
-        assert len(set(subs)) == len(subs), "account subscribed to the same keys twice"
+                if refused_hashes:
+                    batch_size = max(SUBSCRIPTION_BATCH_SIZE_MIN, batch_size // 2)
+                    self.logger.info(f'server refused {len(refused_hashes):,d} subscriptions, '
+                        f'retrying in {retry_delay:.0f} seconds')
+                    await sleep(retry_delay)
+                    retry_delay = min(SUBSCRIPTION_RETRY_DELAY_MAX, retry_delay * 2)
+                elif elapsed_time < SUBSCRIPTION_LATENCY_LOW:
+                    batch_size = min(SUBSCRIPTION_BATCH_SIZE_MAX, batch_size * 2)
+                    retry_delay = SUBSCRIPTION_RETRY_DELAY
+                elif elapsed_time > SUBSCRIPTION_LATENCY_HIGH:
+                    batch_size = max(SUBSCRIPTION_BATCH_SIZE_MIN, batch_size // 2)
+                batch_hashes = refused_hashes
+            # Timeouts are raised rather than returned, as they were for single subscriptions.
+            return False
+
+        def _batches() -> Iterable[Coroutine[Any, Any, bool]]:
+            # The batch size is read as each batch is started, so that it follows the latency
+            # of the batches that have completed.
+            index = 0
+            while index < len(script_hashes):
+                batch_hashes = script_hashes[index:index + batch_size]
+                index += len(batch_hashes)
+                yield _subscribe_batch(batch_hashes)
+
+        await self._network._run_batches(_batches(), batch_window)
+        self.logger.debug(f'subscribed to {len(script_hashes):,d} script hashes, '
+            f'final batch size {batch_size:,d}')
 
     async def unsubscribe_from_pairs(self, account, pairs) -> None:
-        '''pairs is an iterable of (keyinstance_id, script_hash) pairs.
+        '''pairs is an iterable of (keyinstance_id, script_type, script_hash) triples.
 
         Raises: RPCError, TaskTimeout'''
-        subs = self._subs_by_account[account]
-        exclusive_subs = self._get_exclusive_set(account, subs)
+        # Only unsubscribe from the script hashes no other account needs, as the server
+        # subscription is shared between accounts.
+        released_script_hashes = self._subscriptions.remove(account,
+            (script_hash for _keyinstance_id, _script_type, script_hash in pairs))
         async with TaskGroup() as group:
-            for keyinstance_id, script_type, script_hash in pairs:
-                if script_hash not in exclusive_subs:
-                    continue
-                # Blocking on each removal allows for race conditions.
-                if script_hash not in subs:
-                    continue
-                subs.remove(script_hash)
+            for script_hash in released_script_hashes:
                 del self._keyinstance_map[script_hash]
                 await group.spawn(self._unsubscribe_from_script_hash(script_hash))
 
     @classmethod
-    def _get_exclusive_set(cls, account, subs: List[str]) -> set:
-        # This returns the script hashes the given account is subscribed to, that no other
-        # account is also subscribed to. This ensures that when we unsubscribe script hashes for
-        # the given account, as the server subscription is shared between wallets, we only
-        # unsubscribe if the script hash will no longer be needed for any account.
-        subs_set = set(subs)
-        for other_account, other_subs in cls._subs_by_account.items():
-            if other_account == account:
-                continue
-            subs_set -= set(other_subs)
-        return subs_set
+    def reset_account(cls, account) -> None:
+        '''Forgets the account's subscriptions, leaving it registered so that they can be made
+        again on a new session.'''
+        for script_hash in cls._subscriptions.clear_account(account):
+            cls._keyinstance_map.pop(script_hash, None)
 
     @classmethod
     async def unsubscribe_account(cls, account, session):
-        subs = cls._subs_by_account.pop(account, None)
-        if subs is None:
+        if not cls._subscriptions.has_account(account):
             return
+        released_script_hashes = cls._subscriptions.remove_account(account)
+        for script_hash in released_script_hashes:
+            cls._keyinstance_map.pop(script_hash, None)
         if not session:
             return
-        exclusive_subs = cls._get_exclusive_set(account, subs)
-        if not exclusive_subs:
+        if not released_script_hashes:
             return
 
         if session.ptuple < (1, 4, 2):
             logger.debug("negotiated protocol does not support unsubscribing")
             return
-        logger.debug(f"unsubscribing {len(exclusive_subs)} subscriptions for {account}")
+        logger.debug(f"unsubscribing {len(released_script_hashes)} subscriptions for {account}")
         async with TaskGroup() as group:
-            for script_hash in exclusive_subs:
+            for script_hash in released_script_hashes:
                 await group.spawn(session._unsubscribe_from_script_hash(script_hash))
-        logger.debug(f"unsubscribed {len(exclusive_subs)} subscriptions for {account}")
+        logger.debug(f"unsubscribed {len(released_script_hashes)} subscriptions for {account}")
 
 
 class Network(TriggeredCallbacks):
@@ -904,8 +1326,12 @@ class Network(TriggeredCallbacks):
         # Add an account, remove an account, or redo all account verifications
         self.account_jobs = app_state.async_.queue()
 
+        # Set when a session is added or removed, or a fetch on one completes.
+        self._fetch_event = app_state.async_.event()
+
         # Feed pub-sub notifications to currently active SVSession for processing
-        self._on_status_queue = app_state.async_.queue()
+        self._on_status_queue = StatusQueue(
+            app_state.config.get('status_fetch_window', STATUS_FETCH_WINDOW))
 
         dir_path = app_state.config.file_path('certs')
         if not os.path.exists(dir_path):
@@ -1088,34 +1514,138 @@ class Network(TriggeredCallbacks):
     async def _request_transactions(self, account, missing_hashes: List[bytes]) -> bool:
         account.request_count += len(missing_hashes)
         account.progress_event.set()
+        await self._main_session()
+        logger.debug(f'requesting {len(missing_hashes)} missing transactions')
+        # Limiting the batches in flight stops large restores flooding both the servers and the
+        # wallet database writer.
+        batch_size = app_state.config.get('tx_request_batch_size', TX_REQUEST_BATCH_SIZE)
+        batch_window = app_state.config.get('tx_request_batch_window', TX_REQUEST_BATCH_WINDOW)
+        return await self._run_batches((self._request_transaction_batch(account, tx_hashes)
+            for tx_hashes in chunks(missing_hashes, batch_size)),
+            batch_window * max(1, len(self._fetch_sessions())))
+
+    async def _run_batches(self, batches: Iterable[Coroutine[Any, Any, bool]],
+            window: int) -> bool:
+        '''Runs the batch coroutines with at most `window` of them in flight at a time. Each
+        returns whether it timed out, and the result is whether any did. The next batch is only
+        taken once there is room for it, so that it can depend on those that have completed.'''
         had_timeout = False
-        session = await self._main_session()
-        session.logger.debug(f'requesting {len(missing_hashes)} missing transactions')
+        batch_iterator = iter(batches)
         async with TaskGroup() as group:
-            tasks = {}
-            for tx_hash in missing_hashes:
-                tx_id = hash_to_hex_str(tx_hash)
-                tasks[await group.spawn(session.request_tx(tx_id))] = tx_hash
-
-            while tasks:
+            in_flight = 0
+            while True:
+                if in_flight >= window:
+                    task = await group.next_done()
+                    had_timeout |= task.result()
+                    in_flight -= 1
+                batch = next(batch_iterator, None)
+                if batch is None:
+                    break
+                await group.spawn(batch)
+                in_flight += 1
+
+            while in_flight:
                 task = await group.next_done()
-                account.response_count += 1
-                account.progress_event.set()
-                tx_hash = tasks.pop(task)
+                had_timeout |= task.result()
+                in_flight -= 1
+        return had_timeout
+
+    def _fetch_sessions(self, exclude: Iterable['SVSession']=()) -> List['SVSession']:
+        '''The sessions that read-only requests can be spread across. Those that lag the main
+        server may lack the latest transactions and blocks, and are left out.'''
+        main_session = self.main_session()
+        if main_session is None or main_session.tip is None:
+            return []
+        min_height = main_session.tip.height - 1
+        return [ session for session in self.sessions
+            if session not in exclude and session.tip is not None
+            and session.tip.height >= min_height ]
+
+    async def _acquire_fetch_session(self, exclude: Iterable['SVSession']) \
+            -> Optional['SVSession']:
+        '''Waits for the least busy session that is below its fetch limit. Returns None if there
+        are no sessions other than those excluded.'''
+        limit = app_state.config.get('session_fetch_limit', SESSION_FETCH_LIMIT)
+        while True:
+            sessions = self._fetch_sessions(exclude)
+            if not sessions:
+                if exclude:
+                    return None
+                await self._main_session()
+                continue
+            random.shuffle(sessions)
+            session = min(sessions, key=lambda session: session.fetch_count)
+            if session.fetch_count < limit:
+                session.fetch_count += 1
+                return session
+            self._fetch_event.clear()
+            await self._fetch_event.wait()
+
+    async def _fetch(self, description: str,
+            request: Callable[['SVSession'], Awaitable[Any]]) -> Tuple[Optional['SVSession'], Any]:
+        '''Makes a read-only request on the least busy session, trying it on other sessions if it
+        times out or the session disconnects. Returns the session that answered and the result,
+        or None in place of the session if none did.
+
+        Raises: RPCError'''
+        tried: Set[SVSession] = set()
+        attempts = app_state.config.get('fetch_attempts', FETCH_ATTEMPTS)
+        while len(tried) < attempts:
+            session = await self._acquire_fetch_session(tried)
+            if session is None:
+                break
+            try:
+                return session, await request(session)
+            except TaskTimeout:
+                session.logger.error(f'timed out fetching {description}')
+            except CancelledError:
+                # Requests pending on a session are cancelled when it disconnects.
+                if not session.is_closing():
+                    raise
+                session.logger.error(f'disconnected fetching {description}')
+            finally:
+                session.fetch_count -= 1
+                self._fetch_event.set()
+            tried.add(session)
+        return None, None
+
+    async def _request_transaction_batch(self, account, tx_hashes: List[bytes]) -> bool:
+        '''Returns whether the batch timed out.'''
+        tx_ids = [ hash_to_hex_str(tx_hash) for tx_hash in tx_hashes ]
+        try:
+            session, results = await self._fetch(f'{len(tx_hashes)} transactions',
+                lambda session: session.request_txs(tx_ids))
+        finally:
+            account.response_count += len(tx_hashes)
+            account.progress_event.set()
+        if session is None:
+            return True
+
+        def _parse_transactions() -> List[Tuple[bytes, bytes, Transaction]]:
+            txs = []
+            for tx_hash, result in zip(tx_hashes, results):
                 tx_id = hash_to_hex_str(tx_hash)
                 try:
-                    tx_hex = task.result()
-                    tx = Transaction.from_hex(tx_hex)
-                    session.logger.debug(f'received tx {tx_id} bytes: {len(tx_hex)//2}')
-                except CancelledError:
-                    had_timeout = True
+                    if isinstance(result, Exception):
+                        raise result
+                    tx_bytes = bytes.fromhex(result)
+                    if double_sha256(tx_bytes) != tx_hash:
+                        raise ValueError('transaction hash mismatch')
+                    txs.append((tx_hash, tx_bytes, Transaction.from_bytes(tx_bytes)))
                 except Exception as e:
                     logger.exception(e)
                     logger.error(f'fetching transaction {tx_id}: {e}')
-                else:
-                    account.add_transaction(tx_hash, tx, TxFlags.StateCleared | TxFlags.HasByteData)
-                    self.trigger_callback('new_transaction', tx, account)
-        return had_timeout
+            return txs
+
+        # Parsing large transactions is slow enough to stall other network activity.
+        txs = await run_in_thread(_parse_transactions)
+        session.logger.debug(f'received {len(txs)} transactions, '
+            f'bytes: {sum(len(t[1]) for t in txs)}')
+        if txs:
+            await account.add_transactions(txs, TxFlags.StateCleared | TxFlags.HasByteData)
+            for _tx_hash, _tx_bytes, tx in txs:
+                self.trigger_callback('new_transaction', tx, account)
+        return False
 
     def _available_servers(self, protocol):
         now = time.time()
@@ -1134,50 +1664,78 @@ class Network(TriggeredCallbacks):
                 return server
             await sleep(10)
 
-    async def _request_proofs(self, account, wanted_map):
-        had_timeout = False
-        session = await self._main_session()
-        session.logger.debug(f'requesting {len(wanted_map)} proofs')
-        async with TaskGroup() as group:
-            tasks = {}
-            for tx_hash, tx_height in wanted_map.items():
-                tx_id = hash_to_hex_str(tx_hash)
-                tasks[await group.spawn(session.request_proof(tx_id, tx_height))] = (tx_hash,
-                    tx_id)
-            headers = await session.headers_at_heights(wanted_map.values())
+    async def _request_proofs(self, account, wanted_map: Dict[bytes, int]) -> bool:
+        # The proofs can come from any server, but are verified against the headers of the
+        # main server's chain.
+        main_session = await self._main_session()
+        main_session.logger.debug(f'requesting {len(wanted_map)} proofs')
+        headers = await main_session.headers_at_heights(wanted_map.values())
+        batch_size = app_state.config.get('proof_request_batch_size', PROOF_REQUEST_BATCH_SIZE)
+        batch_window = app_state.config.get('proof_request_batch_window',
+            PROOF_REQUEST_BATCH_WINDOW)
+        return await self._run_batches((self._request_proof_batch(account, items, headers)
+            for items in chunks(list(wanted_map.items()), batch_size)),
+            batch_window * max(1, len(self._fetch_sessions())))
+
+    async def _request_proof_batch(self, account, items: List[Tuple[bytes, int]],
+            headers) -> bool:
+        '''Returns whether the batch timed out.'''
+        requests = [ (hash_to_hex_str(tx_hash), tx_height) for tx_hash, tx_height in items ]
+        session, results = await self._fetch(f'{len(items)} proofs',
+            lambda session: session.request_proofs(requests))
+        if session is None:
+            return True
 
-            while tasks:
-                task = await group.next_done()
-                tx_hash, tx_id = tasks.pop(task)
-                tx_height = wanted_map[tx_hash]
-                try:
-                    result = task.result()
-                    branch = [hex_str_to_hash(item) for item in result['merkle']]
-                    tx_pos = result['pos']
-                    proven_root = _root_from_proof(tx_hash, branch, tx_pos)
-                    header = headers[wanted_map[tx_hash]]
-                except CancelledError:
-                    had_timeout = True
-                except Exception as e:
-                    logger.error(f'getting proof for {tx_id}: {e}')
-                else:
+        def _verify_proofs() -> List[Tuple[bytes, int, int, int, int, List[bytes]]]:
+            # Verify the proofs a block at a time, so that each block header is only looked up
+            # once.
+            proofs_by_height: Dict[int, List[Tuple[bytes, Any]]] = defaultdict(list)
+            for (tx_hash, tx_height), result in zip(items, results):
+                proofs_by_height[tx_height].append((tx_hash, result))
+
+            verifications = []
+            for tx_height, proofs in proofs_by_height.items():
+                header = headers[tx_height]
+                for tx_hash, result in proofs:
+                    tx_id = hash_to_hex_str(tx_hash)
+                    try:
+                        if isinstance(result, Exception):
+                            raise result
+                        branch = [hex_str_to_hash(item) for item in result['merkle']]
+                        tx_pos = result['pos']
+                        proven_root = _root_from_proof(tx_hash, branch, tx_pos)
+                    except Exception as e:
+                        logger.error(f'getting proof for {tx_id}: {e}')
+                        continue
                     if header.merkle_root == proven_root:
-                        logger.debug(f'received valid proof for {tx_id}')
-                        account.add_verified_tx(tx_hash,
-                            tx_height, header.timestamp, tx_pos, tx_pos, branch)
+                        verifications.append((tx_hash, tx_height, header.timestamp, tx_pos,
+                            tx_pos, branch))
                     else:
                         hhts = hash_to_hex_str
                         logger.error(f'invalid proof for tx {tx_id} in block '
                                      f'{hhts(header.hash)}; got {hhts(proven_root)} expected '
                                      f'{hhts(header.merkle_root)}')
-        return had_timeout
+            return verifications
+
+        # A batch holds enough deep merkle branches to stall other network activity.
+        verifications = await run_in_thread(_verify_proofs)
+        session.logger.debug(f'received {len(verifications)} valid proofs')
+        if verifications:
+            await account.add_verified_txs(verifications)
+        return False
 
     async def _monitor_on_status(self, group):
         """worker task to process new aiorpcx 'Notifications' from queue"""
         while True:
             session = await self._main_session()
             script_hash, status = await self._on_status_queue.get()
-            await group.spawn(session._on_status_changed, script_hash, status)
+            await group.spawn(self._process_status, session, script_hash, status)
+
+    async def _process_status(self, session, script_hash: str, status: str) -> None:
+        try:
+            await session._on_status_changed(script_hash, status)
+        finally:
+            self._on_status_queue.task_done(script_hash)
 
     async def _monitor_txs(self, account):
         '''Raises: RPCError, BatchError, TaskTimeout, DisconnectSessionError'''
@@ -1199,6 +1757,8 @@ class Network(TriggeredCallbacks):
             if wanted_proof_map:
                 coros.append(self._request_proofs(account, wanted_proof_map))
             if not coros:
+                # Transactions are pruned, if enabled, when nothing is outstanding.
+                await account.get_wallet().prune_transactions()
                 await account.txs_changed_event.wait()
                 account.txs_changed_event.clear()
 
@@ -1213,8 +1773,8 @@ class Network(TriggeredCallbacks):
             session = await self._main_session()
             session.logger.info(f'subscribing to {len(additional_keys):,d} new keys for {account}')
             # Do in reverse to require fewer account re-sync loops
-            pairs = [ (k, script_type, scripthash_hex(script)) for k in additional_keys
-                for script_type, script in account.get_possible_scripts_for_id(k) ]
+            pairs = [ (k, script_type, hash_to_hex_str(script_hash)) for k, script_type, script_hash
+                in account.get_possible_script_hashes(additional_keys) ]
             pairs.reverse()
             await session.subscribe_to_triples(account, pairs)
             additional_keys = await account.new_activated_keys()
@@ -1226,8 +1786,8 @@ class Network(TriggeredCallbacks):
             session = await self._main_session()
             session.logger.info(f'unsubscribing from {len(keys):,d} '+
                 f'deactivated keys for {account}')
-            pairs = [ (k, script_type, scripthash_hex(script)) for k in keys
-                for script_type, script in account.get_possible_scripts_for_id(k) ]
+            pairs = [ (k, script_type, hash_to_hex_str(script_hash)) for k, script_type, script_hash
+                in account.get_possible_script_hashes(keys) ]
             await session.unsubscribe_from_pairs(account, pairs)
 
     async def _maintain_account(self, account):
@@ -1246,7 +1806,7 @@ class Network(TriggeredCallbacks):
                     blacklist = isinstance(error, DisconnectSessionError) and error.blacklist
                     session = self.main_session()
                     if session:
-                        SVSession._subs_by_account[account] = []
+                        SVSession.reset_account(account)
                         await session.disconnect(str(error), blacklist=blacklist)
                         await self.sessions_changed_event.wait()
         finally:
@@ -1274,6 +1834,7 @@ class Network(TriggeredCallbacks):
         self.sessions.append(session)
         self.sessions_changed_event.set()
         self.sessions_changed_event.clear()
+        self._fetch_event.set()
         self.trigger_callback('sessions')
         if session.server is self.main_server:
             self.trigger_callback('status')
@@ -1284,6 +1845,7 @@ class Network(TriggeredCallbacks):
         self.sessions.remove(session)
         self.sessions_changed_event.set()
         self.sessions_changed_event.clear()
+        self._fetch_event.set()
         if session.server is self.main_server:
             self.trigger_callback('status')
         self.trigger_callback('sessions')
@@ -1379,6 +1941,8 @@ class Network(TriggeredCallbacks):
             'spv_nodes': len(self.sessions),
             'connected': self.is_connected(),
             'auto_connect': self.auto_connect(),
+            'subscriptions': SVSession._subscriptions.status(),
+            'status_queue': self._on_status_queue.status(),
         }
 
     # FIXME: this should be removed; its callers need to be fixed
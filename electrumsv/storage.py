@@ -1169,51 +1169,54 @@ class TextStore(AbstractStore):
             # Commit all the changes to the database. This is ordered to respect FK constraints.
             # TODO(rt12) BACKLOG Shouldn't this use explicit creation calls for the first
             # migration so that subsequent migrations can be applied?
-            if len(transaction_rows):
-                with TransactionTable(db_context) as table:
-                    table.create(transaction_rows)
-            if len(masterkey_rows):
-                with MasterKeyTable(db_context) as table:
-                    table.create(masterkey_rows)
-            if len(account_rows):
-                with AccountTable(db_context) as table:
-                    table.create(account_rows)
-            if len(keyinstance_rows):
-                with KeyInstanceTable(db_context) as table:
-                    table.create(keyinstance_rows)
-            if len(txdelta_rows):
-                with TransactionDeltaTable(db_context) as table:
-                    table.create(txdelta_rows)
-            if len(txoutput_rows):
-                with TransactionOutputTable(db_context) as table:
-                    table.create(txoutput_rows)
-            if len(paymentrequest_rows):
-                with PaymentRequestTable(db_context) as table:
-                    table.create(paymentrequest_rows)
-
-            # The database creation should create these rows.
-            creation_rows = []
-            creation_rows.append(WalletDataRow("password-token",
-                pw_encode(os.urandom(32).hex(), new_password)))
-            if len(labels):
-                creation_rows.append(WalletDataRow("lost-labels", labels))
-            for key in [
-                    "contacts2", # contacts.py
-                    "wallet_nonce", "labels", # labels.py (A, B), wallet.py (B)
-                    "winpos-qt", # main_window.py
-                    "use_change", "multiple_change", # preferences.py
-                    "invoices", "stored_height", "gap_limit" ]: # wallet.py
-                value = self.get(key)
-                if value is not None:
-                    creation_rows.append(WalletDataRow(key, value))
-            walletdata_table.create(creation_rows)
-
-            walletdata_table.update([
-                WalletDataRow("next_masterkey_id", next_masterkey_id),
-                WalletDataRow("next_account_id", next_account_id),
-                WalletDataRow("next_keyinstance_id", next_keyinstance_id),
-                WalletDataRow("next_paymentrequest_id", next_paymentrequest_id),
-            ])
+            # Nothing else is using the new database yet, so the writes are only made durable
+            # once they have all been made.
+            with db_context.bulk_restore():
+                if len(transaction_rows):
+                    with TransactionTable(db_context) as table:
+                        table.create(transaction_rows)
+                if len(masterkey_rows):
+                    with MasterKeyTable(db_context) as table:
+                        table.create(masterkey_rows)
+                if len(account_rows):
+                    with AccountTable(db_context) as table:
+                        table.create(account_rows)
+                if len(keyinstance_rows):
+                    with KeyInstanceTable(db_context) as table:
+                        table.create(keyinstance_rows)
+                if len(txdelta_rows):
+                    with TransactionDeltaTable(db_context) as table:
+                        table.create(txdelta_rows)
+                if len(txoutput_rows):
+                    with TransactionOutputTable(db_context) as table:
+                        table.create(txoutput_rows)
+                if len(paymentrequest_rows):
+                    with PaymentRequestTable(db_context) as table:
+                        table.create(paymentrequest_rows)
+
+                # The database creation should create these rows.
+                creation_rows = []
+                creation_rows.append(WalletDataRow("password-token",
+                    pw_encode(os.urandom(32).hex(), new_password)))
+                if len(labels):
+                    creation_rows.append(WalletDataRow("lost-labels", labels))
+                for key in [
+                        "contacts2", # contacts.py
+                        "wallet_nonce", "labels", # labels.py (A, B), wallet.py (B)
+                        "winpos-qt", # main_window.py
+                        "use_change", "multiple_change", # preferences.py
+                        "invoices", "stored_height", "gap_limit" ]: # wallet.py
+                    value = self.get(key)
+                    if value is not None:
+                        creation_rows.append(WalletDataRow(key, value))
+                walletdata_table.create(creation_rows)
+
+                walletdata_table.update([
+                    WalletDataRow("next_masterkey_id", next_masterkey_id),
+                    WalletDataRow("next_account_id", next_account_id),
+                    WalletDataRow("next_keyinstance_id", next_keyinstance_id),
+                    WalletDataRow("next_paymentrequest_id", next_paymentrequest_id),
+                ])
             walletdata_table.close()
             walletdata_table = None
         finally:
@@ -2,6 +2,7 @@ import pytest
 
 from bitcoinx import PublicKey, PrivateKey
 
+from electrumsv import keystore as keystore_module
 from electrumsv.exceptions import InvalidPassword, IncompatibleWalletError
 from electrumsv.keystore import (
     Imported_KeyStore, Old_KeyStore, BIP32_KeyStore, from_bip39_seed,
@@ -279,6 +280,25 @@ class TestXPub:
         pubkey = keystore.derive_pubkey((for_change, n))
         assert pubkey == XPublicKey.from_hex(pubkey_hex).to_public_key()
 
+    @pytest.mark.parametrize("process_minimum", (10, 100))
+    def test_derive_pubkeys(self, monkeypatch, process_minimum) -> None:
+        xpub = ('xpub661MyMwAqRbcH1RHYeZc1zgwYLJ1dNozE8npCe81pnNYtN6e5KsF6cmt17Fv8w'
+                'GvJrRiv6Kewm8ggBG6N3XajhoioH3stUmLRi53tk46CiA')
+        keystore = BIP32_KeyStore({'xpub': xpub})
+        # The larger minimum derives in this process, the smaller in worker processes.
+        monkeypatch.setattr(keystore_module, "DERIVATION_PROCESS_MINIMUM", process_minimum)
+        monkeypatch.setattr(keystore_module, "DERIVATION_CHUNK_MINIMUM", 4)
+        monkeypatch.setattr(keystore_module, "_derivation_pool_size", 2)
+        indexes = list(range(20, 0, -1))
+        try:
+            pubkeys = keystore.derive_pubkeys((1,), indexes)
+        finally:
+            keystore_module.shutdown_derivation_pool()
+        assert keystore_module._derivation_pool is None
+        assert pubkeys == [ keystore.derive_pubkey((1, n)) for n in indexes ]
+        assert pubkeys[15] == XPublicKey.from_hex(
+            '033177256871768b5ee8e031647f3727e63d1b62c8d776d9b422a367fd8e721bd3').to_public_key()
+
     def test_xpubkey(self):
         xpub = ('xpub661MyMwAqRbcH1RHYeZc1zgwYLJ1dNozE8npCe81pnNYtN6e5KsF6cmt17Fv8w'
                 'GvJrRiv6Kewm8ggBG6N3XajhoioH3stUmLRi53tk46CiA')
@@ -0,0 +1,638 @@
+import asyncio
+import os
+import pytest
+import struct
+import threading
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Set, Tuple
+import unittest.mock
+
+from aiorpcx import JSONRPC, RPCError, TaskTimeout
+from bitcoinx import (bits_to_target, double_sha256, hash_to_hex_str, hash_to_value,
+    IncorrectBits, InsufficientPoW, MissingHeader)
+
+from electrumsv.constants import StatusPriority, TxFlags
+from electrumsv.logs import logs
+from electrumsv.network import (_verify_chunk, DisconnectSessionError, HEADER_CHUNK_SIZE,
+    HEADER_CONNECT_SLICE, HEADER_SIZE, Network, StatusQueue, SUBSCRIPTION_LATENCY_HIGH,
+    SUBSCRIPTION_RETRY_DELAY, SubscriptionRegistry, SVSession)
+from electrumsv.networks import Net
+from electrumsv.util import TriggeredCallbacks
+from electrumsv.wallet import AbstractAccount
+
+
+def test_subscription_registry_add() -> None:
+    registry = SubscriptionRegistry()
+    assert registry.add("a", [ "h1", "h2" ]) == [ "h1", "h2" ]
+    assert registry.add("a", [ "h2", "h3" ]) == [ "h3" ]
+    assert registry.add("b", [ "h3", "h4" ]) == [ "h3", "h4" ]
+    assert registry.get_accounts("h3") == { "a", "b" }
+    assert registry.get_accounts("h5") == set()
+    assert registry.count() == 4
+    assert registry.account_count("a") == 3
+    assert registry.account_count("b") == 2
+    assert registry.status() == { "total": 4, "accounts": { "a": 3, "b": 2 } }
+
+
+def test_subscription_registry_remove_shared() -> None:
+    registry = SubscriptionRegistry()
+    registry.add("a", [ "h1", "h2" ])
+    registry.add("b", [ "h2" ])
+    # Only the script hashes no other account needs are released.
+    assert registry.remove("a", [ "h1", "h2", "h3" ]) == [ "h1" ]
+    assert registry.get_accounts("h2") == { "b" }
+    assert registry.remove("b", [ "h2" ]) == [ "h2" ]
+    assert registry.count() == 0
+    assert registry.has_account("a")
+    assert registry.remove("c", [ "h1" ]) == []
+
+
+def test_subscription_registry_remove_account() -> None:
+    registry = SubscriptionRegistry()
+    registry.add("a", [ "h1", "h2" ])
+    registry.add("b", [ "h2" ])
+    assert registry.remove_account("a") == [ "h1" ]
+    assert not registry.has_account("a")
+    assert registry.remove_account("a") == []
+    assert registry.clear_account("b") == [ "h2" ]
+    assert registry.has_account("b")
+    assert registry.account_count("b") == 0
+    assert registry.count() == 0
+
+
+def _run_with_event_loop(coro_func, config: Optional[Dict[str, Any]]=None) -> None:
+    config = {} if config is None else config
+    async def _run() -> None:
+        with unittest.mock.patch('electrumsv.network.app_state') as mock_app_state:
+            mock_app_state.async_.event = asyncio.Event
+            mock_app_state.config.get.side_effect = \
+                lambda key, default=None: config.get(key, default)
+            await coro_func()
+    asyncio.run(_run())
+
+
+class FakeTip:
+    def __init__(self, height: int) -> None:
+        self.height = height
+
+
+class FakeSession:
+    """Stands in for a session in the network's requests to the servers."""
+
+    def __init__(self, name: str, height: int=100000) -> None:
+        self.name = name
+        self.logger = logs.get_logger(name)
+        self.server = object()
+        self.tip = FakeTip(height)
+        self.fetch_count = 0
+        self.closing = False
+        self.blacklisted = False
+
+        # Answers the requests made on the session, with an exception raised if it gives one.
+        self.handler: Any = None
+        self.requests: List[Any] = []
+
+    def __repr__(self) -> str:
+        return f"FakeSession({self.name})"
+
+    async def _handle(self, request: Any) -> Any:
+        self.requests.append(request)
+        result = self.handler(request)
+        if asyncio.iscoroutine(result):
+            result = await result
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    async def request_txs(self, tx_ids: List[str]) -> List[Any]:
+        return await self._handle(tx_ids)
+
+    async def request_proofs(self, requests: List[Tuple[str, int]]) -> List[Any]:
+        return await self._handle(requests)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    async def disconnect(self, reason: str, *, blacklist: bool=False) -> None:
+        self.closing = True
+        self.blacklisted = blacklist
+
+
+class FakeAccount:
+    def __init__(self) -> None:
+        self.request_count = 0
+        self.response_count = 0
+        self.progress_event = asyncio.Event()
+        self.added_tx_hashes: List[bytes] = []
+        self.verifications: List[Tuple[bytes, int, int, int, int, List[bytes]]] = []
+
+    async def add_transactions(self, txs, flags) -> None:
+        self.added_tx_hashes.extend(t[0] for t in txs)
+
+    async def add_verified_txs(self, verifications) -> None:
+        self.verifications.extend(verifications)
+
+
+def _make_network(sessions: List[FakeSession]) -> Network:
+    # The first session is connected to the main server.
+    network = Network.__new__(Network)
+    TriggeredCallbacks.__init__(network)
+    network.sessions = sessions
+    network.main_server = sessions[0].server
+    network._fetch_event = asyncio.Event()
+    return network
+
+
+def _make_transaction(value: int) -> bytes:
+    return bytes.fromhex("01000000" "01" + "00" * 32 + "ffffffff" "01" "51" "ffffffff" "01" +
+        value.to_bytes(8, "little").hex() + "01" "51" "00000000")
+
+
+class FakeHeaderSession(FakeSession):
+    _request_chunks = SVSession._request_chunks
+    _fetch_chunk_or_none = SVSession._fetch_chunk_or_none
+    _connect_chunk_slices = SVSession._connect_chunk_slices
+
+    def __init__(self, name: str, network: Any, connect_error: Optional[Exception]=None,
+            fetch_error: Optional[Exception]=None) -> None:
+        super().__init__(name)
+        self._network = network
+        self._connect_error = connect_error
+        self._fetch_error = fetch_error
+        self.connected_heights: List[int] = []
+
+    async def _fetch_chunk(self, height: int, count: int) -> bytes:
+        if self._fetch_error is not None:
+            raise self._fetch_error
+        return self.name.encode() * (count * HEADER_SIZE // len(self.name))
+
+    def _connect_chunk(self, height: int, raw_chunk: bytes, flush: bool=True) -> None:
+        # The session connecting the chunks uses the checks of the session that served them.
+        session = next(session for session in self._network.sessions
+            if raw_chunk.startswith(session.name.encode()))
+        if session._connect_error is not None:
+            raise session._connect_error
+        self.connected_heights.append(height)
+
+
+def test_status_queue_priority_order() -> None:
+    async def _test() -> None:
+        queue = StatusQueue(10)
+        queue.put_nowait("h1", "s1", StatusPriority.CHANGE)
+        queue.put_nowait("h2", "s2", StatusPriority.USED)
+        queue.put_nowait("h3", "s3", StatusPriority.PAYMENT_REQUEST)
+        queue.put_nowait("h4", "s4", StatusPriority.USED)
+        assert [ await queue.get() for i in range(4) ] == [ ("h3", "s3"), ("h2", "s2"),
+            ("h4", "s4"), ("h1", "s1") ]
+        assert queue.status()["depth"] == 0
+        assert queue.status()["in_flight"] == 4
+    _run_with_event_loop(_test)
+
+
+def test_status_queue_coalesces() -> None:
+    async def _test() -> None:
+        queue = StatusQueue(10)
+        queue.put_nowait("h1", "s1", StatusPriority.USED)
+        queue.put_nowait("h2", "s2", StatusPriority.USED)
+        queue.put_nowait("h1", "s3", StatusPriority.CHANGE)
+        # A more urgent notification moves the script hash forward.
+        queue.put_nowait("h2", "s4", StatusPriority.FRESH)
+        status = queue.status()
+        assert status["depth"] == 2 and status["coalesced"] == 2
+        assert await queue.get() == ("h2", "s4")
+        assert await queue.get() == ("h1", "s3")
+    _run_with_event_loop(_test)
+
+
+def test_status_queue_in_flight() -> None:
+    async def _test() -> None:
+        queue = StatusQueue(1)
+        queue.put_nowait("h1", "s1", StatusPriority.USED)
+        assert await queue.get() == ("h1", "s1")
+        # A script hash is not taken again while it is in flight, nor is anything beyond the
+        # window.
+        queue.put_nowait("h1", "s2", StatusPriority.USED)
+        queue.put_nowait("h2", "s3", StatusPriority.CHANGE)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(queue.get(), 0.01)
+        queue.task_done("h1")
+        assert await queue.get() == ("h1", "s2")
+        queue.task_done("h1")
+        assert await queue.get() == ("h2", "s3")
+    _run_with_event_loop(_test)
+
+
+@pytest.mark.parametrize("connect_error,blacklisted", (
+    (IncorrectBits("header", 0x1d00ffff), True),
+    (MissingHeader("prev_hash does not connect"), False)))
+def test_request_chunks_bad_session(connect_error: Exception, blacklisted: bool) -> None:
+    async def _test() -> None:
+        network = unittest.mock.Mock()
+        session = FakeHeaderSession("good", network)
+        bad_session = FakeHeaderSession("bad_", network, connect_error)
+        network.sessions = [ session, bad_session ]
+        await session._request_chunks(0, 4 * HEADER_CHUNK_SIZE - 1)
+
+        # The bad session is disconnected, and its chunk fetched from the main session.
+        assert bad_session.closing
+        assert bad_session.blacklisted == blacklisted
+        assert session.connected_heights == _connected_slice_heights(4)
+    _run_with_event_loop(_test)
+
+
+def test_request_chunks_invalid_chunk() -> None:
+    async def _test() -> None:
+        network = unittest.mock.Mock()
+        session = FakeHeaderSession("good", network)
+        bad_session = FakeHeaderSession("bad_", network,
+            fetch_error=DisconnectSessionError("invalid chunk", blacklist=True))
+        network.sessions = [ session, bad_session ]
+        await session._request_chunks(0, 4 * HEADER_CHUNK_SIZE - 1)
+
+        # The session that served a chunk that failed verification is blacklisted.
+        assert bad_session.closing and bad_session.blacklisted
+        assert session.connected_heights == _connected_slice_heights(4)
+    _run_with_event_loop(_test)
+
+
+def _connected_slice_heights(chunk_count: int) -> List[int]:
+    # Each chunk is connected a slice at a time.
+    return [ chunk_height + slice_offset
+        for chunk_height in range(0, chunk_count * HEADER_CHUNK_SIZE, HEADER_CHUNK_SIZE)
+        for slice_offset in range(0, HEADER_CHUNK_SIZE, HEADER_CONNECT_SLICE) ]
+
+
+EASY_BITS = 0x207fffff
+
+def _mine_header(prev_hash: bytes, timestamp: int) -> bytes:
+    # Half of all hashes meet the easiest target, so few nonces are tried.
+    target = bits_to_target(EASY_BITS)
+    nonce = 0
+    while True:
+        raw_header = struct.pack('<I32s32sIII', 1, prev_hash, bytes(32), timestamp, EASY_BITS,
+            nonce)
+        if hash_to_value(double_sha256(raw_header)) <= target:
+            return raw_header
+        nonce += 1
+
+
+def test_verify_chunk() -> None:
+    raw_headers = [ _mine_header(bytes(32), 1) ]
+    for i in range(9):
+        raw_headers.append(_mine_header(double_sha256(raw_headers[-1]), i + 2))
+    _verify_chunk(Net.COIN, b''.join(raw_headers))
+
+    with pytest.raises(MissingHeader):
+        _verify_chunk(Net.COIN, b''.join(raw_headers[:4] + raw_headers[5:]))
+
+    # The proof of work of a header is checked against its own bits, and the hash of this one
+    # is all but certain to miss the harder target.
+    bad_header = raw_headers[-1][:72] + struct.pack('<I', 0x1d00ffff) + raw_headers[-1][76:]
+    with pytest.raises(InsufficientPoW):
+        _verify_chunk(Net.COIN, b''.join(raw_headers[:-1] + [ bad_header ]))
+
+
+def test_request_transaction_batch_partial_failure() -> None:
+    async def _test() -> None:
+        session = FakeSession("main")
+        network = _make_network([ session ])
+        account = FakeAccount()
+        txs = [ _make_transaction(i) for i in range(4) ]
+        tx_hashes = [ double_sha256(tx_bytes) for tx_bytes in txs ]
+        # One transaction is refused, and one is not the transaction that was asked for.
+        session.handler = lambda tx_ids: [ txs[0].hex(), RPCError(1, "not found"),
+            txs[0].hex(), txs[3].hex() ]
+
+        assert not await network._request_transaction_batch(account, tx_hashes)
+        assert account.added_tx_hashes == [ tx_hashes[0], tx_hashes[3] ]
+        assert account.response_count == 4
+        assert session.fetch_count == 0
+    _run_with_event_loop(_test)
+
+
+def test_request_transaction_batch_timeout() -> None:
+    async def _test() -> None:
+        sessions = [ FakeSession("main"), FakeSession("other") ]
+        network = _make_network(sessions)
+        account = FakeAccount()
+        tx_bytes = _make_transaction(1)
+        tx_hash = double_sha256(tx_bytes)
+
+        # The batch is fetched from another session when the first times out.
+        sessions[0].handler = lambda tx_ids: TaskTimeout(1)
+        sessions[1].handler = lambda tx_ids: [ tx_bytes.hex() ]
+        assert not await network._request_transaction_batch(account, [ tx_hash ])
+        assert account.added_tx_hashes == [ tx_hash ]
+        assert len(sessions[0].requests) <= 1 and len(sessions[1].requests) == 1
+
+        # The batch times out when every session does.
+        sessions[1].handler = sessions[0].handler
+        assert await network._request_transaction_batch(account, [ tx_hash ])
+        assert account.added_tx_hashes == [ tx_hash ]
+        assert account.response_count == 2
+        assert [ session.fetch_count for session in sessions ] == [ 0, 0 ]
+    _run_with_event_loop(_test)
+
+
+class CountingHeaders(dict):
+    def __init__(self, *args) -> None:
+        super().__init__(*args)
+        self.lookups: List[int] = []
+        self.threads: Set[threading.Thread] = set()
+
+    def __getitem__(self, height: int) -> Any:
+        self.lookups.append(height)
+        self.threads.add(threading.current_thread())
+        return super().__getitem__(height)
+
+
+def test_request_proof_batch() -> None:
+    async def _test() -> None:
+        session = FakeSession("main")
+        network = _make_network([ session ])
+        account = FakeAccount()
+        tx_hash_1, tx_hash_2, tx_hash_3, tx_hash_4 = [ os.urandom(32) for i in range(4) ]
+        # The first two transactions are the only two in the block at height 10.
+        headers = CountingHeaders({
+            10: SimpleNamespace(merkle_root=double_sha256(tx_hash_1 + tx_hash_2), timestamp=100,
+                hash=os.urandom(32)),
+            20: SimpleNamespace(merkle_root=os.urandom(32), timestamp=200, hash=os.urandom(32)),
+        })
+        items = [ (tx_hash_1, 10), (tx_hash_3, 20), (tx_hash_2, 10), (tx_hash_4, 20) ]
+        session.handler = lambda requests: [
+            { "merkle": [ hash_to_hex_str(tx_hash_2) ], "pos": 0 },
+            # A proof that does not match the block's merkle root is rejected.
+            { "merkle": [ hash_to_hex_str(os.urandom(32)) ], "pos": 1 },
+            { "merkle": [ hash_to_hex_str(tx_hash_1) ], "pos": 1 },
+            RPCError(1, "no proof"),
+        ]
+
+        assert not await network._request_proof_batch(account, items, headers)
+        assert session.requests == [ [ (hash_to_hex_str(tx_hash), tx_height)
+            for tx_hash, tx_height in items ] ]
+        assert account.verifications == [
+            (tx_hash_1, 10, 100, 0, 0, [ tx_hash_2 ]),
+            (tx_hash_2, 10, 100, 1, 1, [ tx_hash_1 ]),
+        ]
+        # The proofs are verified a block at a time, away from the event loop.
+        assert headers.lookups == [ 10, 20 ]
+        assert threading.current_thread() not in headers.threads
+    _run_with_event_loop(_test)
+
+
+def test_request_proof_batch_timeout() -> None:
+    async def _test() -> None:
+        session = FakeSession("main")
+        network = _make_network([ session ])
+        account = FakeAccount()
+        session.handler = lambda requests: TaskTimeout(1)
+        assert await network._request_proof_batch(account, [ (os.urandom(32), 10) ], {})
+        assert account.verifications == []
+    _run_with_event_loop(_test)
+
+
+class FakeTransactionCache:
+    def __init__(self, flags: Dict[bytes, TxFlags]) -> None:
+        self._flags = flags
+        self.verifications: List[Any] = []
+
+    def get_flags(self, tx_hash: bytes) -> Optional[TxFlags]:
+        return self._flags.get(tx_hash)
+
+    def update_verifications(self, verifications, completion_callback) -> None:
+        self.verifications.extend(verifications)
+        completion_callback(None)
+
+
+def test_add_verified_txs_skips() -> None:
+    tx_hashes = [ os.urandom(32) for i in range(5) ]
+    cache = FakeTransactionCache({
+        tx_hashes[1]: TxFlags.StateSettled | TxFlags.HasByteData,
+        tx_hashes[2]: TxFlags.StateCleared | TxFlags.HasByteData,
+        tx_hashes[3]: TxFlags.HasByteData,
+        tx_hashes[4]: TxFlags.StateReceived,
+    })
+    verified_events = []
+    throttle_count = 0
+    async def _throttle_writes() -> None:
+        nonlocal throttle_count
+        throttle_count += 1
+    account = SimpleNamespace(_stopped=False, _id=1, _logger=logs.get_logger("account"),
+        _wallet=SimpleNamespace(_transaction_cache=cache, _prune_wanted=False,
+            _db_context=SimpleNamespace(throttle_writes=_throttle_writes),
+            get_storage_path=lambda: "wallet"),
+        _network=SimpleNamespace(trigger_callback=lambda *args: verified_events.append(args)),
+        _history=SimpleNamespace(update_transactions=lambda tx_hashes: None),
+        _update_transaction_balances=lambda tx_hashes: None,
+        get_tx_height=lambda tx_hash: (10, 1, 100))
+    account._wait_for_write = lambda completion_callback: \
+        AbstractAccount._wait_for_write(account, completion_callback)
+
+    async def _test() -> None:
+        with unittest.mock.patch(
+                'electrumsv.wallet_database.sqlite_support.app_state') as mock_app_state:
+            mock_app_state.async_.loop = asyncio.get_running_loop()
+            await AbstractAccount.add_verified_txs(account, [ (tx_hash, 10, 100, i, i, [])
+                for i, tx_hash in enumerate(tx_hashes) ])
+
+    asyncio.run(_test())
+    # Unknown and settled transactions are skipped, as are those without bytedata that are
+    # not yet cleared. Those with bytedata are settled whatever their state.
+    assert [ t[0] for t in cache.verifications ] == [ tx_hashes[2], tx_hashes[3] ]
+    assert [ event[2] for event in verified_events ] == [ tx_hashes[2], tx_hashes[3] ]
+    assert account._wallet._prune_wanted
+    # The writer is given the chance to catch up before the verifications are written.
+    assert throttle_count == 1
+
+
+class FakeSubscriptionSession(FakeSession):
+    subscribe_to_triples = SVSession.subscribe_to_triples
+
+    def __init__(self, name: str, network: Any) -> None:
+        super().__init__(name)
+        self._network = network
+        self._handlers: Dict[str, Any] = {}
+        self._keyinstance_map: Dict[str, Any] = {}
+        self._subscriptions = SubscriptionRegistry()
+        self.statuses: List[Tuple[str, str]] = []
+
+    async def _subscribe_to_script_hashes(self, script_hashes: List[str]) -> List[Any]:
+        return await self._handle(script_hashes)
+
+    async def _on_queue_status_changed(self, script_hash: str, status: str) -> None:
+        self.statuses.append((script_hash, status))
+
+
+def _run_subscriptions(handler, script_hash_count: int,
+        config: Dict[str, Any]) -> Tuple[FakeSubscriptionSession, FakeAccount, List[float]]:
+    """
+    Subscribe to the given number of script hashes one batch at a time, with the clock advanced
+    by the number of seconds the handler returns alongside its results.
+    """
+    triples = [ (i, None, f"h{i}") for i in range(script_hash_count) ]
+    clock_time = 0.0
+    delays: List[float] = []
+    results: List[Any] = []
+
+    def _monotonic() -> float:
+        return clock_time
+
+    async def _sleep(delay: float) -> None:
+        delays.append(delay)
+
+    def _handle(script_hashes: List[str]) -> Any:
+        nonlocal clock_time
+        latency, result = handler(script_hashes)
+        clock_time += latency
+        return result
+
+    async def _test() -> None:
+        session = FakeSubscriptionSession("main", None)
+        session._network = _make_network([ session ])
+        session.handler = _handle
+        account = FakeAccount()
+        results.extend((session, account))
+        with unittest.mock.patch('electrumsv.network.sleep', _sleep), \
+                unittest.mock.patch('electrumsv.network.time',
+                    SimpleNamespace(monotonic=_monotonic)):
+            await session.subscribe_to_triples(account, triples)
+
+    _run_with_event_loop(_test, dict(config, subscription_batch_window=1))
+    return results[0], results[1], delays
+
+
+def test_subscribe_to_triples_batch_sizing() -> None:
+    call_count = 0
+    def _handler(script_hashes: List[str]) -> Tuple[float, List[str]]:
+        nonlocal call_count
+        call_count += 1
+        # The first two batches are answered quickly and the rest slowly.
+        latency = 0.1 if call_count <= 2 else SUBSCRIPTION_LATENCY_HIGH + 1
+        return latency, [ f"s{script_hash}" for script_hash in script_hashes ]
+
+    session, account, delays = _run_subscriptions(_handler, 110,
+        { "subscription_batch_size": 10 })
+    assert [ len(request) for request in session.requests ] == [ 10, 20, 40, 20, 10, 10 ]
+    assert len(session.statuses) == 110
+    assert session.statuses[0] == ("h0", "sh0")
+    assert account.request_count == account.response_count == 110
+    assert delays == []
+
+
+def test_subscribe_to_triples_rate_limited() -> None:
+    call_count = 0
+    def _handler(script_hashes: List[str]) -> Tuple[float, List[Any]]:
+        nonlocal call_count
+        call_count += 1
+        # The server refuses half of the first batch, and then all of the retry, before it
+        # accepts the retry.
+        refused_count = { 1: len(script_hashes) // 2, 2: len(script_hashes) }.get(call_count, 0)
+        accepted_count = len(script_hashes) - refused_count
+        return 0.1, [ f"s{script_hash}" for script_hash in script_hashes[:accepted_count] ] + \
+            [ RPCError(JSONRPC.EXCESSIVE_RESOURCE_USAGE, "excessive") ] * refused_count
+
+    session, account, delays = _run_subscriptions(_handler, 40,
+        { "subscription_batch_size": 40 })
+    assert [ len(request) for request in session.requests ] == [ 40, 20, 20 ]
+    assert session.requests[1] == [ f"h{i}" for i in range(20, 40) ]
+    assert len(session.statuses) == 40
+    assert account.response_count == 40
+    # The delay before each retry doubles.
+    assert delays == [ SUBSCRIPTION_RETRY_DELAY, SUBSCRIPTION_RETRY_DELAY * 2 ]
+
+
+def test_subscribe_to_triples_error() -> None:
+    def _handler(script_hashes: List[str]) -> Tuple[float, List[Any]]:
+        return 0.1, [ RPCError(1, "bad script hash") for script_hash in script_hashes ]
+
+    with pytest.raises(RPCError):
+        _run_subscriptions(_handler, 5, {})
+
+
+def _fetch_name(network: Network) -> Any:
+    # Each session answers with its name, unless its handler says otherwise.
+    return network._fetch("name", lambda session: session._handle(session.name))
+
+
+def test_fetch_retries_other_session() -> None:
+    async def _test() -> None:
+        sessions = [ FakeSession("main"), FakeSession("other") ]
+        network = _make_network(sessions)
+        failed_sessions: List[FakeSession] = []
+
+        def _fail_first(session: FakeSession, error: BaseException) -> Any:
+            def _handler(name: str) -> Any:
+                if not failed_sessions:
+                    failed_sessions.append(session)
+                    return error
+                return name
+            return _handler
+
+        # A request that times out is made again on the other session.
+        for session in sessions:
+            session.handler = _fail_first(session, TaskTimeout(1))
+        session, result = await _fetch_name(network)
+        assert session is not failed_sessions[0] and result == session.name
+
+        # So is one that is cancelled because its session disconnected.
+        failed_sessions.clear()
+        for session in sessions:
+            session.handler = _fail_first(session, asyncio.CancelledError())
+            session.closing = True
+        session, result = await _fetch_name(network)
+        assert session is not failed_sessions[0] and result == session.name
+
+        # But a cancellation with the session still open is not caught.
+        failed_sessions.clear()
+        for session in sessions:
+            session.closing = False
+        with pytest.raises(asyncio.CancelledError):
+            await _fetch_name(network)
+        assert [ session.fetch_count for session in sessions ] == [ 0, 0 ]
+    _run_with_event_loop(_test)
+
+
+@pytest.mark.parametrize("session_count,config,request_count", [
+    (4, {}, 3), (4, { "fetch_attempts": 2 }, 2), (2, {}, 2) ])
+def test_fetch_attempts(session_count: int, config: Dict[str, Any], request_count: int) -> None:
+    async def _test() -> None:
+        sessions = [ FakeSession(f"s{i}") for i in range(session_count) ]
+        network = _make_network(sessions)
+        for session in sessions:
+            session.handler = lambda name: TaskTimeout(1)
+
+        # Each attempt is made on a different session, until the attempts or sessions run out.
+        assert await _fetch_name(network) == (None, None)
+        request_counts = [ len(session.requests) for session in sessions ]
+        assert sum(request_counts) == request_count and max(request_counts) == 1
+        assert all(session.fetch_count == 0 for session in sessions)
+    _run_with_event_loop(_test, config)
+
+
+def test_fetch_session_limit() -> None:
+    async def _test() -> None:
+        sessions = [ FakeSession("main"), FakeSession("other") ]
+        network = _make_network(sessions)
+        release_event = asyncio.Event()
+
+        async def _wait(name: str) -> str:
+            await release_event.wait()
+            return name
+        for session in sessions:
+            session.handler = _wait
+
+        # With one fetch allowed per session, the fetches are spread over both and the third
+        # waits for one of them to finish.
+        tasks = [ asyncio.ensure_future(_fetch_name(network)) for i in range(3) ]
+        for i in range(5):
+            await asyncio.sleep(0)
+        assert [ len(session.requests) for session in sessions ] == [ 1, 1 ]
+        assert [ session.fetch_count for session in sessions ] == [ 1, 1 ]
+        assert not any(task.done() for task in tasks)
+
+        release_event.set()
+        results = await asyncio.gather(*tasks)
+        assert all(result == session.name for session, result in results)
+        assert sum(len(session.requests) for session in sessions) == 3
+        assert [ session.fetch_count for session in sessions ] == [ 0, 0 ]
+    _run_with_event_loop(_test, { "session_fetch_limit": 1 })
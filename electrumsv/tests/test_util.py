@@ -2,7 +2,7 @@ import pytest
 import unittest
 
 from electrumsv.util import format_satoshis, get_identified_release_signers
-from electrumsv.util.cache import LRUCache
+from electrumsv.util.cache import CachePolicy, CacheStats, LRUCache, ObjectCache
 
 
 class TestUtil(unittest.TestCase):
@@ -232,3 +232,75 @@ def test_lrucache_add_past_limit_lru_ordering(max_count: int, max_size: int) ->
     added, removals = cache.set(b'6', b'6')
     assert added
     assert removals == [(b'4', b'4')]
+
+
+def test_lrucache_stats() -> None:
+    cache = LRUCache(max_size=2)
+    cache.set(b'1', b'1')
+    cache.set(b'2', b'2')
+    cache.set(b'3', b'3')
+    assert cache.get(b'3') == b'3'
+    assert cache.get(b'1') is None
+    assert cache.get_stats() == CacheStats(hits=1, misses=1, evictions=1, count=2,
+        current_size=2, maximum_size=2)
+
+def test_lrucache_segmented_scan_resistance() -> None:
+    cache = LRUCache(max_size=10, policy=CachePolicy.SEGMENTED_LRU)
+    cache.set(b'a', b'a')
+    cache.set(b'b', b'b')
+    # Entries that are used again are protected.
+    assert cache.get(b'a') == b'a'
+    assert cache.get(b'b') == b'b'
+    # A scan of entries that are used once only displaces other entries on probation.
+    for i in range(20):
+        cache.set(bytes([ i ]), b'x')
+    assert b'a' in cache
+    assert b'b' in cache
+    assert cache.current_size == 10
+    assert cache.get_stats().evictions == 12
+
+def test_lrucache_segmented_protect() -> None:
+    cache = LRUCache(max_size=5, policy=CachePolicy.SEGMENTED_LRU)
+    cache.set(b'a', b'a', protect=True)
+    added, removals = cache.set(b'b', b'b'*4)
+    assert added and removals == []
+    # The new entry is not evicted in favour of the protected one.
+    added, removals = cache.set(b'c', b'c'*5)
+    assert added
+    assert removals == [ (b'b', b'b'*4), (b'a', b'a') ]
+
+def test_lrucache_segmented_demotion() -> None:
+    cache = LRUCache(max_size=5, policy=CachePolicy.SEGMENTED_LRU)
+    for key in (b'1', b'2', b'3', b'4', b'5'):
+        cache.set(key, key)
+        cache.get(key)
+    # Only four fit in the protected segment, so the least recently used is back on probation
+    # and is the first evicted.
+    added, removals = cache.set(b'6', b'6')
+    assert removals == [ (b'1', b'1') ]
+    assert cache.get(b'2') == b'2'
+
+
+def test_objectcache_size_eviction() -> None:
+    cache = ObjectCache(10)
+    assert cache.set(b'1', [ 1 ], 4)
+    assert cache.set(b'2', [ 2 ], 4)
+    assert cache.get(b'1') == [ 1 ]
+    assert cache.set(b'3', [ 3 ], 4)
+    # The least recently used object makes room for the new one.
+    assert b'2' not in cache
+    assert cache.get(b'2') is None
+    assert cache.get_sizes() == (8, 10)
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+    assert not cache.set(b'4', [ 4 ], 11)
+    assert len(cache) == 2
+
+def test_objectcache_discard() -> None:
+    cache = ObjectCache(10)
+    cache.set(b'1', [ 1 ], 4)
+    cache.set(b'1', [ 2 ], 6)
+    assert cache.current_size == 6
+    cache.discard(b'1')
+    cache.discard(b'2')
+    assert cache.current_size == 0
+    assert len(cache) == 0
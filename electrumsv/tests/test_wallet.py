@@ -2,21 +2,27 @@ import os
 import shutil
 import sys
 import tempfile
-from typing import Dict, Optional, List, Set
+from types import SimpleNamespace
+from typing import Dict, Optional, List, Set, Tuple
 import unittest
 
 import pytest
+from bitcoinx import Script
 
-from electrumsv.constants import (DATABASE_EXT, DerivationType, KeystoreTextType, ScriptType,
-    StorageKind, CHANGE_SUBPATH, RECEIVING_SUBPATH)
+from electrumsv.app_state import app_state
+from electrumsv.bitcoin import COINBASE_MATURITY, history_status, scripthash_bytes
+from electrumsv.constants import (DATABASE_EXT, DerivationType, KeystoreTextType, PaymentState,
+    ScriptType, StatusPriority, StorageKind, TransactionOutputFlag, TxFlags, CHANGE_SUBPATH,
+    RECEIVING_SUBPATH)
 from electrumsv.crypto import pw_decode
 from electrumsv.exceptions import InvalidPassword, IncompatibleWalletError
 from electrumsv.keystore import (from_seed, from_xpub, Old_KeyStore, Multisig_KeyStore)
 from electrumsv.networks import Net, SVMainnet, SVTestnet
 from electrumsv.storage import get_categorised_files, WalletStorage, WalletStorageInfo
-from electrumsv.wallet import (ImportedPrivkeyAccount, ImportedAddressAccount,
+from electrumsv.transaction import Transaction, XTxInput, XTxOutput
+from electrumsv.wallet import (AccountHistory, ImportedPrivkeyAccount, ImportedAddressAccount,
     MultisigAccount, Wallet, StandardAccount)
-from electrumsv.wallet_database import DatabaseContext
+from electrumsv.wallet_database import DatabaseContext, SynchronousWriter, TxData
 from electrumsv.wallet_database.tables import AccountRow, KeyInstanceRow
 
 from .util import setup_async, tear_down_async, TEST_WALLET_PATH
@@ -489,3 +495,302 @@ def test_legacy_wallet_loading(storage_info: WalletStorageInfo) -> None:
 #         public_key = privkey.public_key
 #         address = public_key.to_address(coin=coin).to_string()
 #         assert account.pubkeys_to_a_ddress(public_key) == address_from_string(address)
+
+
+def _create_standard_account(storage) -> Tuple[Wallet, StandardAccount]:
+    seed_words = 'cycle rocket west magnet parrot shuffle foot correct salt library feed song'
+    wallet = Wallet(storage)
+    masterkey_row = wallet.create_masterkey_from_keystore(from_seed(seed_words, ''))
+    account_row = AccountRow(1, masterkey_row.masterkey_id, ScriptType.P2PKH, '...')
+    account = StandardAccount(wallet, account_row, [], [])
+    wallet.register_account(account.get_id(), account)
+    return wallet, account
+
+
+def test_process_key_usage_spend_before_funding(tmp_storage) -> None:
+    wallet, account = _create_standard_account(tmp_storage)
+
+    keyinstance = account.create_keys(1, RECEIVING_SUBPATH)[0]
+    script = account.get_script_template_for_id(keyinstance.keyinstance_id).to_script()
+    funding_tx = Transaction.from_io([ XTxInput(os.urandom(32), 0, Script(), 0xffffffff) ],
+        [ XTxOutput(1000, Script(os.urandom(25))), XTxOutput(5000, script) ])
+    funding_tx_hash = funding_tx.hash()
+    spending_tx = Transaction.from_io([ XTxInput(funding_tx_hash, 1, Script(), 0xffffffff) ],
+        [ XTxOutput(4800, Script(os.urandom(25))) ])
+    spending_tx_hash = spending_tx.hash()
+
+    account._sync_state.set_key_history(keyinstance.keyinstance_id,
+        [ (funding_tx.txid(), 1), (spending_tx.txid(), 1) ])
+    for tx in (funding_tx, spending_tx):
+        wallet._transaction_cache.add_transaction(tx, TxFlags.StateCleared)
+
+    # The spend is processed first, and is matched when the spent output is processed.
+    account.process_key_usage(spending_tx_hash, spending_tx, None)
+    assert account.get_stxo(funding_tx_hash, 1) is None
+    account.process_key_usage(funding_tx_hash, funding_tx, None)
+    assert account.get_stxo(funding_tx_hash, 1) == keyinstance.keyinstance_id
+    assert account.get_utxo(funding_tx_hash, 1) is None
+    # The output with an unrelated script is not ours.
+    assert account.get_stxo(funding_tx_hash, 0) is None
+    assert account.get_utxo(funding_tx_hash, 0) is None
+    assert (funding_tx_hash, 1) not in account._unmatched_spends
+
+
+def test_process_key_usage_matching(tmp_storage) -> None:
+    wallet, account = _create_standard_account(tmp_storage)
+
+    key_ids = [ keyinstance.keyinstance_id
+        for keyinstance in account.create_keys(2, RECEIVING_SUBPATH) ]
+    scripts = [ account._get_cached_script(key_id)[0] for key_id in key_ids ]
+    # The first key also has a script of another type cached, as it would have had before its
+    # script type was changed.
+    p2pk_script = account._get_cached_script(key_ids[0], ScriptType.P2PK)[0]
+    funding_tx = Transaction.from_io([ XTxInput(os.urandom(32), 0, Script(), 0xffffffff) ],
+        [ XTxOutput(1000, p2pk_script), XTxOutput(2000, scripts[1]),
+        XTxOutput(3000, scripts[0]) ])
+    funding_tx_hash = funding_tx.hash()
+    # The spending transaction also spends an output of a transaction that is not ours.
+    foreign_txo_key = (os.urandom(32), 0)
+    spending_tx = Transaction.from_io([ XTxInput(*foreign_txo_key, Script(), 0xffffffff),
+        XTxInput(funding_tx_hash, 0, Script(), 0xffffffff),
+        XTxInput(funding_tx_hash, 2, Script(), 0xffffffff) ],
+        [ XTxOutput(5800, Script(os.urandom(25))) ])
+    spending_tx_hash = spending_tx.hash()
+
+    # Only the first key has the transactions in its history.
+    account._sync_state.set_key_history(key_ids[0],
+        [ (funding_tx.txid(), 1), (spending_tx.txid(), 1) ])
+    for tx in (funding_tx, spending_tx):
+        wallet._transaction_cache.add_transaction(tx, TxFlags.StateCleared)
+
+    # Only the spends of outputs of transactions in our history are kept to be matched.
+    account.process_key_usage(spending_tx_hash, spending_tx, None)
+    assert set(account._unmatched_spends) == { (funding_tx_hash, 0), (funding_tx_hash, 2) }
+
+    # Neither the script of another type of the first key, nor the script of the second key
+    # which does not have the transaction in its history, are matched.
+    account.process_key_usage(funding_tx_hash, funding_tx, None)
+    assert account.get_stxo(funding_tx_hash, 2) == key_ids[0]
+    for output_index in (0, 1):
+        assert account.get_stxo(funding_tx_hash, output_index) is None
+        assert account.get_utxo(funding_tx_hash, output_index) is None
+    # The spends of the outputs that were not ours are dropped as they never will be matched.
+    assert account._unmatched_spends == {}
+
+
+def test_prunable_transactions(tmp_storage) -> None:
+    wallet, account = _create_standard_account(tmp_storage)
+
+    keyinstances = account.create_keys(2, RECEIVING_SUBPATH)
+    scripts = [ account.get_script_template_for_id(keyinstance.keyinstance_id).to_script()
+        for keyinstance in keyinstances ]
+    # Our output of the funding transaction is spent by a payment, and both also pay others.
+    # The last transaction has an output of ours that is unspent.
+    funding_tx = Transaction.from_io([ XTxInput(os.urandom(32), 0, Script(), 0xffffffff) ],
+        [ XTxOutput(1000, Script(os.urandom(25))), XTxOutput(5000, scripts[0]) ])
+    spending_tx = Transaction.from_io([ XTxInput(funding_tx.hash(), 1, Script(), 0xffffffff) ],
+        [ XTxOutput(4800, Script(os.urandom(25))) ])
+    unspent_tx = Transaction.from_io([ XTxInput(os.urandom(32), 0, Script(), 0xffffffff) ],
+        [ XTxOutput(2000, scripts[1]) ])
+    txs = [ funding_tx, spending_tx, unspent_tx ]
+
+    account._sync_state.set_key_history(keyinstances[0].keyinstance_id,
+        [ (funding_tx.txid(), 1), (spending_tx.txid(), 2) ])
+    account._sync_state.set_key_history(keyinstances[1].keyinstance_id,
+        [ (unspent_tx.txid(), 3) ])
+    for tx in txs:
+        wallet._transaction_cache.add_transaction(tx, TxFlags.StateCleared)
+        account.process_key_usage(tx.hash(), tx, None)
+    with SynchronousWriter() as writer:
+        wallet._transaction_cache.update([ (tx.hash(), TxData(height=i+1, position=1), None,
+            TxFlags.HasHeight | TxFlags.HasPosition | TxFlags.StateSettled)
+            for i, tx in enumerate(txs) ], completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    # Outputs that are not ours do not keep a transaction from being pruned, as the wallet only
+    # spends its own unspent outputs.
+    prunable_tx_hashes = wallet._get_prunable_tx_hashes()
+    assert set(prunable_tx_hashes) == { funding_tx.hash(), spending_tx.hash() }
+    with SynchronousWriter() as writer:
+        wallet._transaction_cache.prune(prunable_tx_hashes,
+            completion_callback=writer.get_callback())
+        assert writer.succeeded()
+    assert wallet._get_prunable_tx_hashes() == []
+
+    account._network = SimpleNamespace(request_and_wait=lambda method, args: str(funding_tx))
+    assert account.fetch_pruned_transaction(funding_tx.hash()).hash() == funding_tx.hash()
+    assert account.fetch_pruned_transaction(unspent_tx.hash()) is None
+    # The fetch waits on the event loop, so it must not be made from it.
+    async def _fetch_on_event_loop() -> None:
+        account.fetch_pruned_transaction(funding_tx.hash())
+    with pytest.raises(AssertionError):
+        app_state.async_.spawn_and_wait(_fetch_on_event_loop)
+
+
+def test_incremental_balance(tmp_storage) -> None:
+    wallet, account = _create_standard_account(tmp_storage)
+    tmp_storage.put('stored_height', 150)
+
+    keyinstance = account.create_keys(1, RECEIVING_SUBPATH)[0]
+    script = account.get_script_template_for_id(keyinstance.keyinstance_id).to_script()
+    coinbase_tx_hash, confirmed_tx_hash, unconfirmed_tx_hash = [ os.urandom(32)
+        for i in range(3) ]
+    wallet._transaction_cache.add([
+        (coinbase_tx_hash, TxData(height=100, position=0), None, TxFlags.Unset, None),
+        (confirmed_tx_hash, TxData(height=120, position=1), None, TxFlags.Unset, None),
+        (unconfirmed_tx_hash, TxData(height=0), None, TxFlags.Unset, None) ])
+    account.register_utxo(coinbase_tx_hash, 0, 50, TransactionOutputFlag.IS_COINBASE,
+        keyinstance, script)
+    account.register_utxo(confirmed_tx_hash, 0, 10, TransactionOutputFlag.NONE, keyinstance,
+        script)
+    account.register_utxo(confirmed_tx_hash, 1, 5, TransactionOutputFlag.IS_FROZEN,
+        keyinstance, script)
+    account.register_utxo(unconfirmed_tx_hash, 0, 3, TransactionOutputFlag.NONE, keyinstance,
+        script)
+    assert account.get_balance() == (15, 3, 50)
+    assert account.get_frozen_balance() == (5, 0, 0)
+    assert account.get_balance(exclude_frozen_coins=True) == (10, 3, 50)
+
+    # The coinbase output matures as the local height advances.
+    tmp_storage.put('stored_height', 100 + COINBASE_MATURITY)
+    assert account.get_balance() == (65, 3, 0)
+
+    account.set_frozen_coin_state([ account.get_utxo(confirmed_tx_hash, 1) ], False)
+    assert account.get_frozen_balance() == (0, 0, 0)
+    account.set_utxo_spent(confirmed_tx_hash, 0)
+    assert account.get_balance() == (55, 3, 0)
+
+    # Confirmation of a transaction moves its outputs to the confirmed balance.
+    wallet._transaction_cache.update([ (unconfirmed_tx_hash, TxData(height=130), None,
+        TxFlags.HasHeight) ])
+    account._update_transaction_balances([ unconfirmed_tx_hash ])
+    assert account.get_balance() == (58, 0, 0)
+    # The totals always match a full recalculation.
+    assert account.get_balance() == account.get_balance(set(account._utxos))
+
+
+def test_account_history_paging() -> None:
+    tx_hashes = [ bytes([i]) * 32 for i in range(5) ]
+    metadatas = {
+        tx_hashes[0]: TxData(height=100, position=1),
+        tx_hashes[1]: TxData(height=100, position=0),
+        tx_hashes[2]: TxData(height=101, position=3),
+        tx_hashes[3]: TxData(height=0),
+        tx_hashes[4]: TxData(),
+    }
+    history = AccountHistory(metadatas.get)
+    history.load([ (tx_hashes[0], 10, 1), (tx_hashes[1], 20, 1), (tx_hashes[1], 5, 2),
+        (tx_hashes[2], -7, 1), (tx_hashes[4], 1, 1) ])
+
+    # Transactions without a height are not listed.
+    page, cursor = history.get_page(limit=2)
+    assert [ (line.tx_hash, balance) for line, balance in page ] == [
+        (tx_hashes[2], 28), (tx_hashes[0], 35) ]
+    page, cursor = history.get_page(cursor, limit=2)
+    assert [ (line.tx_hash, balance) for line, balance in page ] == [ (tx_hashes[1], 25) ]
+    assert cursor is None
+
+    # New deltas for unconfirmed transactions go last.
+    history.add_value_deltas([ (tx_hashes[3], 3) ])
+    page, cursor = history.get_page(limit=1)
+    assert [ (line.tx_hash, balance) for line, balance in page ] == [ (tx_hashes[3], 31) ]
+
+    # A transaction that is mined is moved into place, and the balances after it updated.
+    metadatas[tx_hashes[3]] = TxData(height=100, position=2)
+    history.update_transactions([ tx_hashes[3] ])
+    page, cursor = history.get_page(limit=10)
+    assert [ (line.tx_hash, balance) for line, balance in page ] == [
+        (tx_hashes[2], 31), (tx_hashes[3], 38), (tx_hashes[0], 35), (tx_hashes[1], 25) ]
+
+    history.remove_transaction(tx_hashes[1])
+    page, cursor = history.get_page(limit=10)
+    assert [ (line.tx_hash, balance) for line, balance in page ] == [
+        (tx_hashes[2], 6), (tx_hashes[3], 13), (tx_hashes[0], 10) ]
+
+
+def test_stored_scripts_reused(tmp_storage) -> None:
+    seed_words = 'cycle rocket west magnet parrot shuffle foot correct salt library feed song'
+    wallet = Wallet(tmp_storage)
+    masterkey_row = wallet.create_masterkey_from_keystore(from_seed(seed_words, ''))
+    # The account needs to be written to the database for the key scripts to be.
+    account_row = wallet.add_accounts([ AccountRow(-1, masterkey_row.masterkey_id,
+        ScriptType.P2PKH, '...') ])[0]
+    account = StandardAccount(wallet, account_row, [], [])
+
+    keyinstance = account.create_keys(1, RECEIVING_SUBPATH)[0]
+    keyinstance_id = keyinstance.keyinstance_id
+    script = account.get_script_for_id(keyinstance_id)
+    script_hashes = account.get_possible_script_hashes([ keyinstance_id ])
+    assert script_hashes == [ (keyinstance_id, ScriptType.P2PKH, scripthash_bytes(script)) ]
+
+    # Wait for the derived scripts to be written.
+    with SynchronousWriter() as writer:
+        wallet._db_context.queue_write(lambda db: None, writer.get_callback())
+        assert writer.succeeded()
+
+    # A reopened account uses the stored scripts without deriving them.
+    account = StandardAccount(wallet, account._row, [ keyinstance ], [])
+    def _get_public_key_for_id(keyinstance_id: int) -> None:
+        raise AssertionError("script derived")
+    account._get_public_key_for_id = _get_public_key_for_id
+    assert account.get_possible_script_hashes([ keyinstance_id ]) == script_hashes
+    cached_script, _script_bytes, address = account._get_cached_script(keyinstance_id)
+    assert cached_script == script
+    assert address is not None and address.to_script() == script
+
+
+def test_key_status_persisted(tmp_storage) -> None:
+    seed_words = 'cycle rocket west magnet parrot shuffle foot correct salt library feed song'
+    wallet = Wallet(tmp_storage)
+    masterkey_row = wallet.create_masterkey_from_keystore(from_seed(seed_words, ''))
+    account_row = wallet.add_accounts([ AccountRow(-1, masterkey_row.masterkey_id,
+        ScriptType.P2PKH, '...') ])[0]
+    account = StandardAccount(wallet, account_row, [], [])
+
+    keyinstance = account.create_keys(1, RECEIVING_SUBPATH)[0]
+    keyinstance_id = keyinstance.keyinstance_id
+    account.get_possible_script_hashes([ keyinstance_id ])
+    assert account.get_key_status(keyinstance_id, ScriptType.P2PKH) is None
+
+    # The status follows changes to the key history.
+    history = [ ("ab" * 32, 100) ]
+    account._sync_state.set_key_history(keyinstance_id, history)
+    status = history_status(history)
+    assert account.get_key_status(keyinstance_id, ScriptType.P2PKH) == status
+
+    # Receiving a history from the server sets the script type of a fresh key.
+    keyinstance = keyinstance._replace(script_type=ScriptType.P2PKH)
+    with SynchronousWriter() as writer:
+        wallet.update_keyinstance_script_types([ (ScriptType.P2PKH, keyinstance_id) ])
+        wallet.update_keyinstance_script_statuses([
+            (bytes.fromhex(status), keyinstance_id, ScriptType.P2PKH) ])
+        wallet._db_context.queue_write(lambda db: None, writer.get_callback())
+        assert writer.succeeded()
+
+    # A reopened account has the stored status, whatever history it rebuilds.
+    account = StandardAccount(wallet, account._row, [ keyinstance ], [])
+    assert account.get_key_history(keyinstance_id, ScriptType.P2PKH) == []
+    assert account.get_key_status(keyinstance_id, ScriptType.P2PKH) == status
+    assert account.get_key_status(keyinstance_id, ScriptType.P2PK) is None
+
+
+def test_key_status_priority(tmp_storage) -> None:
+    seed_words = 'cycle rocket west magnet parrot shuffle foot correct salt library feed song'
+    wallet = Wallet(tmp_storage)
+    masterkey_row = wallet.create_masterkey_from_keystore(from_seed(seed_words, ''))
+    account_row = wallet.add_accounts([ AccountRow(-1, masterkey_row.masterkey_id,
+        ScriptType.P2PKH, '...') ])[0]
+    account = StandardAccount(wallet, account_row, [], [])
+
+    receiving_ids = [ key.keyinstance_id
+        for key in account.get_fresh_keys(RECEIVING_SUBPATH, 3) ]
+    used_id = account.create_keys(1, RECEIVING_SUBPATH)[0].keyinstance_id
+    change_id = account.get_fresh_keys(CHANGE_SUBPATH, 1)[0].keyinstance_id
+    account.create_payment_request(receiving_ids[0], PaymentState.UNPAID, 1000, None, "")
+    account.create_payment_request(receiving_ids[1], PaymentState.PAID, 1000, None, "")
+
+    assert account.get_key_status_priority(receiving_ids[0]) == StatusPriority.PAYMENT_REQUEST
+    assert account.get_key_status_priority(receiving_ids[1]) == StatusPriority.FRESH
+    assert account.get_key_status_priority(receiving_ids[2]) == StatusPriority.FRESH
+    assert account.get_key_status_priority(used_id) == StatusPriority.USED
+    assert account.get_key_status_priority(change_id) == StatusPriority.CHANGE
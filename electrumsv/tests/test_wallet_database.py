@@ -1,6 +1,11 @@
+import asyncio
 import os
 import pytest
-from typing import Tuple, Optional
+import sqlite3
+import threading
+import time
+import tracemalloc
+from typing import List, Optional, Tuple
 
 import bitcoinx
 
@@ -8,11 +13,13 @@ from electrumsv.constants import TxFlags, TRANSACTION_FLAGS
 from electrumsv.transaction import Transaction
 from electrumsv.logs import logs
 from electrumsv import wallet_database
-from electrumsv.wallet_database import (DatabaseContext, SynchronousWriter, TxData, TxProof,
-    TransactionCache, TransactionCacheEntry)
-from electrumsv.wallet_database.migration import create_database, update_database
-from electrumsv.wallet_database.sqlite_support import WriteEntryType
-from electrumsv.wallet_database.tables import WalletDataRow
+from electrumsv.wallet_database import (AsyncCompletionCallback, DatabaseContext,
+    SynchronousWriter, TxData, TxProof, TransactionCache, TransactionCacheEntry)
+from electrumsv.wallet_database.cache import INDEXED_FLAGS, TransactionCacheEntries
+from electrumsv.wallet_database.migration import (create_database, create_database_file,
+    update_database)
+from electrumsv.wallet_database.sqlite_support import BulkRestoreError, WriteEntryType
+from electrumsv.wallet_database.tables import TransactionRow, WalletDataRow
 
 logs.set_level("debug")
 
@@ -56,7 +63,7 @@ class TestWalletDataTable:
     def setup_method(self):
         self.store._get_current_timestamp = self._get_timestamp
         self._timestamp = 1
-        db = self.store._db
+        db = self.db
         db.execute(f"DELETE FROM WalletData")
         db.commit()
 
@@ -169,6 +176,373 @@ class TestWalletDataTable:
         assert row is None
 
 
+class TestDatabaseContextAsync:
+    @classmethod
+    def setup_class(cls):
+        unique_name = os.urandom(8).hex()
+        cls.db_filename = DatabaseContext.shared_memory_uri(unique_name)
+        cls.db_context = DatabaseContext(cls.db_filename)
+        # We hold onto an open connection to ensure that the database persists for the
+        # lifetime of the tests.
+        cls.db = cls.db_context.acquire_connection()
+        create_database(cls.db)
+        update_database(cls.db)
+        cls.store = wallet_database.WalletDataTable(cls.db_context)
+        cls.loop = asyncio.new_event_loop()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.loop.close()
+        cls.store.close()
+        cls.db_context.release_connection(cls.db)
+        cls.db_context.close()
+
+    @pytest.mark.timeout(5)
+    def test_write(self) -> None:
+        def _write(db: sqlite3.Connection) -> None:
+            db.execute("INSERT INTO WalletData (key, value, date_created, date_updated) "
+                "VALUES ('async', '1', 1, 1)")
+
+        self.loop.run_until_complete(self.db_context.write(_write))
+        assert self.store.get_value("async") == 1
+
+    @pytest.mark.timeout(5)
+    def test_queue_write_async_failure(self) -> None:
+        def _write(db: sqlite3.Connection) -> None:
+            db.execute("INSERT INTO NonexistentTable (key) VALUES (1)")
+
+        async def _test() -> None:
+            future = self.db_context.queue_write_async(_write, loop=self.loop)
+            with pytest.raises(sqlite3.OperationalError):
+                await future
+
+        self.loop.run_until_complete(_test())
+
+    @pytest.mark.timeout(5)
+    def test_completion_after_loop_closed(self) -> None:
+        loop = asyncio.new_event_loop()
+        completion_callback = AsyncCompletionCallback(loop)
+        loop.close()
+        self.db_context.queue_write(lambda db: None, completion_callback)
+        # The writer thread survives the completion for the closed loop and keeps writing.
+        with SynchronousWriter() as writer:
+            self.db_context.queue_write(lambda db: None, writer.get_callback())
+            assert writer.succeeded()
+        assert not completion_callback.future.done()
+
+    @pytest.mark.timeout(5)
+    def test_throttle_writes(self) -> None:
+        # Force the throttling to wait regardless of how many writes are queued.
+        self.db_context.MAXIMUM_WRITE_BACKLOG = -1
+        try:
+            written = []
+            for i in range(10):
+                self.db_context.queue_write(lambda db, i=i: written.append(i))
+            self.loop.run_until_complete(self.db_context.throttle_writes())
+            assert written == list(range(10))
+        finally:
+            del self.db_context.MAXIMUM_WRITE_BACKLOG
+
+
+class TestReadConnectionPool:
+    @classmethod
+    def setup_class(cls):
+        unique_name = os.urandom(8).hex()
+        cls.db_filename = DatabaseContext.shared_memory_uri(unique_name)
+        cls.db_context = DatabaseContext(cls.db_filename)
+        # We hold onto an open connection to ensure that the database persists for the
+        # lifetime of the tests.
+        cls.db = cls.db_context.acquire_connection()
+        create_database(cls.db)
+        update_database(cls.db)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.db_context.release_connection(cls.db)
+        cls.db_context.close()
+
+    def test_same_thread_reuse(self) -> None:
+        stats1 = self.db_context.get_read_pool_statistics()
+        db1 = self.db_context.acquire_read_connection()
+        self.db_context.release_read_connection(db1)
+        db2 = self.db_context.acquire_read_connection()
+        assert db1 is db2
+        stats2 = self.db_context.get_read_pool_statistics()
+        assert stats2.hits == stats1.hits + 1
+        assert stats2.active_count == stats1.active_count + 1
+        self.db_context.release_read_connection(db2)
+        assert self.db_context.get_read_pool_statistics().active_count == stats1.active_count
+
+    def test_other_thread_not_shared(self) -> None:
+        db1 = self.db_context.acquire_read_connection()
+        self.db_context.release_read_connection(db1)
+
+        connections = []
+        def _acquire() -> None:
+            db = self.db_context.acquire_read_connection()
+            connections.append(db)
+            self.db_context.release_read_connection(db)
+        thread = threading.Thread(target=_acquire)
+        thread.start()
+        thread.join()
+
+        assert len(connections) == 1
+        assert connections[0] is not db1
+
+    def test_query_only(self) -> None:
+        db = self.db_context.acquire_read_connection()
+        try:
+            db.execute("SELECT COUNT(*) FROM WalletData").fetchone()
+            with pytest.raises(sqlite3.OperationalError):
+                db.execute("INSERT INTO WalletData (key, value, date_created, date_updated) "
+                    "VALUES ('pool', '1', 1, 1)")
+        finally:
+            self.db_context.release_read_connection(db)
+
+    def test_idle_limit(self) -> None:
+        self.db_context.MAXIMUM_IDLE_READ_CONNECTIONS = 1
+        try:
+            stats1 = self.db_context.get_read_pool_statistics()
+            connections = [ self.db_context.acquire_read_connection() for i in range(3) ]
+            for db in connections:
+                self.db_context.release_read_connection(db)
+            stats2 = self.db_context.get_read_pool_statistics()
+            assert stats2.idle_count <= 1
+            assert stats2.discards >= stats1.discards + 2
+        finally:
+            del self.db_context.MAXIMUM_IDLE_READ_CONNECTIONS
+
+
+class TestBulkRestore:
+    INSERT_MASTERKEY_SQL = ("INSERT INTO MasterKeys (masterkey_id, derivation_type, "
+        "derivation_data, date_created, date_updated) VALUES (?, 1, x'00', 1, 1)")
+    INSERT_ACCOUNT_SQL = ("INSERT INTO Accounts (account_id, default_masterkey_id, "
+        "default_script_type, account_name, date_created, date_updated) VALUES (?, ?, 1, '', 1, 1)")
+
+    def _write(self, db_context: DatabaseContext, write_callback) -> None:
+        with SynchronousWriter() as writer:
+            db_context.queue_write(write_callback, writer.get_callback())
+            assert writer.succeeded()
+
+    @pytest.mark.timeout(5)
+    def test_deferred_foreign_keys(self, tmp_path) -> None:
+        wallet_path = os.path.join(tmp_path, "wallet")
+        create_database_file(wallet_path)
+        db_context = DatabaseContext(wallet_path)
+        try:
+            # The account is inserted before the masterkey it refers to.
+            def _write_account_first(masterkey_id: int, db: sqlite3.Connection) -> None:
+                db.execute(self.INSERT_ACCOUNT_SQL, (masterkey_id, masterkey_id))
+                db.execute(self.INSERT_MASTERKEY_SQL, (masterkey_id,))
+
+            with pytest.raises(sqlite3.IntegrityError):
+                self._write(db_context, lambda db: _write_account_first(1, db))
+
+            with db_context.bulk_restore():
+                assert db_context.is_bulk_restore()
+                self._write(db_context, lambda db: _write_account_first(2, db))
+                # The foreign keys are still checked when the batch is committed.
+                with pytest.raises(sqlite3.IntegrityError):
+                    self._write(db_context, lambda db: db.execute(self.INSERT_ACCOUNT_SQL,
+                        (3, 3)))
+            assert not db_context.is_bulk_restore()
+
+            db = db_context.acquire_connection()
+            try:
+                assert [ (2,) ] == db.execute("SELECT account_id FROM Accounts").fetchall()
+                assert 2 == db.execute("PRAGMA synchronous").fetchone()[0]
+            finally:
+                db_context.release_connection(db)
+        finally:
+            db_context.close()
+
+    @pytest.mark.timeout(5)
+    def test_commit_failure_completion(self, tmp_path) -> None:
+        wallet_path = os.path.join(tmp_path, "wallet")
+        create_database_file(wallet_path)
+        db_context = DatabaseContext(wallet_path)
+        try:
+            results: List[Optional[Exception]] = []
+            with db_context.bulk_restore():
+                # The foreign key violation is only detected when the write is committed.
+                db_context.queue_write(lambda db: db.execute(self.INSERT_ACCOUNT_SQL, (1, 1)),
+                    results.append)
+                # The completions are made in order, so this one comes after the first.
+                self._write(db_context, lambda db: None)
+            assert len(results) == 1
+            assert isinstance(results[0], sqlite3.IntegrityError)
+        finally:
+            db_context.close()
+
+    @pytest.mark.timeout(5)
+    def test_refused_for_live_session(self, tmp_path) -> None:
+        wallet_path = os.path.join(tmp_path, "wallet")
+        create_database_file(wallet_path)
+        db_context = DatabaseContext(wallet_path)
+        try:
+            db_context.begin_bulk_restore()
+            with pytest.raises(BulkRestoreError):
+                db_context.begin_bulk_restore()
+            with pytest.raises(BulkRestoreError):
+                db_context.set_live_session()
+            db_context.end_bulk_restore()
+            with pytest.raises(BulkRestoreError):
+                db_context.end_bulk_restore()
+
+            db_context.set_live_session()
+            with pytest.raises(BulkRestoreError):
+                db_context.begin_bulk_restore()
+            assert not db_context.is_bulk_restore()
+        finally:
+            db_context.close()
+
+
+class TestTransactionCacheEntries:
+    def test_roundtrip(self) -> None:
+        entries = TransactionCacheEntries()
+        tx_hash_1 = os.urandom(32)
+        tx_hash_2 = os.urandom(32)
+        entry_1 = TransactionCacheEntry(TxData(height=-1, date_added=1, date_updated=2),
+            TxFlags.StateCleared, 10.5)
+        entry_2 = TransactionCacheEntry(TxData(height=0, position=0, fee=0, date_added=3,
+            date_updated=4), TxFlags.StateSettled | TxFlags.HasFee, 11.5)
+        entries[tx_hash_1] = entry_1
+        entries[tx_hash_2] = entry_2
+
+        assert len(entries) == 2
+        assert tx_hash_1 in entries
+        for tx_hash, entry in ((tx_hash_1, entry_1), (tx_hash_2, entry_2)):
+            copy = entries[tx_hash]
+            assert copy is not entry
+            assert copy.metadata == entry.metadata
+            assert copy.flags == entry.flags
+            assert copy.time_loaded == entry.time_loaded
+        assert entries.get_flags(tx_hash_2) == TxFlags.StateSettled | TxFlags.HasFee
+        assert [ t[0] for t in entries.select(lambda flags: flags & TxFlags.StateSettled) ] == \
+            [ tx_hash_2 ]
+
+        # Changes to an entry have to be set back to take effect.
+        copy = entries[tx_hash_1]
+        copy.flags = TxFlags.StateSettled
+        assert entries[tx_hash_1].flags == TxFlags.StateCleared
+        entries[tx_hash_1] = copy
+        assert entries[tx_hash_1].flags == TxFlags.StateSettled
+
+    def test_slot_reuse(self) -> None:
+        entries = TransactionCacheEntries()
+        tx_hash_1 = os.urandom(32)
+        tx_hash_2 = os.urandom(32)
+        entries[tx_hash_1] = TransactionCacheEntry(TxData(height=1), TxFlags.Unset)
+        del entries[tx_hash_1]
+        assert tx_hash_1 not in entries
+        assert entries.get(tx_hash_1) is None
+        assert entries.pop(tx_hash_1) is None
+        with pytest.raises(KeyError):
+            entries[tx_hash_1]
+
+        entries[tx_hash_2] = TransactionCacheEntry(TxData(height=2), TxFlags.Unset)
+        assert len(entries._flags) == 1
+        assert entries[tx_hash_2].metadata == TxData(height=2)
+        assert entries.pop(tx_hash_2).metadata == TxData(height=2)
+        assert len(entries) == 0
+
+    def test_indexes(self) -> None:
+        entries = TransactionCacheEntries()
+        tx_hashes = [ os.urandom(32) for i in range(5) ]
+        settled_flags = TxFlags.StateSettled | TxFlags.HasByteData | TxFlags.HasHeight
+        entries[tx_hashes[0]] = TransactionCacheEntry(TxData(height=0), TxFlags.HasHeight)
+        entries[tx_hashes[1]] = TransactionCacheEntry(TxData(height=10), settled_flags)
+        entries[tx_hashes[2]] = TransactionCacheEntry(TxData(height=20), settled_flags)
+        entries[tx_hashes[3]] = TransactionCacheEntry(TxData(height=20), settled_flags)
+
+        def _select(flags: TxFlags, mask: TxFlags) -> List[bytes]:
+            return [ t[0] for t in entries.select(lambda entry_flags: entry_flags & mask == flags,
+                mask) ]
+        assert _select(TxFlags.Unset, TxFlags.HasByteData) == [ tx_hashes[0] ]
+        assert set(_select(TxFlags.HasByteData, TxFlags.HasByteData)) == set(tx_hashes[1:4])
+
+        def _settled_above(height: int) -> List[bytes]:
+            return sorted(t[0] for t in entries.get_settled_above_height(height))
+        assert _settled_above(10) == sorted(tx_hashes[2:4])
+        assert _settled_above(0) == sorted(tx_hashes[1:4])
+
+        # Updates that change the indexed values move the entry in the indexes.
+        entries[tx_hashes[2]] = TransactionCacheEntry(TxData(height=0),
+            TxFlags.StateCleared | TxFlags.HasByteData | TxFlags.HasHeight)
+        assert _settled_above(10) == [ tx_hashes[3] ]
+        assert _select(TxFlags.StateCleared, TxFlags.StateCleared) == [ tx_hashes[2] ]
+        # Updates that do not change them, leave the entry in place.
+        entries[tx_hashes[3]] = TransactionCacheEntry(TxData(height=20, fee=1),
+            settled_flags | TxFlags.HasFee)
+        assert _settled_above(10) == [ tx_hashes[3] ]
+
+        del entries[tx_hashes[3]]
+        assert _settled_above(10) == []
+        entries[tx_hashes[4]] = TransactionCacheEntry(TxData(height=30), settled_flags)
+        assert _settled_above(10) == [ tx_hashes[4] ]
+        assert _settled_above(5) == sorted([ tx_hashes[1], tx_hashes[4] ])
+        assert entries.pop(tx_hashes[1]) is not None
+        assert _settled_above(5) == [ tx_hashes[4] ]
+
+    def test_bulk_index_removal(self) -> None:
+        # Pruning, evicting or deleting every settled entry used to search the settled flag
+        # bucket and height index for each one, which took minutes for this many entries.
+        count = 100000
+        entries = TransactionCacheEntries()
+        tx_hashes = [ os.urandom(32) for i in range(count) ]
+        settled_flags = TxFlags.StateSettled | TxFlags.HasByteData | TxFlags.HasHeight
+        for i, tx_hash in enumerate(tx_hashes):
+            entries[tx_hash] = TransactionCacheEntry(TxData(height=i+1), settled_flags)
+
+        sort_count = 0
+        original_sort = entries._sort_settled_keys
+        def _sort_settled_keys() -> None:
+            nonlocal sort_count
+            sort_count += 1
+            original_sort()
+        entries._sort_settled_keys = _sort_settled_keys
+
+        start_time = time.time()
+        pruned_flags = TxFlags.StateSettled | TxFlags.PrunedByteData | TxFlags.HasHeight
+        for i, tx_hash in enumerate(tx_hashes[:count // 2]):
+            entries[tx_hash] = TransactionCacheEntry(TxData(height=i+1), pruned_flags)
+        for tx_hash in tx_hashes[count // 2:]:
+            del entries[tx_hash]
+        assert time.time() - start_time < 10
+        # Removed height index keys are only marked, and the index is rebuilt when next used.
+        assert sort_count == 0
+        assert len(entries._removed_settled_keys) == count // 2
+
+        def _select(flags: TxFlags) -> List[bytes]:
+            return [ t[0] for t in entries.select(lambda entry_flags: entry_flags == flags,
+                INDEXED_FLAGS) ]
+        assert _select(settled_flags) == []
+        assert set(_select(pruned_flags)) == set(tx_hashes[:count // 2])
+        assert [ t[0] for t in entries.get_settled_above_height(count // 2 - 1) ] == \
+            [ tx_hashes[count // 2 - 1] ]
+        assert len(entries.get_settled_above_height(0)) == count // 2
+        assert sort_count == 1
+
+    def test_memory_usage(self) -> None:
+        count = 10000
+        tx_hashes = [ os.urandom(32) for i in range(count) ]
+
+        def _measure(entries) -> int:
+            tracemalloc.start()
+            try:
+                for i, tx_hash in enumerate(tx_hashes):
+                    entries[tx_hash] = TransactionCacheEntry(TxData(height=600000 + i,
+                        position=i, fee=1000 + i, date_added=1600000000 + i,
+                        date_updated=1600000000 + i), TxFlags.StateSettled)
+                return tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+
+        dict_size = _measure({})
+        columnar_size = _measure(TransactionCacheEntries())
+        assert columnar_size < dict_size / 2, (columnar_size, dict_size)
+
+
 class MockTransactionStore:
     def update_proof(self, tx_hash: bytes, proof: TxProof) -> None:
         raise NotImplementedError
@@ -194,7 +568,7 @@ class TestTransactionCache:
         cls.db_context.close()
 
     def setup_method(self):
-        db = self.store._db
+        db = self.db
         db.execute(f"DELETE FROM Transactions")
         db.commit()
 
@@ -255,6 +629,76 @@ class TestTransactionCache:
         assert cache.have_transaction_data_cached(tx_hash)
         assert TxFlags.StateCleared == entry.flags & TxFlags.StateCleared
 
+    @pytest.mark.timeout(5)
+    def test_add_transactions(self):
+        cache = TransactionCache(self.store)
+
+        bytedata_1 = bytes.fromhex(tx_hex_1)
+        tx_hash_1 = bitcoinx.double_sha256(bytedata_1)
+        bytedata_2 = bytes.fromhex(tx_hex_2)
+        tx_hash_2 = bitcoinx.double_sha256(bytedata_2)
+
+        # The first transaction is known without its data, the second is not known at all.
+        with SynchronousWriter() as writer:
+            cache.add([ (tx_hash_1, TxData(height=1), None, TxFlags.Unset, None) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        with SynchronousWriter() as writer:
+            cache.add_transactions([ (tx_hash_1, bytedata_1), (tx_hash_2, bytedata_2) ],
+                TxFlags.StateCleared, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        for tx_hash, bytedata in ((tx_hash_1, bytedata_1), (tx_hash_2, bytedata_2)):
+            entry = cache.get_entry(tx_hash)
+            assert entry.flags & (TxFlags.StateCleared | TxFlags.HasByteData) == \
+                TxFlags.StateCleared | TxFlags.HasByteData
+            assert cache.get_transaction_data(tx_hash) == bytedata
+        # The known transaction retains its existing metadata.
+        assert cache.get_entry(tx_hash_1).metadata.height == 1
+
+        rows = self.store.read(tx_hashes=[ tx_hash_1, tx_hash_2 ])
+        assert len(rows) == 2
+        assert all(row[1] is not None for row in rows)
+
+    @pytest.mark.timeout(5)
+    def test_update_verifications(self):
+        cache = TransactionCache(self.store)
+
+        bytedata_1 = bytes.fromhex(tx_hex_1)
+        tx_hash_1 = bitcoinx.double_sha256(bytedata_1)
+        bytedata_2 = bytes.fromhex(tx_hex_2)
+        tx_hash_2 = bitcoinx.double_sha256(bytedata_2)
+        with SynchronousWriter() as writer:
+            cache.add([ (tx_hash_1, TxData(height=10, fee=5), bytedata_1, TxFlags.StateCleared,
+                    None),
+                (tx_hash_2, TxData(height=11), bytedata_2, TxFlags.StateCleared, None) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        proof_1 = TxProof(1, [ os.urandom(32) ])
+        proof_2 = TxProof(3, [ os.urandom(32), os.urandom(32) ])
+        with SynchronousWriter() as writer:
+            cache.update_verifications([ (tx_hash_1, 10, 1, proof_1),
+                (tx_hash_2, 11, 3, proof_2) ], completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        entry_1 = cache.get_entry(tx_hash_1)
+        assert entry_1.flags & TxFlags.STATE_MASK == TxFlags.StateSettled
+        assert entry_1.metadata.position == 1
+        # Existing metadata that the verification does not cover is preserved.
+        assert entry_1.metadata.fee == 5
+        assert cache.get_entry(tx_hash_2).metadata.position == 3
+
+        rows = { row[0]: row for row in self.store.read_metadata(tx_hashes=[ tx_hash_1,
+            tx_hash_2 ]) }
+        assert rows[tx_hash_1][1] & TxFlags.STATE_MASK == TxFlags.StateSettled
+        assert rows[tx_hash_1][1] & TxFlags.HasProofData
+        assert rows[tx_hash_2][2].position == 3
+        proofs = dict(self.store.read_proof([ tx_hash_1, tx_hash_2 ]))
+        assert proofs[tx_hash_1] == proof_1
+        assert proofs[tx_hash_2] == proof_2
+
     @pytest.mark.timeout(5)
     def test_add_then_update(self):
         cache = TransactionCache(self.store)
@@ -430,6 +874,32 @@ class TestTransactionCache:
         assert tx is not None
         assert tx_hash == tx.hash()
 
+    @pytest.mark.timeout(5)
+    def test_get_transaction_object_cached(self):
+        bytedata = bytes.fromhex(tx_hex_1)
+        tx_hash = bitcoinx.double_sha256(bytedata)
+        metadata = TxData(height=1, fee=2, position=None, date_added=1, date_updated=1)
+        cache = TransactionCache(self.store)
+        with SynchronousWriter() as writer:
+            cache.add([ (tx_hash, metadata, bytedata, TxFlags.Unset, None) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        tx = cache.get_transaction(tx_hash)
+        assert cache.get_transaction(tx_hash) is tx
+        object_cache = cache._transaction_object_cache
+        assert (object_cache.hits, object_cache.misses) == (1, 1)
+        # A filtered out transaction is not given out from the object cache.
+        assert cache.get_transaction(tx_hash, TxFlags.StateSettled) is None
+        # Copies are not shared.
+        assert cache.get_transactions(tx_hashes=[ tx_hash ])[0][1] is not tx
+
+        with SynchronousWriter() as writer:
+            cache.delete(tx_hash, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        assert tx_hash not in object_cache
+        assert cache.get_transaction(tx_hash) is None
+
     @pytest.mark.timeout(5)
     def test_get_transactions(self):
         tx_hashes = []
@@ -543,6 +1013,12 @@ class TestTransactionCache:
                 completion_callback=writer.get_callback())
             assert writer.succeeded()
 
+        # The lookup is made on the flag index, rather than by scanning every entry.
+        class _UnscannableSlots(dict):
+            def items(self):
+                raise AssertionError("every entry was scanned")
+        cache._cache._slots = _UnscannableSlots(cache._cache._slots)
+
         results = cache.get_unsynced_hashes()
         assert 1 == len(results)
 
@@ -672,6 +1148,181 @@ class TestTransactionCache:
         assert data_n3.fee == n3.metadata.fee
         assert TxFlags.StateDispatched | expected_flags == n3.flags, TxFlags.to_repr(n3.flags)
 
+    @pytest.mark.timeout(5)
+    def test_prune(self) -> None:
+        cache = TransactionCache(self.store)
+
+        tx_bytes_1 = bytes.fromhex(tx_hex_1)
+        tx_hash_1 = bitcoinx.double_sha256(tx_bytes_1)
+        data_1 = TxData(height=11, position=22, fee=33, date_added=1, date_updated=1)
+        tx_bytes_2 = bytes.fromhex(tx_hex_2)
+        tx_hash_2 = bitcoinx.double_sha256(tx_bytes_2)
+        data_2 = TxData(height=0, fee=33, date_added=1, date_updated=1)
+        with SynchronousWriter() as writer:
+            cache.add([ (tx_hash_1, data_1, tx_bytes_1, TxFlags.StateSettled, None),
+                (tx_hash_2, data_2, tx_bytes_2, TxFlags.StateCleared, None) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        assert cache.get_transaction(tx_hash_1) is not None
+
+        # Only the settled transaction is pruned.
+        with SynchronousWriter() as writer:
+            assert [ tx_hash_1 ] == cache.prune([ tx_hash_1, tx_hash_2 ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        expected_flags = (TxFlags.StateSettled | TxFlags.PrunedByteData | TxFlags.HasFee |
+            TxFlags.HasHeight | TxFlags.HasPosition)
+        entry = cache.get_entry(tx_hash_1)
+        assert expected_flags == entry.flags, TxFlags.to_repr(entry.flags)
+        assert data_1.position == entry.metadata.position
+        assert cache.get_transaction(tx_hash_1) is None
+        assert not cache.have_transaction_data(tx_hash_1)
+        assert cache.have_transaction_data(tx_hash_2)
+        # A pruned transaction is not wanted again.
+        assert [] == cache.get_unsynced_hashes()
+
+        # The bytedata is gone from the database, but not the metadata.
+        rows = self.store.read(tx_hashes=[ tx_hash_1 ])
+        assert 1 == len(rows)
+        assert rows[0][1] is None
+        assert expected_flags == rows[0][2], TxFlags.to_repr(rows[0][2])
+        assert data_1.position == rows[0][3].position
+
+    @pytest.mark.timeout(5)
+    def test_unprune(self) -> None:
+        cache = TransactionCache(self.store)
+
+        tx_bytes_1 = bytes.fromhex(tx_hex_1)
+        tx_hash_1 = bitcoinx.double_sha256(tx_bytes_1)
+        data_1 = TxData(height=11, position=22, fee=33, date_added=1, date_updated=1)
+        with SynchronousWriter() as writer:
+            cache.add([ (tx_hash_1, data_1, tx_bytes_1, TxFlags.StateSettled, None) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        assert [ tx_hash_1 ] == cache.prune([ tx_hash_1 ])
+
+        # It is wanted again, and settled again once its proof is.
+        with SynchronousWriter() as writer:
+            assert [ tx_hash_1 ] == cache.unprune([ tx_hash_1 ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        entry = cache.get_entry(tx_hash_1)
+        assert TxFlags.HasFee | TxFlags.HasHeight == entry.flags, TxFlags.to_repr(entry.flags)
+        assert data_1.height == entry.metadata.height
+        assert [ tx_hash_1 ] == cache.get_unsynced_hashes()
+        assert [] == cache.unprune([ tx_hash_1 ])
+
+        with SynchronousWriter() as writer:
+            cache.add_transactions([ (tx_hash_1, tx_bytes_1) ], TxFlags.StateCleared,
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        assert cache.get_transaction(tx_hash_1) is not None
+        assert [ tx_hash_1 ] == [ t[0] for t in cache.get_unverified_entries(100) ]
+
+    def _add_budget_rows(self, settled_count: int) -> Tuple[List[bytes], bytes]:
+        # The settled transactions are created in ascending height order.
+        rows = []
+        for i in range(settled_count + 1):
+            tx_bytes = bytes.fromhex(tx_hex_1) + os.urandom(4)
+            if i < settled_count:
+                tx_data = TxData(height=i+1, position=0, date_added=1, date_updated=1)
+                flags = TxFlags.StateSettled
+            else:
+                tx_data = TxData(height=0, date_added=1, date_updated=1)
+                flags = TxFlags.StateCleared
+            rows.append(TransactionRow(bitcoinx.double_sha256(tx_bytes), tx_data, tx_bytes,
+                flags, None))
+        unsettled_tx_hash = rows[-1].tx_hash
+        with SynchronousWriter() as writer:
+            self.store.create(rows, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        return [ row.tx_hash for row in rows[:-1] ], unsettled_tx_hash
+
+    @pytest.mark.timeout(5)
+    def test_metadata_budget_faulting(self) -> None:
+        settled_tx_hashes, unsettled_tx_hash = self._add_budget_rows(5)
+        cache = TransactionCache(self.store, metadata_entry_budget=2)
+
+        # The unsettled and the most recently mined settled transactions are loaded.
+        assert cache.is_cached(unsettled_tx_hash)
+        assert [ cache.is_cached(tx_hash) for tx_hash in settled_tx_hashes ] == \
+            [ False, False, False, True, True ]
+
+        for i in range(3):
+            flags = cache.get_flags(settled_tx_hashes[i])
+            assert flags is not None and flags & TxFlags.StateSettled
+            assert cache.is_cached(settled_tx_hashes[i])
+        assert cache.metadata_faults == 3
+        # Each fault evicts the least recently used settled entry to make room for itself.
+        assert cache.metadata_evictions == 2
+        assert not cache.is_cached(settled_tx_hashes[3])
+        assert not cache.is_cached(settled_tx_hashes[4])
+        assert cache.is_cached(unsettled_tx_hash)
+
+        metadata = cache.get_metadata(settled_tx_hashes[4])
+        assert metadata is not None and metadata.height == 5
+        assert cache.get_metadata(os.urandom(32)) is None
+
+    @pytest.mark.timeout(5)
+    def test_metadata_budget_scanning(self) -> None:
+        settled_tx_hashes, unsettled_tx_hash = self._add_budget_rows(5)
+        cache = TransactionCache(self.store, metadata_entry_budget=0)
+        cache.METADATA_PAGE_SIZE = 2
+
+        assert len(cache._cache) == 1
+        assert len(cache.get_metadatas()) == 6
+        entries = cache.get_entries(TxFlags.StateSettled, TxFlags.StateSettled)
+        assert set(t[0] for t in entries) == set(settled_tx_hashes)
+        entries = cache.get_entries(TxFlags.Unset, TxFlags.StateSettled)
+        assert [ t[0] for t in entries ] == [ unsettled_tx_hash ]
+        # Scanning does not populate the cache.
+        assert len(cache._cache) == 1
+
+        # Filters that exclude settled transactions do not need to scan the store.
+        read_metadata_page = self.store.read_metadata_page
+        page_reads = 0
+        def _read_metadata_page(*args):
+            nonlocal page_reads
+            page_reads += 1
+            return read_metadata_page(*args)
+        self.store.read_metadata_page = _read_metadata_page
+        try:
+            assert cache.get_unverified_entries(10) == []
+            assert cache.get_unsynced_hashes() == []
+            entries = cache.get_entries(TxFlags.Unset, TxFlags.HasPosition)
+            assert [ t[0] for t in entries ] == [ unsettled_tx_hash ]
+            assert page_reads == 0
+        finally:
+            del self.store.read_metadata_page
+
+        # Reorged transactions become unsettled, and have to be cached.
+        with SynchronousWriter() as writer:
+            cache.apply_reorg(3, completion_callback=writer.get_callback())
+            assert writer.succeeded()
+        assert [ cache.is_cached(tx_hash) for tx_hash in settled_tx_hashes ] == \
+            [ False, False, False, True, True ]
+
+    @pytest.mark.timeout(5)
+    def test_metadata_budget_pending_writes(self) -> None:
+        settled_tx_hashes, unsettled_tx_hash = self._add_budget_rows(1)
+        tx_hash = settled_tx_hashes[0]
+        cache = TransactionCache(self.store, metadata_entry_budget=0)
+
+        new_flags = TxFlags.StateSettled | TxFlags.HasByteData | TxFlags.HasProofData
+        with cache._lock:
+            cache.update_flags(tx_hash, new_flags)
+            # The entry cannot be evicted until the store has the change.
+            assert cache.is_cached(tx_hash)
+            assert tx_hash in cache._pending_writes
+
+        # Completion callbacks are called in order, so the pin is released before this one.
+        with SynchronousWriter() as writer:
+            self.db_context.queue_write(lambda db: None, writer.get_callback())
+            assert writer.succeeded()
+        assert not cache.is_cached(tx_hash)
+        assert cache.get_flags(tx_hash) & new_flags == new_flags
+
 
 class TestSqliteWriteDispatcher:
     @classmethod
@@ -737,3 +1388,67 @@ class TestSqliteWriteDispatcher:
 
         assert _write_callback_called
 
+
+    @pytest.mark.timeout(5)
+    def test_write_dispatcher_bisects_failed_batch(self) -> None:
+        self.dispatcher = wallet_database.SqliteWriteDispatcher(self.db_context)
+        self.dispatcher._writer_loop_event.wait()
+
+        results = {}
+        def _make_completion_callback(i: int):
+            def _completion_callback(exc_value: Optional[Exception]) -> None:
+                results[i] = exc_value
+            return _completion_callback
+
+        def _make_write_callback(i: int):
+            def _write_callback(conn) -> None:
+                if i == 7:
+                    raise ValueError(i)
+            return _write_callback
+
+        for i in range(20):
+            self.dispatcher.put(WriteEntryType(_make_write_callback(i),
+                _make_completion_callback(i), 0))
+        self.dispatcher.stop()
+
+        assert len(results) == 20
+        assert isinstance(results[7], ValueError)
+        assert all(results[i] is None for i in range(20) if i != 7)
+        stats = self.dispatcher.get_statistics()
+        assert stats.failed_write_count == 1
+        assert stats.write_count == 19
+        # A failure should not permanently reduce the batch size.
+        assert stats.batch_size_limit > 1
+
+    @pytest.mark.timeout(5)
+    def test_write_dispatcher_size_budget(self) -> None:
+        self.dispatcher = wallet_database.SqliteWriteDispatcher(self.db_context)
+        self.dispatcher._writer_loop_event.wait()
+
+        order = []
+        size_hint = self.dispatcher.MAXIMUM_BATCH_BYTES // 2 + 1
+        for i in range(10):
+            self.dispatcher.put(WriteEntryType(lambda conn, i=i: order.append(i), None,
+                size_hint))
+        self.dispatcher.stop()
+
+        assert order == list(range(10))
+        stats = self.dispatcher.get_statistics()
+        assert stats.batch_count == 10
+        assert stats.maximum_batch_size == 1
+
+    @pytest.mark.timeout(5)
+    def test_write_dispatcher_adapts_batch_size(self) -> None:
+        self.dispatcher = wallet_database.SqliteWriteDispatcher(self.db_context)
+        initial_limit = self.dispatcher._batch_size_limit
+        # A full batch that commits quickly grows the limit.
+        self.dispatcher._record_batch(initial_limit, 1.0)
+        assert self.dispatcher._batch_size_limit == initial_limit * 2
+        # A batch that commits slowly shrinks it.
+        self.dispatcher._record_batch(1, self.dispatcher.TARGET_COMMIT_MS + 1)
+        assert self.dispatcher._batch_size_limit == initial_limit
+
+        stats = self.dispatcher.get_statistics()
+        assert stats.batch_count == 2
+        assert stats.write_count == initial_limit + 1
+        assert stats.maximum_commit_ms == self.dispatcher.TARGET_COMMIT_MS + 1
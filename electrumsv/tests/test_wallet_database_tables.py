@@ -3,7 +3,7 @@ import os
 import pytest
 import sqlite3
 import tempfile
-from typing import List
+from typing import List, Tuple
 
 from electrumsv.constants import (TxFlags, ScriptType, DerivationType, TransactionOutputFlag,
     PaymentState, WalletEventFlag, WalletEventType)
@@ -11,9 +11,10 @@ from electrumsv.logs import logs
 from electrumsv.wallet_database import (AccountTable, DatabaseContext, KeyInstanceTable,
     MasterKeyTable, migration, PaymentRequestTable, SynchronousWriter, TransactionTable,
     TransactionDeltaTable, TransactionOutputTable, TxData, TxProof)
-from electrumsv.wallet_database.tables import (AccountRow, KeyInstanceRow,
-    MAGIC_UNTOUCHED_BYTEDATA, MasterKeyRow, PaymentRequestRow, TransactionDeltaRow,
+from electrumsv.wallet_database.tables import (AccountRow, KeyInstanceRow, KeyInstanceScriptRow,
+    KeyInstanceScriptTable, MAGIC_UNTOUCHED_BYTEDATA, MasterKeyRow, PaymentRequestRow, TransactionDeltaRow,
     WalletEventRow, WalletEventTable)
+from electrumsv.wallet_database import tables
 
 logs.set_level("debug")
 
@@ -50,6 +51,50 @@ def test_migrations() -> None:
     migration.create_database_file(wallet_path)
 
 
+# These read whole tables by design, or are the base of a query that has clauses added to it.
+FULL_READ_SQL = {
+    ("AccountTable", "READ_SQL"),
+    ("KeyInstanceTable", "READ_SQL"),
+    ("MasterKeyTable", "READ_SQL"),
+    ("PaymentRequestTable", "READ_ALL_SQL"),
+    ("TransactionDeltaTable", "READ_ALL_SQL"),
+    ("TransactionOutputTable", "READ_SQL"),
+    ("TransactionTable", "READ_DESCRIPTION_SQL"),
+    ("TransactionTable", "READ_MANY_BASE_SQL"),
+    ("TransactionTable", "READ_METADATA_MANY_BASE_SQL"),
+    ("TransactionTable", "READ_PROOF_SQL"),
+    ("WalletDataTable", "READ_SQL"),
+    ("WalletEventTable", "READ_ALL_MASK_SQL"),
+    ("WalletEventTable", "READ_ALL_SQL"),
+}
+
+def _get_table_queries() -> List[Tuple[str, str, str]]:
+    queries = []
+    for class_name, value in sorted(vars(tables).items()):
+        if not isinstance(value, type) or not issubclass(value, tables.BaseWalletStore):
+            continue
+        for attribute_name, query in sorted(vars(value).items()):
+            if attribute_name.endswith("_SQL") and isinstance(query, str):
+                queries.append((class_name, attribute_name, query))
+    return queries
+
+@pytest.mark.parametrize("class_name,attribute_name,query", _get_table_queries())
+def test_query_plan(class_name: str, attribute_name: str, query: str) -> None:
+    db = sqlite3.connect(":memory:")
+    migration.create_database(db)
+    migration.update_database(db)
+    plan = db.execute("EXPLAIN QUERY PLAN "+ query, [ None ] * query.count("?")).fetchall()
+    db.close()
+
+    # The last column of each row describes the step, e.g. "SCAN Transactions" for a full table
+    # scan or "SEARCH Transactions USING INDEX ..." for an index lookup.
+    scans = [ row[-1] for row in plan if row[-1].startswith("SCAN ") ]
+    if (class_name, attribute_name) in FULL_READ_SQL:
+        assert len(scans), f"{class_name}.{attribute_name} is no longer a full read"
+    else:
+        assert scans == [], f"{class_name}.{attribute_name} scans: {scans}"
+
+
 @pytest.mark.timeout(8)
 def test_table_masterkeys_crud(db_context: DatabaseContext) -> None:
     table = MasterKeyTable(db_context)
@@ -291,6 +336,89 @@ def test_table_keyinstances_crud(db_context: DatabaseContext) -> None:
     assert rows[0].description == "line1"
 
 
+def test_table_keyinstancescripts_crud(db_context: DatabaseContext) -> None:
+    table = KeyInstanceScriptTable(db_context)
+    assert [] == table.read(1)
+
+    ACCOUNT_ID = 10
+    MASTERKEY_ID = 20
+
+    line1 = KeyInstanceScriptRow(1, ScriptType.P2PKH, b'hash1', b'script1')
+    line2 = KeyInstanceScriptRow(1, ScriptType.P2PK, b'hash2', b'script2')
+    line3 = KeyInstanceScriptRow(2, ScriptType.P2PKH, b'hash3', b'script3')
+
+    # No effect: The keyinstance foreign key constraint will fail as the key does not exist.
+    with pytest.raises(sqlite3.IntegrityError):
+        with SynchronousWriter() as writer:
+            table.create([ line1 ], completion_callback=writer.get_callback())
+            assert not writer.succeeded()
+
+    # Satisfy the keyinstance foreign key constraint by creating the keys and their parents.
+    with SynchronousWriter() as writer:
+        MasterKeyTable(db_context).create([ MasterKeyRow(MASTERKEY_ID, None, 2, b'111') ],
+            completion_callback=writer.get_callback())
+        assert writer.succeeded()
+    with SynchronousWriter() as writer:
+        AccountTable(db_context).create([
+                AccountRow(ACCOUNT_ID, MASTERKEY_ID, ScriptType.P2PKH, 'name1'),
+                AccountRow(ACCOUNT_ID+1, MASTERKEY_ID, ScriptType.P2PKH, 'name2') ],
+            completion_callback=writer.get_callback())
+        assert writer.succeeded()
+    with SynchronousWriter() as writer:
+        KeyInstanceTable(db_context).create([
+                KeyInstanceRow(1, ACCOUNT_ID, MASTERKEY_ID, DerivationType.BIP32, b'111',
+                    ScriptType.P2PKH, True, None),
+                KeyInstanceRow(2, ACCOUNT_ID+1, MASTERKEY_ID, DerivationType.BIP32, b'222',
+                    ScriptType.P2PKH, True, None) ],
+            completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    with SynchronousWriter() as writer:
+        table.create([ line1, line2, line3 ], completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    # Scripts already stored by another caller are ignored.
+    with SynchronousWriter() as writer:
+        table.create([ line1._replace(script_data=b'other') ],
+            completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    assert sorted(table.read(ACCOUNT_ID)) == sorted([ line1, line2 ])
+    assert table.read(ACCOUNT_ID+1) == [ line3 ]
+
+    # Only statuses that are set, for the script type the key is used with, are read.
+    assert table.read_statuses(ACCOUNT_ID) == []
+    with SynchronousWriter() as writer:
+        table.update_statuses([ (b'status1', 1, ScriptType.P2PKH),
+                (b'status2', 1, ScriptType.P2PK), (b'status3', 2, ScriptType.P2PKH) ],
+            completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    assert table.read_statuses(ACCOUNT_ID) == [ (1, b'status1') ]
+    assert table.read_statuses(ACCOUNT_ID+1) == [ (2, b'status3') ]
+
+    with SynchronousWriter() as writer:
+        table.update_statuses([ (None, 2, ScriptType.P2PKH) ],
+            completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    assert table.read_statuses(ACCOUNT_ID+1) == []
+
+    with SynchronousWriter() as writer:
+        table.delete([ 1 ], completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    assert table.read(ACCOUNT_ID) == []
+    assert table.read(ACCOUNT_ID+1) == [ line3 ]
+
+    # Deleting a key also deletes its scripts.
+    with SynchronousWriter() as writer:
+        KeyInstanceTable(db_context).delete([ 2 ], completion_callback=writer.get_callback())
+        assert writer.succeeded()
+
+    assert table.read(ACCOUNT_ID+1) == []
+
+
 class TestTransactionTable:
     @classmethod
     def setup_class(cls):
@@ -305,9 +433,13 @@ class TestTransactionTable:
         cls.db_context.close()
 
     def setup_method(self):
-        db = self.store._db
-        db.execute(f"DELETE FROM Transactions")
-        db.commit()
+        # The store's connection is read-only, so clearing rows needs a connection of our own.
+        db = self.db_context.acquire_connection()
+        try:
+            db.execute(f"DELETE FROM Transactions")
+            db.commit()
+        finally:
+            self.db_context.release_connection(db)
 
     def _get_store_hashes(self) -> List[bytes]:
         return [ row[0] for row in self.store.read_metadata() ]
@@ -669,6 +801,86 @@ class TestTransactionTable:
         assert position1 == tx_position2
         assert merkle_branch1 == merkle_branch2
 
+    @pytest.mark.timeout(8)
+    def test_update_proofs_and_metadata(self):
+        bytedata = os.urandom(10)
+        tx_hash = bitcoinx.double_sha256(bytedata)
+        metadata = TxData(height=-1, fee=2, position=None, date_added=1, date_updated=1)
+        with SynchronousWriter() as writer:
+            self.store.create([ (tx_hash, metadata, bytedata, TxFlags.StateCleared, None) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        proof = TxProof(5, [ os.urandom(32) for i in range(10) ])
+        metadata = TxData(height=100, fee=2, position=5, date_added=1, date_updated=2)
+        with SynchronousWriter() as writer:
+            self.store.update_proofs_and_metadata(
+                [ (tx_hash, metadata, TxFlags.StateSettled, proof) ],
+                completion_callback=writer.get_callback())
+            assert writer.succeeded()
+
+        _tx_hash, flags, metadata2 = self.store.read_metadata(tx_hashes=[ tx_hash ])[0]
+        assert metadata2 == metadata
+        assert flags & TxFlags.STATE_MASK == TxFlags.StateSettled
+        assert flags & TxFlags.HasProofData
+        assert flags & TxFlags.HasPosition
+
+        _tx_hash, (position2, branch2) = self.store.read_proof([ tx_hash ])[0]
+        assert position2 == proof.position
+        assert branch2 == proof.branch
+
+    @pytest.mark.timeout(8)
+    def test_compression(self) -> None:
+        store = TransactionTable(self.db_context, compression_threshold=100)
+        try:
+            small_bytedata = b"\x01" * 50
+            large_bytedata = b"\x02" * 200
+            random_bytedata = os.urandom(200)
+            rows = []
+            for bytedata in (small_bytedata, large_bytedata, random_bytedata):
+                metadata = TxData(height=1, fee=2, position=None, date_added=1, date_updated=1)
+                rows.append((bitcoinx.double_sha256(bytedata), metadata, bytedata,
+                    TxFlags.StateCleared, None))
+            with SynchronousWriter() as writer:
+                store.create(rows, completion_callback=writer.get_callback())
+                assert writer.succeeded()
+
+            # Only the large bytedata that compresses smaller is stored compressed.
+            stored_rows = { row[0]: row[1:] for row in self.store._db.execute(
+                "SELECT tx_hash, flags, length(tx_data) FROM Transactions") }
+            assert stored_rows[rows[0][0]] == (rows[0][3] | TxFlags.HasByteData |
+                TxFlags.HasFee | TxFlags.HasHeight, 50)
+            assert stored_rows[rows[1][0]][0] & TxFlags.CompressedByteData
+            assert stored_rows[rows[1][0]][1] < 200
+            assert not stored_rows[rows[2][0]][0] & TxFlags.CompressedByteData
+
+            # Metadata and flag updates leave the compressed bytedata readable.
+            tx_hash = rows[1][0]
+            metadata = TxData(height=100, fee=2, position=5, date_added=1, date_updated=2)
+            with SynchronousWriter() as writer:
+                store.update([ (tx_hash, metadata, MAGIC_UNTOUCHED_BYTEDATA,
+                    TxFlags.HasByteData) ], completion_callback=writer.get_callback())
+                assert writer.succeeded()
+            with SynchronousWriter() as writer:
+                store.update_flags([ (tx_hash, TxFlags.StateSettled,
+                    TxFlags.METADATA_FIELD_MASK | TxFlags.HasByteData, 3) ],
+                    completion_callback=writer.get_callback())
+                assert writer.succeeded()
+
+            # Any table reads it, whether it compresses or not.
+            for read_tx_hash, bytedata, flags, _metadata in self.store.read():
+                assert read_tx_hash == bitcoinx.double_sha256(bytedata)
+                assert not flags & TxFlags.CompressedByteData
+            _tx_hash, flags, _metadata = self.store.read_metadata(tx_hashes=[ tx_hash ])[0]
+            assert flags & TxFlags.STATE_MASK == TxFlags.StateSettled
+            assert not flags & TxFlags.CompressedByteData
+            # Filtering on the compression flag is not possible.
+            assert len(self.store.read(TxFlags.StateSettled | TxFlags.HasByteData,
+                TxFlags.STATE_MASK | TxFlags.HasByteData | TxFlags.CompressedByteData,
+                [ tx_hash ])) == 1
+        finally:
+            store.close()
+
     @pytest.mark.timeout(8)
     def test_labels(self):
         bytedata_1 = os.urandom(10)
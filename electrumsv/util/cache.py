@@ -1,6 +1,8 @@
+from collections import OrderedDict
+from enum import IntEnum
 import sys
 from threading import RLock
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 from ..constants import MAXIMUM_TXDATA_CACHE_SIZE_MB, MINIMUM_TXDATA_CACHE_SIZE_MB
 
@@ -9,19 +11,43 @@ class Node:
     next: 'Node'
     key: bytes
     value: bytes
+    protected: bool
 
     def __init__(self, previous: Optional['Node']=None, next: Optional['Node']=None,
             key: bytes=b'', value: bytes=b'') -> None:
         self.previous = previous if previous is not None else self
-        self.next = previous if previous is not None else self
+        self.next = next if next is not None else self
         self.key = key
         self.value = value
+        self.protected = False
+
+
+class CachePolicy(IntEnum):
+    # Evict the least recently used entries.
+    LRU = 1
+    # New entries are put on probation, and only move to the protected segment if they are used
+    # again while there. A scan of entries that are each used once can then only displace other
+    # entries on probation, not the protected working set.
+    SEGMENTED_LRU = 2
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    count: int
+    current_size: int
+    maximum_size: int
 
 
 # Derived from functools.lrucache, LRUCache should be considered licensed under Python license.
 # This intentionally does not have a dictionary interface for now.
 class LRUCache:
-    def __init__(self, max_count: Optional[int]=None, max_size: Optional[int]=None) -> None:
+    # The share of the maximum size the protected segment of the segmented LRU policy can use.
+    PROTECTED_SIZE_RATIO = 0.8
+
+    def __init__(self, max_count: Optional[int]=None, max_size: Optional[int]=None,
+            policy: CachePolicy=CachePolicy.LRU) -> None:
         self._cache: Dict[bytes, Node] = {}
 
         assert max_count is not None or max_size is not None, "need some limit"
@@ -32,12 +58,17 @@ class LRUCache:
             f"maximum size {max_size} not within min/max constraints"
         self._max_size = max_size
         self._max_count: int = max_count if max_count is not None else sys.maxsize
+        self._policy = policy
         self.current_size = 0
+        self._protected_size = 0
 
-        self.hits = self.misses = 0
+        self.hits = self.misses = self.evictions = 0
         self._lock = RLock()
-        # This will be a node in a bi-directional circular linked list with itself as sole entry.
+        # These will be nodes in bi-directional circular linked lists with themselves as sole
+        # entry. Entries on probation are in the first, and the second is only used by the
+        # segmented LRU policy for protected entries.
         self._root = Node()
+        self._protected_root = Node()
 
     def set_maximum_size(self, maximum_size: int, resize: bool=True) -> None:
         self._max_size = maximum_size
@@ -48,38 +79,77 @@ class LRUCache:
     def get_sizes(self) -> Tuple[int, int]:
         return (self.current_size, self._max_size)
 
-    def _add(self, key: bytes, value: bytes) -> Node:
-        most_recent_node = self._root.previous
-        new_node = Node(most_recent_node, self._root, key, value)
-        most_recent_node.next = self._root.previous = self._cache[key] = new_node
+    def get_stats(self) -> CacheStats:
+        return CacheStats(self.hits, self.misses, self.evictions, len(self._cache),
+            self.current_size, self._max_size)
+
+    def _link(self, root: Node, node: Node) -> None:
+        # Insert the node as the most recently used in the given list.
+        most_recent_node = root.previous
+        node.previous = most_recent_node
+        node.next = root
+        most_recent_node.next = root.previous = node
+
+    def _unlink(self, node: Node) -> None:
+        previous_node, next_node = node.previous, node.next
+        previous_node.next = next_node
+        next_node.previous = previous_node
+
+    def _remove(self, node: Node) -> None:
+        self._unlink(node)
+        self.current_size -= len(node.value)
+        if node.protected:
+            self._protected_size -= len(node.value)
+        del self._cache[node.key]
+
+    def _add(self, key: bytes, value: bytes, protect: bool) -> Node:
+        new_node = self._cache[key] = Node(key=key, value=value)
         self.current_size += len(value)
+        if protect and self._policy == CachePolicy.SEGMENTED_LRU:
+            self._protect(new_node)
+        else:
+            self._link(self._root, new_node)
         return new_node
 
+    def _protect(self, node: Node) -> None:
+        node.protected = True
+        self._protected_size += len(node.value)
+        self._link(self._protected_root, node)
+        # Demote the least recently used protected entries back to probation, where they get
+        # another chance to be used before they are evicted.
+        max_protected_size = self._max_size * self.PROTECTED_SIZE_RATIO
+        while self._protected_size > max_protected_size:
+            demoted_node = self._protected_root.next
+            self._unlink(demoted_node)
+            demoted_node.protected = False
+            self._protected_size -= len(demoted_node.value)
+            self._link(self._root, demoted_node)
+
     def __len__(self) -> int:
         return len(self._cache)
 
     def __contains__(self, key: bytes) -> bool:
         return key in self._cache
 
-    def set(self, key: bytes, value: Optional[bytes]) -> Tuple[bool, List[Tuple[bytes, bytes]]]:
+    def set(self, key: bytes, value: Optional[bytes], protect: bool=False) \
+            -> Tuple[bool, List[Tuple[bytes, bytes]]]:
+        """
+        With the segmented LRU policy, `protect` puts a new entry straight into the protected
+        segment, for a working set that is known to be needed.
+        """
         added = False
         removals: List[Tuple[bytes, bytes]] = []
         with self._lock:
             node = self._cache.get(key, None)
             if node is not None:
-                previous_node, next_node, old_value = node.previous, node.next, node.value
-                assert value != old_value, "duplicate set not supported"
-                previous_node.next = next_node
-                next_node.previous = previous_node
-                self.current_size -= len(old_value)
-                del self._cache[key]
-                removals.append((key, old_value))
+                assert value != node.value, "duplicate set not supported"
+                self._remove(node)
+                removals.append((key, node.value))
 
             if value is not None and len(value) <= self._max_size:
-                added_node = self._add(key, value)
+                added_node = self._add(key, value, protect)
                 added = True
-                # Discount the root node when considering count.
-                resize_removals = self._resize()
+                resize_removals = self._resize(added_node)
                 assert all(t[0] != added_node.key for t in resize_removals), "removed added node"
                 removals.extend(resize_removals)
 
@@ -89,27 +159,91 @@ class LRUCache:
         with self._lock:
             node = self._cache.get(key)
             if node is not None:
-                previous_node, next_node, value = node.previous, node.next, node.value
-                previous_node.next = next_node
-                next_node.previous = previous_node
-                most_recent_node = self._root.previous
-                most_recent_node.next = self._root.previous = node
-                node.previous = most_recent_node
-                node.next = self._root
+                self._unlink(node)
+                if node.protected:
+                    self._link(self._protected_root, node)
+                elif self._policy == CachePolicy.SEGMENTED_LRU:
+                    self._protect(node)
+                else:
+                    self._link(self._root, node)
                 self.hits += 1
-                return value
+                return node.value
             self.misses += 1
         return None
 
-    def _resize(self) -> List[Tuple[bytes, bytes]]:
+    def _resize(self, added_node: Optional[Node]=None) -> List[Tuple[bytes, bytes]]:
         removals = []
-        while len(self._cache)-1 >= self._max_count or self.current_size > self._max_size:
+        while len(self._cache) > self._max_count or self.current_size > self._max_size:
+            # Entries on probation are evicted first, but never the entry being added.
             node = self._root.next
-            previous_node, next_node, discard_key, discard_value = \
-                node.previous, node.next, node.key, node.value
-            previous_node.next = next_node
-            next_node.previous = previous_node
-            self.current_size -= len(discard_value)
-            del self._cache[discard_key]
-            removals.append((discard_key, discard_value))
+            if node is self._root or node is added_node:
+                node = self._protected_root.next
+            self._remove(node)
+            self.evictions += 1
+            removals.append((node.key, node.value))
         return removals
+
+
+class ObjectCache:
+    """
+    A least recently used cache of arbitrary objects, limited by the total of the estimated
+    sizes the caller gives for them. The objects are shared with every caller that gets them, so
+    they must not be modified.
+    """
+    def __init__(self, max_size: int) -> None:
+        self._cache: 'OrderedDict[bytes, Tuple[Any, int]]' = OrderedDict()
+        self._max_size = max_size
+        self.current_size = 0
+
+        self.hits = self.misses = self.evictions = 0
+        self._lock = RLock()
+
+    def set_maximum_size(self, maximum_size: int) -> None:
+        with self._lock:
+            self._max_size = maximum_size
+            self._resize()
+
+    def get_sizes(self) -> Tuple[int, int]:
+        return (self.current_size, self._max_size)
+
+    def get_stats(self) -> CacheStats:
+        return CacheStats(self.hits, self.misses, self.evictions, len(self._cache),
+            self.current_size, self._max_size)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self._cache
+
+    def set(self, key: bytes, value: Any, size: int) -> bool:
+        with self._lock:
+            self.discard(key)
+            if size > self._max_size:
+                return False
+            self._cache[key] = (value, size)
+            self.current_size += size
+            self._resize()
+        return True
+
+    def discard(self, key: bytes) -> None:
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None:
+                self.current_size -= entry[1]
+
+    def get(self, key: bytes) -> Optional[Any]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        return None
+
+    def _resize(self) -> None:
+        while self.current_size > self._max_size:
+            _key, (_value, size) = self._cache.popitem(last=False)
+            self.current_size -= size
+            self.evictions += 1
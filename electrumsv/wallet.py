@@ -28,27 +28,33 @@
 #   - MultisigAccount: several keystores, P2SH
 
 from collections import defaultdict
+import bisect
 from datetime import datetime
+from aiorpcx import run_in_thread
 import attr
+import heapq
 from bitcoinx import (Address, PrivateKey, PublicKey, P2MultiSig_Output, hash160, P2SH_Address,
-    P2PK_Output, Script, hex_str_to_hash, hash_to_hex_str, MissingHeader)
+    P2PK_Output, Script, hex_str_to_hash, hash_to_hex_str, MissingHeader, classify_output_script)
 import itertools
 import json
 import os
 import random
+import sys
 import threading
 import time
-from typing import (Any, cast, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple,
-    TypeVar, TYPE_CHECKING, Union)
+from typing import (Any, Callable, cast, Dict, Iterable, List, NamedTuple, Optional, Sequence,
+    Set, Tuple, TypeVar, TYPE_CHECKING, Union)
 import weakref
 
 from . import coinchooser
 from .app_state import app_state
-from .bitcoin import compose_chain_string, COINBASE_MATURITY, ScriptTemplate
-from .constants import (AccountType, CHANGE_SUBPATH, DEFAULT_TXDATA_CACHE_SIZE_MB, DerivationType,
-    KeyInstanceFlag, KeystoreTextType, MAXIMUM_TXDATA_CACHE_SIZE_MB, MINIMUM_TXDATA_CACHE_SIZE_MB,
-    PaymentState, RECEIVING_SUBPATH, ScriptType, TransactionOutputFlag, TxFlags, WalletEventFlag,
-    WalletEventType)
+from .bitcoin import (compose_chain_string, COINBASE_MATURITY, history_status, scripthash_bytes,
+    ScriptTemplate)
+from .constants import (AccountType, CHANGE_SUBPATH, DEFAULT_TXDATA_CACHE_SIZE_MB,
+    DEFAULT_TXOBJECT_CACHE_SIZE_MB, DerivationType, KeyInstanceFlag, KeystoreTextType,
+    MAXIMUM_TXDATA_CACHE_SIZE_MB, MINIMUM_TXDATA_CACHE_SIZE_MB,
+    PaymentState, RECEIVING_SUBPATH, ScriptType, StatusPriority, TransactionOutputFlag, TxFlags,
+    WalletEventFlag, WalletEventType)
 from .contacts import Contacts
 from .crypto import pw_encode, sha256
 from .exceptions import (NotEnoughFunds, ExcessiveFee, UserCancelled, UnknownTransactionException,
@@ -67,12 +73,13 @@ from .transaction import (Transaction, XPublicKey, NO_SIGNATURE, XTxInput, XTxOu
     XPublicKeyType)
 from .util import (format_satoshis, get_wallet_name_from_path, timestamp_to_datetime,
     TriggeredCallbacks)
-from .wallet_database import TxData, TxProof, TransactionCacheEntry, TransactionCache
+from .wallet_database import (AsyncCompletionCallback, TxData, TxProof, TransactionCacheEntry,
+    TransactionCache)
 from .wallet_database.tables import (AccountRow, AccountTable, KeyInstanceRow, KeyInstanceTable,
-    MasterKeyRow, MasterKeyTable, TransactionTable, TransactionOutputTable,
-    TransactionOutputRow, TransactionDeltaTable, TransactionDeltaRow, PaymentRequestTable,
-    PaymentRequestRow, WalletEventRow, WalletEventTable)
-from .wallet_database.sqlite_support import DatabaseContext
+    KeyInstanceScriptRow, KeyInstanceScriptTable, MasterKeyRow, MasterKeyTable, TransactionTable,
+    TransactionOutputTable, TransactionOutputRow, TransactionDeltaTable, TransactionDeltaRow,
+    PaymentRequestTable, PaymentRequestRow, WalletEventRow, WalletEventTable)
+from .wallet_database.sqlite_support import CompletionCallbackType, DatabaseContext
 
 if TYPE_CHECKING:
     from .network import Network
@@ -148,15 +155,27 @@ class UTXO:
 class SyncState:
     def __init__(self) -> None:
         self._key_history: Dict[int, List[Tuple[str, int]]] = {}
+        # The status of each key's history, computed when first needed or loaded from the
+        # database, and discarded when the history changes.
+        self._key_status: Dict[int, Optional[str]] = {}
         self._tx_keys: Dict[str, Set[int]] = {}
 
     def get_key_history(self, key_id: int) -> List[Tuple[str, int]]:
         return self._key_history.get(key_id, [])
 
+    def get_key_status(self, key_id: int) -> Optional[str]:
+        if key_id not in self._key_status:
+            self._key_status[key_id] = history_status(self.get_key_history(key_id))
+        return self._key_status[key_id]
+
+    def set_key_status(self, key_id: int, status: Optional[str]) -> None:
+        self._key_status[key_id] = status
+
     def set_key_history(self, key_id: int, history: List[Tuple[str, int]]) \
             -> Tuple[Set[str], Set[str]]:
         old_history = self._key_history.get(key_id, [])
         self._key_history[key_id] = history
+        self._key_status.pop(key_id, None)
 
         old_tx_ids = set(t[0] for t in old_history)
         new_tx_ids = set(t[0] for t in history)
@@ -181,11 +200,133 @@ class SyncState:
         return tx_keys
 
 
+# The sort key and hash of the last entry of a page of history, used to fetch the next page.
+HistoryCursor = Tuple[Tuple[int, int], bytes]
+
+class AccountHistory:
+    """
+    The history of an account, ordered by block height and position, with the balance after
+    each transaction. It is kept up to date as deltas are applied and transaction heights
+    change, so the newest entries can be read without visiting the older ones.
+    """
+    def __init__(self, get_metadata: Callable[[bytes], Optional[TxData]]) -> None:
+        self._get_metadata = get_metadata
+        self._lock = threading.RLock()
+        self._value_deltas: Dict[bytes, int] = {}
+        # Only transactions with a known height are listed.
+        self._lines: Dict[bytes, HistoryLine] = {}
+        self._entries: List[HistoryCursor] = []
+        # The balance after each entry, valid for the entries before `_valid_count`.
+        self._balances: List[int] = []
+        self._valid_count = 0
+
+    @staticmethod
+    def get_sort_key(height: int, position: Optional[int]) -> Tuple[int, int]:
+        if position is not None:
+            return height, position
+        # Unconfirmed transactions go last, and those with unconfirmed parents after them.
+        return (height, 0) if height > 0 else (1000000000 - height, 0)
+
+    def load(self, rows: Iterable[Tuple[bytes, int, int]]) -> None:
+        with self._lock:
+            for tx_hash, value_delta, _keyinstance_id in rows:
+                self._value_deltas[tx_hash] = self._value_deltas.get(tx_hash, 0) + value_delta
+            self.rebuild()
+
+    def rebuild(self) -> None:
+        "Recreate the ordering from scratch, for when many transaction heights have changed."
+        with self._lock:
+            self._lines.clear()
+            for tx_hash, value_delta in self._value_deltas.items():
+                line = self._make_line(tx_hash, value_delta)
+                if line is not None:
+                    self._lines[tx_hash] = line
+            self._entries = sorted((line.sort_key, line.tx_hash) for line in self._lines.values())
+            self._valid_count = 0
+
+    def add_value_deltas(self, value_deltas: Iterable[Tuple[bytes, int]]) -> None:
+        with self._lock:
+            tx_hashes = set()
+            for tx_hash, value_delta in value_deltas:
+                self._value_deltas[tx_hash] = self._value_deltas.get(tx_hash, 0) + value_delta
+                tx_hashes.add(tx_hash)
+            self.update_transactions(tx_hashes)
+
+    def remove_transaction(self, tx_hash: bytes) -> None:
+        with self._lock:
+            if self._value_deltas.pop(tx_hash, None) is not None:
+                self._remove_line(tx_hash)
+
+    def update_transactions(self, tx_hashes: Iterable[bytes]) -> None:
+        "Reposition the given transactions, for when their heights may have changed."
+        with self._lock:
+            for tx_hash in tx_hashes:
+                value_delta = self._value_deltas.get(tx_hash)
+                if value_delta is None:
+                    continue
+                line = self._make_line(tx_hash, value_delta)
+                if line == self._lines.get(tx_hash):
+                    continue
+                self._remove_line(tx_hash)
+                if line is not None:
+                    entry = (line.sort_key, tx_hash)
+                    index = bisect.bisect_left(self._entries, entry)
+                    self._entries.insert(index, entry)
+                    self._lines[tx_hash] = line
+                    self._valid_count = min(self._valid_count, index)
+
+    def get_page(self, cursor: Optional[HistoryCursor]=None, limit: int=100) \
+            -> Tuple[List[Tuple[HistoryLine, int]], Optional[HistoryCursor]]:
+        """
+        Get up to `limit` entries with their balances, newest first, starting after `cursor`.
+        Returns the page and the cursor for the next page, which is `None` at the end.
+        """
+        with self._lock:
+            end_index = len(self._entries) if cursor is None else \
+                bisect.bisect_left(self._entries, cursor)
+            start_index = max(0, end_index - limit)
+            self._update_balances(end_index)
+            page = [ (self._lines[self._entries[i][1]], self._balances[i])
+                for i in range(end_index-1, start_index-1, -1) ]
+            return page, (self._entries[start_index] if start_index > 0 else None)
+
+    def _make_line(self, tx_hash: bytes, value_delta: int) -> Optional[HistoryLine]:
+        metadata = self._get_metadata(tx_hash)
+        # Signed but not cleared.
+        if metadata is None or metadata.height is None:
+            return None
+        sort_key = self.get_sort_key(metadata.height, metadata.position)
+        return HistoryLine(sort_key, tx_hash, metadata.height, value_delta)
+
+    def _remove_line(self, tx_hash: bytes) -> None:
+        line = self._lines.pop(tx_hash, None)
+        if line is not None:
+            index = bisect.bisect_left(self._entries, (line.sort_key, tx_hash))
+            del self._entries[index]
+            self._valid_count = min(self._valid_count, index)
+
+    def _update_balances(self, end_index: int) -> None:
+        # Changes are almost always to the newest entries, so little is recalculated.
+        if self._valid_count >= end_index:
+            return
+        del self._balances[self._valid_count:]
+        balance = self._balances[-1] if self._balances else 0
+        for i in range(self._valid_count, end_index):
+            balance += self._lines[self._entries[i][1]].value_delta
+            self._balances.append(balance)
+        self._valid_count = end_index
+
+
 def dust_threshold(network):
     return 546 # hard-coded Bitcoin SV dust threshold. Was changed to this as of Sept. 2018
 
 CachedScriptType = Tuple[Script, bytes, Optional[ScriptTemplate]]
 
+# The indexes of the totals maintained for account balances.
+BALANCE_CONFIRMED = 0
+BALANCE_UNCONFIRMED = 1
+BALANCE_IMMATURE = 2
+
 T = TypeVar('T', bound='AbstractAccount')
 
 class AbstractAccount:
@@ -210,6 +351,13 @@ class AbstractAccount:
         self._network = None
 
         self._script_cache: Dict[Tuple[int, ScriptType], CachedScriptType] = {}
+        # The script data and script hash of each derived script, as stored in the database.
+        self._stored_scripts: Dict[Tuple[int, ScriptType], Tuple[bytes, bytes]] = {}
+        # The script bytes of each cached script, mapped to the key and script type it is for.
+        self._script_keys: Dict[bytes, Tuple[int, ScriptType]] = {}
+        # Spent outpoints of transactions in the history of our keys for which we have not yet
+        # processed the spent output, mapped to the hash of the spending transaction.
+        self._unmatched_spends: Dict[Tuple[bytes, int], bytes] = {}
 
         # For synchronization.
         self._activated_keys: List[int] = []
@@ -231,6 +379,8 @@ class AbstractAccount:
         self._utxos: Dict[Tuple[bytes, int], UTXO] = {}
         self._utxos_lock = threading.RLock()
         self._stxos: Dict[Tuple[bytes, int], int] = {}
+        # The running balance totals are maintained under the UTXO lock.
+        self._reset_balances()
         self._keypath: Dict[int, Sequence[int]] = {}
         self._keyinstances: Dict[int, KeyInstanceRow] = { r.keyinstance_id: r for r
             in keyinstance_rows }
@@ -242,6 +392,7 @@ class AbstractAccount:
         self._script_txos: Dict[str, Dict[bytes, Set[int]]] = {}
 
         self._load_keys(keyinstance_rows)
+        self._load_scripts()
         self._load_txos(output_rows)
         self._load_payment_requests()
 
@@ -371,7 +522,7 @@ class AbstractAccount:
         # Flush the associated UTXO state and account state from memory.
         with self._utxos_lock:
             for utxo in self.get_key_utxos(key_id):
-                del self._utxos[utxo.key()]
+                self._discard_utxo(utxo.key())
         self._unload_keys([ key_id ])
         return True
 
@@ -398,6 +549,11 @@ class AbstractAccount:
     def get_possible_scripts_for_id(self, keyinstance_id: int) -> List[Script]:
         raise NotImplementedError
 
+    def get_possible_scripts_for_ids(self,
+            keyinstance_ids: Sequence[int]) -> List[Tuple[int, ScriptType, Script]]:
+        return [ (keyinstance_id, script_type, script) for keyinstance_id in keyinstance_ids
+            for script_type, script in self.get_possible_scripts_for_id(keyinstance_id) ]
+
     def get_script_for_id(self, keyinstance_id: int,
             script_type: Optional[ScriptType]=None) -> Script:
         script_template = self.get_script_template_for_id(keyinstance_id, script_type)
@@ -464,7 +620,35 @@ class AbstractAccount:
         return self._wallet._transaction_cache.have_transaction_data(tx_hash)
 
     def get_transaction(self, tx_hash: bytes, flags: Optional[int]=None) -> Optional[Transaction]:
-        return self._wallet._transaction_cache.get_transaction(tx_hash, flags)
+        # The caller may modify the transaction, so it is given a copy rather than the shared one
+        # from the transaction object cache.
+        results = self._wallet._transaction_cache.get_transactions(flags, tx_hashes=[ tx_hash ])
+        if len(results):
+            return results[0][1]
+        return None
+
+    def is_transaction_pruned(self, tx_hash: bytes) -> bool:
+        flags = self._wallet._transaction_cache.get_flags(tx_hash)
+        return flags is not None and (flags & TxFlags.PrunedByteData) != 0
+
+    def fetch_pruned_transaction(self, tx_hash: bytes) -> Optional[Transaction]:
+        """
+        Fetch a pruned transaction from the network for display. It is not stored again, as it
+        would only be pruned again. This blocks until the server responds.
+        """
+        # The request is made on the event loop, which would never get to it if it were blocked.
+        assert threading.current_thread() is not app_state.async_.thread, \
+            "fetching pruned transactions on the event loop would deadlock"
+        if self._network is None or not self.is_transaction_pruned(tx_hash):
+            return None
+        tx_hex = self._network.request_and_wait('blockchain.transaction.get',
+            [ hash_to_hex_str(tx_hash) ])
+        tx = Transaction.from_hex(tx_hex)
+        if tx.hash() != tx_hash:
+            self._logger.error("fetched transaction %s does not match",
+                hash_to_hex_str(tx_hash))
+            return None
+        return tx
 
     def get_transaction_entry(self, tx_hash: bytes, flags: Optional[int]=None,
             mask: Optional[int]=None) -> Optional[TransactionCacheEntry]:
@@ -512,9 +696,14 @@ class AbstractAccount:
         with TransactionDeltaTable(self._wallet._db_context) as table:
             rows = table.read_history(self._id)
 
+        self._history = AccountHistory(self._wallet._transaction_cache.get_metadata)
+        self._history.load(rows)
+
         key_history: Dict[int, List[Tuple[str, int]]] = {}
         maximum_position = 0
         positions: Dict[str, int] = {}
+        # The spends of transactions processed in earlier sessions are indexed on demand.
+        self._unindexed_spend_tx_hashes: Set[bytes] = set(row[0] for row in rows)
         for tx_hash, _value_delta, keyinstance_id in rows:
             metadata = cast(TxData, self.get_transaction_metadata(tx_hash))
             if metadata.height is not None:
@@ -538,28 +727,53 @@ class AbstractAccount:
             entries.sort(key=lambda v: (v[1], positions.get(v[0], maximum_position+1)))
             self._sync_state.set_key_history(keyinstance_id, entries)
 
+        # The history rebuilt from the database may not be in the order the server gives, or
+        # may lack transactions that are yet to be fetched. The status of the history last
+        # received from the server is what resubscribing compares against.
+        with KeyInstanceScriptTable(self._wallet._db_context) as table:
+            for keyinstance_id, status_bytes in table.read_statuses(self._id):
+                self._sync_state.set_key_status(keyinstance_id, status_bytes.hex())
+
     def _load_keys(self, keyinstance_rows: List[KeyInstanceRow]) -> None:
         pass
 
+    def _load_scripts(self) -> None:
+        self._stored_scripts.clear()
+        with KeyInstanceScriptTable(self._wallet._db_context) as table:
+            for row in table.read(self._id):
+                self._stored_scripts[(row.keyinstance_id, row.script_type)] = \
+                    row.script_data, row.script_hash
+
+    def _store_scripts(self, rows: List[KeyInstanceScriptRow]) -> None:
+        for row in rows:
+            self._stored_scripts[(row.keyinstance_id, row.script_type)] = \
+                row.script_data, row.script_hash
+        self._wallet.create_keyinstance_scripts(rows)
+
     def _load_txos(self, output_rows: List[TransactionOutputRow]) -> None:
         self._stxos.clear()
-        self._utxos.clear()
+        with self._utxos_lock:
+            self._utxos.clear()
+            self._reset_balances()
         self._frozen_coins: Set[Tuple[bytes, int]] = set([])
 
+        new_script_rows: List[KeyInstanceScriptRow] = []
         for row in output_rows:
             txo_key = row.tx_hash, row.tx_index
             if row.flags & TransactionOutputFlag.IS_SPENT:
                 self._stxos[txo_key] = row.keyinstance_id
             else:
                 keyinstance = self._keyinstances[row.keyinstance_id]
-                script_template = self.get_script_template_for_id(row.keyinstance_id)
+                script, _script_bytes, address = self._get_cached_script(row.keyinstance_id,
+                    self.get_script_type_for_id(row.keyinstance_id), new_script_rows)
                 metadata = self._wallet._transaction_cache.get_metadata(row.tx_hash)
                 flags = row.flags
                 if metadata.position==0:
                     flags |= TransactionOutputFlag.IS_COINBASE
-                address = script_template if isinstance(script_template, Address) else None
                 self.register_utxo(row.tx_hash, row.tx_index, row.value, flags,
-                    keyinstance, script_template.to_script(), address)
+                    keyinstance, script, address)
+        if len(new_script_rows):
+            self._store_scripts(new_script_rows)
 
     def register_utxo(self, tx_hash: bytes, output_index: int, value: int,
             flags: TransactionOutputFlag, keyinstance: KeyInstanceRow,
@@ -567,7 +781,7 @@ class AbstractAccount:
         is_coinbase = (flags & TransactionOutputFlag.IS_COINBASE) != 0
         utxo_key = (tx_hash, output_index)
         with self._utxos_lock:
-            self._utxos[utxo_key] = UTXO(
+            utxo = self._utxos[utxo_key] = UTXO(
                 value=value,
                 script_pubkey=script,
                 script_type=keyinstance.script_type,
@@ -577,8 +791,15 @@ class AbstractAccount:
                 flags=flags,
                 address=address,
                 is_coinbase=is_coinbase)
-        if flags & TransactionOutputFlag.IS_FROZEN:
-            self._frozen_coins.add(utxo_key)
+            if flags & TransactionOutputFlag.IS_FROZEN:
+                self._frozen_coins.add(utxo_key)
+            self._add_utxo_balance(utxo)
+
+    # Should be called with the UTXO lock.
+    def _discard_utxo(self, utxo_key: Tuple[bytes, int]) -> UTXO:
+        utxo = self._utxos.pop(utxo_key)
+        self._remove_utxo_balance(utxo)
+        return utxo
 
     # Should be called with the transaction lock.
     def create_transaction_output(self, tx_hash: bytes, output_index: int, value: int,
@@ -757,39 +978,83 @@ class AbstractAccount:
         return PrivateKey(secret).to_WIF(compressed=compressed, coin=Net.COIN)
 
     # Called by network.
-    def add_verified_tx(self, tx_hash: bytes, height: int, timestamp: int, position: int,
+    async def add_verified_tx(self, tx_hash: bytes, height: int, timestamp: int, position: int,
             proof_position: int, proof_branch: Sequence[bytes]) -> None:
-        tx_id = hash_to_hex_str(tx_hash)
+        await self.add_verified_txs([ (tx_hash, height, timestamp, position, proof_position,
+            proof_branch) ])
+
+    # Called by network.
+    async def add_verified_txs(self,
+            verifications: List[Tuple[bytes, int, int, int, int, Sequence[bytes]]]) -> None:
+        """
+        Settle a group of transactions with verified proofs. Each verification is the
+        transaction hash, block height, block timestamp, block position, proof position and
+        proof branch. The changes for all of the transactions are committed in one write.
+        """
         if self._stopped:
-            self._logger.debug("add_verified_tx on stopped wallet: %s", tx_id)
+            self._logger.debug("add_verified_txs on stopped wallet: %d transactions",
+                len(verifications))
             return
-        entry = self._wallet._transaction_cache.get_entry(tx_hash, TxFlags.StateCleared) # HasHeight
-
-        # Ensure we are not verifying transactions multiple times.
-        if entry is None:
-            # We have proof now so regardless what TxState is, we can 'upgrade' it to StateSettled.
-            # This rests on the commitment that any of the following four tx States *will*
-            # Have tx bytedata i.e. "HasByteData" flag is set.
-            entry = self._wallet._transaction_cache.get_entry(tx_hash, TxFlags.STATE_UNCLEARED_MASK)
-            if entry.flags & TxFlags.HasByteData != 0:
-                self._logger.debug("Fast_tracking entry to StateSettled: %r", entry)
-            else:
-                self._logger.error("Transaction bytedata absent for %s %r", tx_id, entry)
-                return
 
-        # We only update a subset.
-        flags = TxFlags.HasHeight | TxFlags.HasPosition
-        data = TxData(height=height, position=position)
-        self._wallet._transaction_cache.update(
-            [ (tx_hash, data, None, flags | TxFlags.StateSettled) ])
+        # Wait for the writer to work through its backlog, if it has fallen behind, before
+        # adding to it.
+        await self._wallet._db_context.throttle_writes()
+
+        cache_verifications: List[Tuple[bytes, int, int, TxProof]] = []
+        for tx_hash, height, timestamp, position, proof_position, proof_branch in verifications:
+            tx_id = hash_to_hex_str(tx_hash)
+            flags = self._wallet._transaction_cache.get_flags(tx_hash)
+            # Ensure we are not verifying transactions multiple times.
+            if flags is None or flags & TxFlags.StateSettled:
+                self._logger.debug("add_verified_txs skipping unknown or settled %s", tx_id)
+                continue
+            if flags & TxFlags.StateCleared == 0:
+                # We have proof now so regardless what TxState is, we can 'upgrade' it to
+                # StateSettled. This rests on the commitment that any of the following four tx
+                # States *will* Have tx bytedata i.e. "HasByteData" flag is set.
+                if flags & TxFlags.HasByteData != 0:
+                    self._logger.debug("Fast_tracking entry to StateSettled: %s %s", tx_id,
+                        TxFlags.to_repr(flags))
+                else:
+                    self._logger.error("Transaction bytedata absent for %s %s", tx_id,
+                        TxFlags.to_repr(flags))
+                    continue
+            cache_verifications.append((tx_hash, height, position,
+                TxProof(proof_position, proof_branch)))
+
+        if not len(cache_verifications):
+            return
+        completion_callback = AsyncCompletionCallback()
+        self._wallet._transaction_cache.update_verifications(cache_verifications,
+            completion_callback)
+
+        verified_hashes = set(t[0] for t in cache_verifications)
+        self._update_transaction_balances(verified_hashes)
+        self._history.update_transactions(verified_hashes)
+        if not await self._wait_for_write(completion_callback):
+            return
+        self._wallet._prune_wanted = True
 
-        proof = TxProof(proof_position, proof_branch)
-        self._wallet._transaction_cache.update_proof(tx_hash, proof)
+        for tx_hash, _height, timestamp, _position, _proof_position, _proof_branch \
+                in verifications:
+            if tx_hash not in verified_hashes:
+                continue
+            height, conf, _timestamp = self.get_tx_height(tx_hash)
+            self._logger.debug("add_verified_tx %d %d %d", height, conf, timestamp)
+            cast('Network', self._network).trigger_callback(
+                'verified', self._wallet.get_storage_path(), tx_hash, height, conf, timestamp)
 
-        height, conf, _timestamp = self.get_tx_height(tx_hash)
-        self._logger.debug("add_verified_tx %d %d %d", height, conf, timestamp)
-        cast('Network', self._network).trigger_callback(
-            'verified', self._wallet.get_storage_path(), tx_hash, height, conf, timestamp)
+    async def _wait_for_write(self, completion_callback: AsyncCompletionCallback) -> bool:
+        """
+        Wait for the write given the completion callback to be committed. As writes are
+        committed in order, so will all the writes queued before it. The writer has already
+        logged any failure, so the caller only needs to know whether to carry on.
+        """
+        try:
+            await completion_callback.future
+        except Exception:
+            return False
+        return True
 
     def undo_verifications(self, above_height):
         '''Called by network when a reorg has happened'''
@@ -800,6 +1065,9 @@ class AbstractAccount:
         with self.lock:
             reorg_count = self._wallet._transaction_cache.apply_reorg(above_height)
             self._logger.info(f'removing verification of {reorg_count} transactions')
+            # Reorgs are rare enough that the balances can be recalculated from scratch.
+            self._recalculate_balances()
+            self._history.rebuild()
 
     def get_tx_height(self, tx_hash: bytes) -> Tuple[int, int, Union[int, bool]]:
         """ return the height and timestamp of a verified transaction. """
@@ -829,7 +1097,7 @@ class AbstractAccount:
     def set_utxo_spent(self, tx_hash: bytes, output_index: int) -> None:
         with self._utxos_lock:
             txo_key = (tx_hash, output_index)
-            utxo = self._utxos.pop(txo_key)
+            utxo = self._discard_utxo(txo_key)
         retained_flags = utxo.flags & TransactionOutputFlag.IS_COINBASE
         self._wallet.update_transactionoutput_flags(
             [ (retained_flags | TransactionOutputFlag.IS_SPENT, tx_hash, output_index)  ])
@@ -844,6 +1112,10 @@ class AbstractAccount:
     def get_utxo(self, tx_hash: bytes, output_index: int) -> Optional[UTXO]:
         return self._utxos.get((tx_hash, output_index), None)
 
+    def get_unspent_tx_hashes(self) -> Set[bytes]:
+        with self._utxos_lock:
+            return set(tx_hash for (tx_hash, _output_index) in self._utxos)
+
     def get_spendable_coins(self, domain: Optional[List[int]], config, isInvoice = False):
         confirmed_only = config.get('confirmed_only', False)
         if isInvoice:
@@ -876,13 +1148,95 @@ class AbstractAccount:
             return [ key_id for (key_id, key) in self._keyinstances.items()
                 if key.flags & KeyInstanceFlag.IS_ACTIVE ]
 
+    # Should be called with the UTXO lock.
+    def _reset_balances(self) -> None:
+        # The confirmed, unconfirmed and immature totals, indexed by the BALANCE_* values.
+        self._balance_totals = [ 0, 0, 0 ]
+        self._frozen_balance_totals = [ 0, 0, 0 ]
+        self._utxo_balance_categories: Dict[Tuple[bytes, int], int] = {}
+        self._utxo_keys_by_tx: Dict[bytes, Set[Tuple[bytes, int]]] = {}
+        # A heap of the heights at which immature coinbase outputs mature.
+        self._maturity_schedule: List[Tuple[int, Tuple[bytes, int]]] = []
+        self._balance_local_height = self._wallet.get_local_height()
+
+    # Should be called with the UTXO lock.
+    def _add_utxo_balance(self, utxo: UTXO) -> None:
+        utxo_key = utxo.key()
+        metadata = self._wallet._transaction_cache.get_metadata(utxo.tx_hash)
+        height = metadata.height if metadata is not None and metadata.height is not None else 0
+        if utxo.is_coinbase and height + COINBASE_MATURITY > self._balance_local_height:
+            category = BALANCE_IMMATURE
+            heapq.heappush(self._maturity_schedule, (height + COINBASE_MATURITY, utxo_key))
+        elif height > 0:
+            category = BALANCE_CONFIRMED
+        else:
+            category = BALANCE_UNCONFIRMED
+        self._utxo_balance_categories[utxo_key] = category
+        self._utxo_keys_by_tx.setdefault(utxo.tx_hash, set()).add(utxo_key)
+        self._balance_totals[category] += utxo.value
+        if utxo_key in self._frozen_coins:
+            self._frozen_balance_totals[category] += utxo.value
+
+    # Should be called with the UTXO lock.
+    def _remove_utxo_balance(self, utxo: UTXO) -> None:
+        utxo_key = utxo.key()
+        # Any maturity schedule entry is discarded when it is reached.
+        category = self._utxo_balance_categories.pop(utxo_key)
+        tx_keys = self._utxo_keys_by_tx[utxo.tx_hash]
+        tx_keys.remove(utxo_key)
+        if not tx_keys:
+            del self._utxo_keys_by_tx[utxo.tx_hash]
+        self._balance_totals[category] -= utxo.value
+        if utxo_key in self._frozen_coins:
+            self._frozen_balance_totals[category] -= utxo.value
+
+    def _update_transaction_balances(self, tx_hashes: Iterable[bytes]) -> None:
+        "Recategorise the UTXOs of transactions whose height may have changed."
+        with self._utxos_lock:
+            for tx_hash in tx_hashes:
+                for utxo_key in list(self._utxo_keys_by_tx.get(tx_hash, ())):
+                    utxo = self._utxos[utxo_key]
+                    self._remove_utxo_balance(utxo)
+                    self._add_utxo_balance(utxo)
+
+    def _recalculate_balances(self) -> None:
+        with self._utxos_lock:
+            self._reset_balances()
+            for utxo in self._utxos.values():
+                self._add_utxo_balance(utxo)
+
+    # Should be called with the UTXO lock.
+    def _mature_balances(self) -> None:
+        local_height = self._wallet.get_local_height()
+        if local_height < self._balance_local_height:
+            # The local height only goes down if the headers are replaced, so start over.
+            self._recalculate_balances()
+            return
+        self._balance_local_height = local_height
+        schedule = self._maturity_schedule
+        while schedule and schedule[0][0] <= local_height:
+            _maturity_height, utxo_key = heapq.heappop(schedule)
+            if self._utxo_balance_categories.get(utxo_key) == BALANCE_IMMATURE:
+                utxo = self._utxos[utxo_key]
+                self._remove_utxo_balance(utxo)
+                self._add_utxo_balance(utxo)
+
     def get_frozen_balance(self) -> Tuple[int, int, int]:
-        return self.get_balance(self._frozen_coins)
+        with self._utxos_lock:
+            self._mature_balances()
+            c, u, x = self._frozen_balance_totals
+            return c, u, x
 
     def get_balance(self, domain=None, exclude_frozen_coins: bool=False) -> Tuple[int, int, int]:
         with self._utxos_lock:
             if domain is None:
-                domain = set(self._utxos.keys())
+                self._mature_balances()
+                c, u, x = self._balance_totals
+                if exclude_frozen_coins:
+                    fc, fu, fx = self._frozen_balance_totals
+                    return c - fc, u - fu, x - fx
+                return c, u, x
+
             c = u = x = 0
             for k in domain:
                 if exclude_frozen_coins and k in self._frozen_coins:
@@ -919,10 +1273,40 @@ class AbstractAccount:
             self._wallet._transaction_cache.add_transaction(tx, flag, _completion_callback)
             self._process_key_usage(tx_hash, tx, None)
 
+    # Called by network.
+    async def add_transactions(self, txs: List[Tuple[bytes, bytes, Transaction]],
+            flag: TxFlags) -> None:
+        """
+        Add a group of fetched transactions, given as hash, bytes and parsed transaction. The
+        transaction data is committed in one write.
+        """
+        if self._stopped:
+            self._logger.debug("add_transactions on stopped wallet: %d transactions", len(txs))
+            return
+
+        await self._wallet._db_context.throttle_writes()
+
+        completion_callback = AsyncCompletionCallback()
+        with self.transaction_lock:
+            self._logger.debug("adding tx data for %d transactions (flags: %s)", len(txs),
+                TxFlags.to_repr(flag))
+            self._wallet._transaction_cache.add_transactions(
+                [ (tx_hash, tx_bytes) for (tx_hash, tx_bytes, _tx) in txs ], flag,
+                completion_callback)
+            for tx_hash, _tx_bytes, tx in txs:
+                self._process_key_usage(tx_hash, tx, None)
+
+        if not await self._wait_for_write(completion_callback):
+            return
+
+        for tx_hash, _tx_bytes, _tx in txs:
+            self._wallet.trigger_callback('transaction_added',
+                self._wallet.get_storage_path(), self._id, tx_hash)
+
     def set_transaction_state(self, tx_hash: bytes, flags: TxFlags) -> None:
         """ raises UnknownTransactionException """
         with self.transaction_lock:
-            if not self._wallet._transaction_cache.is_cached(tx_hash):
+            if self._wallet._transaction_cache.get_flags(tx_hash) is None:
                 raise UnknownTransactionException(f"tx {hash_to_hex_str(tx_hash)} unknown")
             existing_flags = self._wallet._transaction_cache.get_flags(tx_hash)
             updated_flags = self._wallet._transaction_cache.update_flags(tx_hash, flags)
@@ -934,20 +1318,109 @@ class AbstractAccount:
         with self.transaction_lock:
             self._process_key_usage(tx_hash, tx, relevant_txos)
 
-    def _get_cached_script(self, keyinstance_id: int) -> CachedScriptType:
-        keyinstance = self.get_keyinstance(keyinstance_id)
-        script_type = keyinstance.script_type
+    def _get_cached_script(self, keyinstance_id: int, script_type: Optional[ScriptType]=None,
+            new_script_rows: Optional[List[KeyInstanceScriptRow]]=None) -> CachedScriptType:
+        """
+        Get the script for the key, preferring the stored script over deriving it. Newly derived
+        scripts are added to `new_script_rows` for the caller to store, or stored immediately
+        if it is not given.
+        """
+        if script_type is None:
+            script_type = self.get_keyinstance(keyinstance_id).script_type
         assert script_type != ScriptType.NONE, "key_id=%s has ScriptType.NONE" % keyinstance_id
         cache_key = (keyinstance_id, script_type)
         cache_value = self._script_cache.get(cache_key)
         if cache_value is None:
-            script_template = self.get_script_template_for_id(keyinstance_id, script_type)
+            stored_script = self._stored_scripts.get(cache_key)
+            if stored_script is not None:
+                script = Script(stored_script[0])
+                script_template = classify_output_script(script, Net.COIN)
+            else:
+                script_template = self.get_script_template_for_id(keyinstance_id, script_type)
+                script = script_template.to_script()
+                rows = [ KeyInstanceScriptRow(keyinstance_id, script_type,
+                    scripthash_bytes(script), bytes(script)) ]
+                if new_script_rows is None:
+                    self._store_scripts(rows)
+                else:
+                    new_script_rows.extend(rows)
             address = script_template if isinstance(script_template, Address) else None
-            script = script_template.to_script()
             cache_value = script, bytes(script), address
             self._script_cache[cache_key] = cache_value
+            self._script_keys[cache_value[1]] = cache_key
         return cache_value
 
+    def get_possible_script_hashes(self,
+            keyinstance_ids: Iterable[int]) -> List[Tuple[int, ScriptType, bytes]]:
+        """
+        Get the script hash of every valid script type for each of the given keys, as used to
+        subscribe to them. Stored script hashes are used, and only missing ones are derived.
+        """
+        script_types = self.get_valid_script_types()
+        results: List[Tuple[int, ScriptType, bytes]] = []
+        missing_keyinstance_ids: List[int] = []
+        for keyinstance_id in keyinstance_ids:
+            stored_scripts = [ self._stored_scripts.get((keyinstance_id, script_type))
+                for script_type in script_types ]
+            if all(stored_scripts):
+                results.extend((keyinstance_id, script_type, stored_script[1])
+                    for script_type, stored_script in zip(script_types, stored_scripts))
+            else:
+                missing_keyinstance_ids.append(keyinstance_id)
+        if len(missing_keyinstance_ids):
+            new_script_rows: List[KeyInstanceScriptRow] = []
+            for keyinstance_id, script_type, script in \
+                    self.get_possible_scripts_for_ids(missing_keyinstance_ids):
+                script_hash = scripthash_bytes(script)
+                new_script_rows.append(KeyInstanceScriptRow(keyinstance_id, script_type,
+                    script_hash, bytes(script)))
+                results.append((keyinstance_id, script_type, script_hash))
+            self._store_scripts(new_script_rows)
+        return results
+
+    def _match_script(self, script_bytes: bytes) -> Optional[int]:
+        cache_key = self._script_keys.get(script_bytes)
+        if cache_key is None:
+            return None
+        keyinstance_id, script_type = cache_key
+        # A key that has since had its script type reset no longer matches its old script.
+        if self._keyinstances[keyinstance_id].script_type != script_type:
+            return None
+        return keyinstance_id
+
+    # Should be called with the transaction lock.
+    def _add_unmatched_spend(self, txo_key: Tuple[bytes, int], spend_tx_hash: bytes) -> None:
+        # Only the outputs of transactions in the history of our keys can be matched later. The
+        # spends of any other outputs, which most inputs of most transactions are, are not kept.
+        # If the spent transaction joins the history of a key, the spending transaction will be
+        # in that history after it and be processed again.
+        if self._sync_state.get_transaction_key_ids(hash_to_hex_str(txo_key[0])):
+            self._unmatched_spends[txo_key] = spend_tx_hash
+
+    # Should be called with the transaction lock.
+    def _index_unmatched_spends(self, tx_hash: bytes, tx: Transaction) -> None:
+        self._unindexed_spend_tx_hashes.discard(tx_hash)
+        for txin in tx.inputs:
+            txo_key = (txin.prev_hash, txin.prev_idx)
+            if txo_key not in self._stxos and txo_key not in self._utxos:
+                self._add_unmatched_spend(txo_key, tx_hash)
+
+    # Should be called with the transaction lock.
+    def _pop_spending_tx_hash(self, tx_hash: bytes, output_index: int,
+            keyinstance_id: int) -> Optional[bytes]:
+        # Transactions loaded with the account are indexed the first time an output of one of
+        # their keys is processed.
+        if self._unindexed_spend_tx_hashes:
+            for spend_tx_id, _height in self._sync_state.get_key_history(keyinstance_id):
+                spend_tx_hash = hex_str_to_hash(spend_tx_id)
+                if spend_tx_hash not in self._unindexed_spend_tx_hashes or \
+                        spend_tx_hash == tx_hash:
+                    continue
+                spend_tx = self._wallet._transaction_cache.get_transaction(spend_tx_hash)
+                if spend_tx is not None:
+                    self._index_unmatched_spends(spend_tx_hash, spend_tx)
+        return self._unmatched_spends.pop((tx_hash, output_index), None)
+
     # def _process_key_usage(self, tx_hash: bytes, tx: Transaction) -> None:
     #     import cProfile, pstats, io
     #     from pstats import SortKey
@@ -964,9 +1437,10 @@ class AbstractAccount:
     def _process_key_usage(self, tx_hash: bytes, tx: Transaction,
             relevant_txos: Optional[List[Tuple[int, XTxOutput]]]) -> None:
         tx_id = hash_to_hex_str(tx_hash)
+        # Ensure the scripts of the keys the transaction is known to use are indexed.
         key_ids = self._sync_state.get_transaction_key_ids(tx_id)
-        key_matches = [(self.get_keyinstance(key_id),
-            *self._get_cached_script(key_id)) for key_id in key_ids]
+        for key_id in key_ids:
+            self._get_cached_script(key_id)
 
         tx_deltas: Dict[Tuple[bytes, int], int] = defaultdict(int)
         new_txos: List[Tuple[bytes, int, int, TransactionOutputFlag, KeyInstanceRow,
@@ -979,44 +1453,35 @@ class AbstractAccount:
             if keyinstance_id is not None:
                 continue
 
-            output_bytes = bytes(output.script_pubkey)
-            for keyinstance, script, script_bytes, address in key_matches:
-                if script_bytes == output_bytes:
-                    break
-            else:
+            # Only the keys that have the transaction in their history are matched.
+            keyinstance_id = self._match_script(bytes(output.script_pubkey))
+            if keyinstance_id is None or keyinstance_id not in key_ids:
+                # Any spend of this output is not of ours, and will not be matched.
+                self._unmatched_spends.pop((tx_hash, output_index), None)
                 continue
+            keyinstance = self.get_keyinstance(keyinstance_id)
+            script, _script_bytes, address = self._get_cached_script(keyinstance_id)
 
-            # Search the known candidates to see if we already have this txo's spending input.
+            # Check if we already have this txo's spending input.
             txo_flags = TransactionOutputFlag.NONE
-            for spend_tx_id, _height in self._sync_state.get_key_history(
-                    keyinstance.keyinstance_id):
-                if spend_tx_id == tx_id:
-                    continue
-                spend_tx_hash = hex_str_to_hash(spend_tx_id)
-                spend_tx = self._wallet._transaction_cache.get_transaction(spend_tx_hash)
-                if spend_tx is None:
-                    continue
-                for spend_txin in spend_tx.inputs:
-                    if spend_txin.prev_hash == tx_hash and spend_txin.prev_idx == output_index:
-                        break
-                else:
-                    continue
-
-                tx_deltas[(spend_tx_hash, keyinstance.keyinstance_id)] -= output.value
+            spend_tx_hash = self._pop_spending_tx_hash(tx_hash, output_index, keyinstance_id)
+            if spend_tx_hash is not None:
+                tx_deltas[(spend_tx_hash, keyinstance_id)] -= output.value
                 txo_flags = TransactionOutputFlag.IS_SPENT
-                break
 
             # TODO(rt12) BACKLOG batch create the outputs.
             self.create_transaction_output(tx_hash, output_index, output.value,
                 txo_flags, keyinstance, script, address)
             tx_deltas[(tx_hash, keyinstance.keyinstance_id)] += output.value
 
+        self._unindexed_spend_tx_hashes.discard(tx_hash)
         for input_index, input in enumerate(tx.inputs):
             keyinstance_id = self.get_stxo(input.prev_hash, input.prev_idx)
             if keyinstance_id is not None:
                 continue
             utxo = self.get_utxo(input.prev_hash, input.prev_idx)
             if utxo is None:
+                self._add_unmatched_spend((input.prev_hash, input.prev_idx), tx_hash)
                 continue
 
             self.set_utxo_spent(input.prev_hash, input.prev_idx)
@@ -1025,6 +1490,7 @@ class AbstractAccount:
         if len(tx_deltas):
             self._wallet.create_or_update_transactiondelta_relative(
                 [ TransactionDeltaRow(k[0], k[1], v) for k, v in tx_deltas.items() ])
+            self._history.add_value_deltas((k[0], v) for k, v in tx_deltas.items())
 
         if len(tx_deltas):
             affected_keys = [self._keyinstances[k] for (_x, k) in tx_deltas.keys()]
@@ -1043,6 +1509,7 @@ class AbstractAccount:
         with self.transaction_lock:
             self._logger.debug("removing tx from history %s", tx_id)
             self._remove_transaction(tx_hash)
+            self._history.remove_transaction(tx_hash)
             self._logger.debug("deleting tx from cache and datastore: %s", tx_id)
             self._wallet._transaction_cache.delete(tx_hash, _completion_callback)
 
@@ -1069,19 +1536,22 @@ class AbstractAccount:
             with TransactionOutputTable(self._wallet._db_context) as table:
                 output_rows = table.read()
 
+            self._unindexed_spend_tx_hashes.discard(tx_hash)
             for input_index, txin in enumerate(tx.inputs):
                 txo_key = (txin.prev_hash, txin.prev_idx)
+                if self._unmatched_spends.get(txo_key) == tx_hash:
+                    del self._unmatched_spends[txo_key]
                 if txo_key in self._stxos:
                     spent_keyinstance_id = self._stxos.pop(txo_key)
-                    # This may incur database read latency, but deletion should be uncommon.
-                    spent_tx = self._wallet._transaction_cache.get_transaction(txin.prev_hash)
-                    spent_value = spent_tx.outputs[txin.prev_idx].value
                     # Need to set the TXO to non-spent.s
                     # tx_deltas[(txin.prev_hash, spent_keyinstance_id)] = spent_value
 
                     # TODO(rt12) BACKLOG lookup the existing flags less painfully.
-                    txo_flags = [ row for row in output_rows if row.tx_hash == txin.prev_hash
-                        and row.tx_index == txin.prev_idx ][0].flags
+                    output_row = [ row for row in output_rows if row.tx_hash == txin.prev_hash
+                        and row.tx_index == txin.prev_idx ][0]
+                    # The spent transaction may have been pruned, but the output has the value.
+                    spent_value = output_row.value
+                    txo_flags = output_row.flags
                     txo_flags &= ~TransactionOutputFlag.IS_SPENT
                     spent_keyinstance = self._keyinstances[spent_keyinstance_id]
                     script_template = self.get_script_template_for_id(spent_keyinstance_id,
@@ -1103,7 +1573,7 @@ class AbstractAccount:
                 self._keyinstances[utxo.keyinstance_id] = key
                 # Expunge the UTXO.
                 with self._utxos_lock:
-                    del self._utxos[(utxo.tx_hash, utxo.out_index)]
+                    self._discard_utxo((utxo.tx_hash, utxo.out_index))
 
             if len(txout_flags):
                 self._wallet.update_transactionoutput_flags(txout_flags)
@@ -1127,6 +1597,33 @@ class AbstractAccount:
         #     f"past, and will ignore it for now. Please report it.")
         return []
 
+    # Called by network.
+    def get_key_status_priority(self, keyinstance_id: int) -> StatusPriority:
+        keyinstance = self._keyinstances.get(keyinstance_id)
+        if keyinstance is None:
+            return StatusPriority.USED
+        if keyinstance.flags & KeyInstanceFlag.IS_PAYMENT_REQUEST:
+            request = self.get_payment_request_for_keyinstance_id(keyinstance_id)
+            if request is not None and request.state != PaymentState.PAID:
+                return StatusPriority.PAYMENT_REQUEST
+        derivation_path = self.get_derivation_path(keyinstance_id)
+        if derivation_path is not None and tuple(derivation_path[:-1]) == CHANGE_SUBPATH:
+            return StatusPriority.CHANGE
+        if keyinstance.script_type == ScriptType.NONE:
+            return StatusPriority.FRESH
+        return StatusPriority.USED
+
+    # Called by network.
+    def get_key_status(self, keyinstance_id: int, script_type: ScriptType) -> Optional[str]:
+        """
+        The status of the key's history as last received from the server, for comparison with
+        the status given for its script hash in subscription responses and notifications.
+        """
+        keyinstance = self._keyinstances[keyinstance_id]
+        if keyinstance.script_type in (ScriptType.NONE, script_type):
+            return self._sync_state.get_key_status(keyinstance_id)
+        return None
+
     def get_relevant_txos(self, keyinstance_id, tx, tx_id) -> Optional[List[Tuple[int, XTxOutput]]]:
         self.add_tx_to_script_txos(tx_id, tx)
         relevant_indices = self.get_script_txos(tx_id, keyinstance_id)
@@ -1145,6 +1642,8 @@ class AbstractAccount:
             self._logger.debug("set_key_history on stopped wallet: %s", keyinstance_id)
             return
 
+        await self._wallet._db_context.throttle_writes()
+
         update_state_changes = []
         with self.lock:
             self._logger.debug("set_key_history %s %s", keyinstance_id, tx_fees)
@@ -1166,6 +1665,13 @@ class AbstractAccount:
             # The history is in immediately usable order. Transactions are listed in ascending
             # block height (height > 0), followed by the unconfirmed (height == 0) and then
             # those with unconfirmed parents (height < 0). [ (tx_hash, tx_height), ... ]
+            # A pruned transaction that is new to the history of this key has not been processed
+            # for it, and is fetched again to be processed.
+            known_tx_ids = set(t[0] for t in self._sync_state.get_key_history(keyinstance_id))
+            unknown_tx_hashes = [ hex_str_to_hash(tx_id) for tx_id, _tx_height in hist
+                if tx_id not in known_tx_ids ]
+            if len(unknown_tx_hashes):
+                self._wallet._transaction_cache.unprune(unknown_tx_hashes)
             self._sync_state.set_key_history(keyinstance_id, hist)
 
             adds = []
@@ -1201,6 +1707,8 @@ class AbstractAccount:
                 self._wallet._transaction_cache.add(adds)
             if len(updates):
                 self._wallet._transaction_cache.update(updates)
+            self._update_transaction_balances(unique_tx_hashes)
+            self._history.update_transactions(unique_tx_hashes)
 
             for tx_id, tx_height in hist:
                 tx_hash = hex_str_to_hash(tx_id)
@@ -1210,16 +1718,28 @@ class AbstractAccount:
                     relevant_txos = self.get_relevant_txos(keyinstance_id, tx, tx_id)
                     self.process_key_usage(tx_hash, tx, relevant_txos)
 
+            # This is written after the changes above, so that a status is only ever stored
+            # for a history the wallet has recorded.
+            status = self._sync_state.get_key_status(keyinstance_id)
+            completion_callback = AsyncCompletionCallback()
+            self._wallet.update_keyinstance_script_statuses([ (None if status is None
+                else bytes.fromhex(status), keyinstance_id, script_type) ], completion_callback)
+
         if len(update_state_changes):
             wallet_path = self._wallet.get_storage_path()
             for state_change in update_state_changes:
                 self._wallet.trigger_callback('transaction_state_change',
                     wallet_path, self._id, *state_change)
 
+        await self._wait_for_write(completion_callback)
+
         self.txs_changed_event.set()
         await self._trigger_synchronization()
 
     def get_history(self, domain: Optional[Set[int]]=None) -> List[Tuple[HistoryLine, int]]:
+        if domain is None:
+            return self._history.get_page(limit=sys.maxsize)[0]
+
         history_raw: List[HistoryLine] = []
         with TransactionDeltaTable(self._wallet._db_context) as table:
             rows = table.read_history(self._id)
@@ -1234,14 +1754,8 @@ class AbstractAccount:
             # Signed but not cleared.
             if metadata.height is None:
                 continue
-            height, position = metadata.height, metadata.position
-            if position is not None:
-                sort_key = height, position
-            elif height is not None:
-                sort_key = (height, 0) if height > 0 else ((1e9 - height), 0)
-            else:
-                sort_key = (1e9+1, 0)
-            history_raw.append(HistoryLine(sort_key, tx_hash, height, value_delta))
+            sort_key = AccountHistory.get_sort_key(metadata.height, metadata.position)
+            history_raw.append(HistoryLine(sort_key, tx_hash, metadata.height, value_delta))
 
         history_raw.sort(key = lambda v: v.sort_key)
 
@@ -1255,6 +1769,15 @@ class AbstractAccount:
 
         return history
 
+    def get_history_page(self, cursor: Optional[HistoryCursor]=None, limit: int=100) \
+            -> Tuple[List[Tuple[HistoryLine, int]], Optional[HistoryCursor]]:
+        """
+        Get the newest `limit` entries of the account history, with the balance after each. The
+        returned cursor is passed back to get the next page of older entries, and is `None`
+        when there are none.
+        """
+        return self._history.get_page(cursor, limit)
+
     def export_history(self, from_timestamp=None, to_timestamp=None,
                        show_addresses=False):
         h = self.get_history()
@@ -1369,14 +1892,23 @@ class AbstractAccount:
         is set/unset independent of address-level freezing, however both must be satisfied for
         a coin to be defined as spendable.'''
         update_entries: List[Tuple[TransactionOutputFlag, bytes, int]] = []
+        with self._utxos_lock:
+            for utxo in utxos:
+                utxo_key = utxo.key()
+                category = self._utxo_balance_categories.get(utxo_key)
+                if category is not None and (utxo_key in self._frozen_coins) != freeze:
+                    self._frozen_balance_totals[category] += utxo.value if freeze \
+                        else -utxo.value
+            if freeze:
+                self._frozen_coins.update(utxo.key() for utxo in utxos)
+            else:
+                self._frozen_coins.difference_update(utxo.key() for utxo in utxos)
         if freeze:
-            self._frozen_coins.update(utxo.key() for utxo in utxos)
             update_entries.extend(
                 (utxo.flags | TransactionOutputFlag.FROZEN_MASK, utxo.tx_hash, utxo.out_index)
                 for utxo in utxos if (utxo.flags & TransactionOutputFlag.FROZEN_MASK !=
                     TransactionOutputFlag.FROZEN_MASK))
         else:
-            self._frozen_coins.difference_update(utxo.key() for utxo in utxos)
             update_entries.extend(
                 (utxo.flags & ~TransactionOutputFlag.FROZEN_MASK, utxo.tx_hash, utxo.out_index)
                 for utxo in utxos if utxo.flags & TransactionOutputFlag.FROZEN_MASK != 0)
@@ -1825,6 +2357,22 @@ class DeterministicAccount(AbstractAccount):
             keystore = cast(DerivablePaths, self.get_keystore())
             return keystore.get_next_index(derivation_path)
 
+    def _get_public_keys_for_ids(self,
+            keyinstance_ids: Sequence[int]) -> Dict[int, List[PublicKey]]:
+        # Keys are derived in batches of those sharing the same parent derivation path.
+        parent_paths: Dict[Sequence[int], List[int]] = defaultdict(list)
+        for keyinstance_id in keyinstance_ids:
+            parent_paths[self._keypath[keyinstance_id][:-1]].append(keyinstance_id)
+        public_keys: Dict[int, List[PublicKey]] = defaultdict(list)
+        for keystore in self.get_keystores():
+            for parent_path, parent_keyinstance_ids in parent_paths.items():
+                indexes = [ self._keypath[keyinstance_id][-1]
+                    for keyinstance_id in parent_keyinstance_ids ]
+                for keyinstance_id, public_key in zip(parent_keyinstance_ids,
+                        keystore.derive_pubkeys(parent_path, indexes)):
+                    public_keys[keyinstance_id].append(public_key)
+        return public_keys
+
     def allocate_keys(self, count: int,
             derivation_path: Sequence[int]) -> Sequence[DeterministicKeyAllocation]:
         if count <= 0:
@@ -1924,6 +2472,14 @@ class SimpleDeterministicAccount(SimpleAccount, DeterministicAccount):
         return [ (script_type, self.get_script_template(public_key, script_type).to_script())
             for script_type in self.get_valid_script_types() ]
 
+    def get_possible_scripts_for_ids(self,
+            keyinstance_ids: Sequence[int]) -> List[Tuple[int, ScriptType, Script]]:
+        public_keys = self._get_public_keys_for_ids(keyinstance_ids)
+        return [ (keyinstance_id, script_type,
+                self.get_script_template(public_keys[keyinstance_id][0], script_type).to_script())
+            for keyinstance_id in keyinstance_ids
+            for script_type in self.get_valid_script_types() ]
+
     def get_script_template_for_id(self, keyinstance_id: int,
             script_type: Optional[ScriptType]=None) -> ScriptTemplate:
         public_key = self._get_public_key_for_id(keyinstance_id)
@@ -1993,6 +2549,16 @@ class MultisigAccount(DeterministicAccount):
         return [ (script_type, self.get_script_template(public_keys_hex, script_type).to_script())
             for script_type in self.get_valid_script_types() ]
 
+    def get_possible_scripts_for_ids(self,
+            keyinstance_ids: Sequence[int]) -> List[Tuple[int, ScriptType, Script]]:
+        results: List[Tuple[int, ScriptType, Script]] = []
+        for keyinstance_id, public_keys in self._get_public_keys_for_ids(keyinstance_ids).items():
+            public_keys_hex = [pubkey.to_hex() for pubkey in public_keys]
+            results.extend((keyinstance_id, script_type,
+                    self.get_script_template(public_keys_hex, script_type).to_script())
+                for script_type in self.get_valid_script_types())
+        return results
+
     def get_script_template_for_id(self, keyinstance_id: int,
             script_type: Optional[ScriptType]=None) -> ScriptTemplate:
         keyinstance = self._keyinstances[keyinstance_id]
@@ -2068,6 +2634,9 @@ class MultisigAccount(DeterministicAccount):
 
 
 class Wallet(TriggeredCallbacks):
+    # The minimum number of seconds between passes that prune transactions.
+    PRUNE_INTERVAL = 60
+
     _network: Optional['Network'] = None
     _transaction_table: Optional[TransactionTable] = None
     _transaction_cache: Optional[TransactionCache] = None
@@ -2082,11 +2651,15 @@ class Wallet(TriggeredCallbacks):
         self._db_context = storage.get_db_context()
 
         if self._db_context is not None:
+            self._db_context.set_live_session()
             txdata_cache_size = self.get_cache_size_for_tx_bytedata() * (1024 * 1024)
 
-            self._transaction_table = TransactionTable(self._db_context)
+            self._transaction_table = TransactionTable(self._db_context,
+                self.get_compression_threshold_for_tx_bytedata())
             self._transaction_cache = TransactionCache(self._transaction_table,
-                txdata_cache_size=txdata_cache_size)
+                txdata_cache_size=txdata_cache_size,
+                metadata_entry_budget=self.get_cache_budget_for_tx_metadata(),
+                txobject_cache_size=self.get_cache_size_for_tx_objects() * (1024 * 1024))
         self._transaction_descriptions: Dict[bytes, str] = {}
 
         self._masterkey_rows: Dict[int, MasterKeyRow] = {}
@@ -2095,6 +2668,11 @@ class Wallet(TriggeredCallbacks):
         self._accounts: Dict[int, AbstractAccount] = {}
         self._keystores: Dict[int, KeyStore] = {}
 
+        # Pruning is only looked at again when transactions have been settled since.
+        self._prune_wanted = True
+        self._prune_running = False
+        self._next_prune_time = 0.0
+
         self.load_state()
 
         self.contacts = Contacts(self._storage)
@@ -2107,7 +2685,9 @@ class Wallet(TriggeredCallbacks):
         self._storage.move_to(new_path)
 
         self._db_context = cast(DatabaseContext, self._storage.get_db_context())
-        self._transaction_table = TransactionTable(self._db_context)
+        self._db_context.set_live_session()
+        self._transaction_table = TransactionTable(self._db_context,
+            self.get_compression_threshold_for_tx_bytedata())
         cast(TransactionCache, self._transaction_cache).set_store(self._transaction_table)
 
     def load_state(self) -> None:
@@ -2371,6 +2951,10 @@ class Wallet(TriggeredCallbacks):
 
         return rows
 
+    def create_keyinstance_scripts(self, entries: List[KeyInstanceScriptRow]) -> None:
+        with KeyInstanceScriptTable(cast(DatabaseContext, self._db_context)) as table:
+            table.create(entries)
+
     def create_transactionoutputs(self, account_id: int,
             entries: List[TransactionOutputRow]) -> List[TransactionOutputRow]:
         with TransactionOutputTable(cast(DatabaseContext, self._db_context)) as table:
@@ -2436,6 +3020,12 @@ class Wallet(TriggeredCallbacks):
         with KeyInstanceTable(cast(DatabaseContext, self._db_context)) as table:
             table.update_script_types(entries)
 
+    def update_keyinstance_script_statuses(self,
+            entries: Iterable[Tuple[Optional[bytes], int, ScriptType]],
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        with KeyInstanceScriptTable(cast(DatabaseContext, self._db_context)) as table:
+            table.update_statuses(entries, completion_callback)
+
     def update_transactionoutput_flags(self,
             entries: Iterable[Tuple[TransactionOutputFlag, bytes, int]]) -> None:
         with TransactionOutputTable(cast(DatabaseContext, self._db_context)) as table:
@@ -2551,6 +3141,89 @@ class Wallet(TriggeredCallbacks):
         self._transaction_cache.set_maximum_cache_size_for_bytedata(maximum_size_bytes,
             force_resize)
 
+    def get_cache_size_for_tx_objects(self) -> int:
+        """
+        This returns the number of megabytes of estimated memory usage to keep parsed transactions
+        cached for. The caller should convert it to bytes for the cache.
+        """
+        return self._storage.get('tx_object_cache_size', DEFAULT_TXOBJECT_CACHE_SIZE_MB)
+
+    def get_compression_threshold_for_tx_bytedata(self) -> Optional[int]:
+        """
+        This returns the size in bytes from which transaction bytedata is compressed when it is
+        written to the database, where `None` means that it is not compressed. This only takes
+        effect when the wallet is next loaded, and does not change what is already written.
+        """
+        return self._storage.get('tx_bytedata_compression_threshold', None)
+
+    def get_cache_budget_for_tx_metadata(self) -> Optional[int]:
+        """
+        This returns the number of settled transactions to keep cached metadata for, where
+        `None` means that the metadata for all transactions is loaded when the wallet is opened.
+        This only takes effect when the wallet is next loaded.
+        """
+        return self._storage.get('tx_metadata_cache_budget', None)
+
+    def get_prune_transactions(self) -> bool:
+        """
+        This returns whether the bytedata of settled transactions that have no unspent outputs in
+        any account is dropped from the database. The bytedata of a pruned transaction is fetched
+        from the network again if the user wants to see it.
+        """
+        return self._storage.get('prune_transactions', False)
+
+    def set_prune_transactions(self, enabled: bool) -> None:
+        self._storage.put('prune_transactions', enabled)
+
+    async def prune_transactions(self) -> int:
+        """
+        Drop the bytedata of the settled transactions that have no unspent outputs in any
+        account, if pruning is enabled. This is only done when every account is synchronized, as
+        otherwise a transaction may still need to be processed. Each account calls this when its
+        monitoring is idle, but a pass is only made if transactions have been settled since the
+        last one, and at most once every `PRUNE_INTERVAL` seconds. Returns the number pruned.
+        """
+        if self._prune_running or not self._prune_wanted or time.time() < self._next_prune_time:
+            return 0
+        if not self.get_prune_transactions() or not self.is_synchronized():
+            return 0
+        assert self._transaction_cache is not None
+        self._prune_running = True
+        self._prune_wanted = False
+        try:
+            # This reads every settled transaction, and is kept off the event loop.
+            tx_hashes = await run_in_thread(self._get_prunable_tx_hashes)
+            if not len(tx_hashes):
+                return 0
+            # The outputs of settled transactions are only registered on the event loop, so any
+            # registered since the candidates were found are known now and until they are pruned.
+            unspent_tx_hashes = self._get_unspent_tx_hashes()
+            tx_hashes = self._transaction_cache.prune(
+                tx_hash for tx_hash in tx_hashes if tx_hash not in unspent_tx_hashes)
+        finally:
+            self._prune_running = False
+            self._next_prune_time = time.time() + self.PRUNE_INTERVAL
+        if len(tx_hashes):
+            self._logger.debug("pruned %d transactions", len(tx_hashes))
+        return len(tx_hashes)
+
+    def _get_prunable_tx_hashes(self) -> List[bytes]:
+        # Those with outputs that are not ours are included, as only our unspent outputs are ever
+        # spent by the wallet, and the transactions that have them are kept.
+        assert self._transaction_cache is not None
+        entries = self._transaction_cache.get_entries(TxFlags.StateSettled | TxFlags.HasByteData,
+            TxFlags.STATE_MASK | TxFlags.HasByteData)
+        if not len(entries):
+            return []
+        unspent_tx_hashes = self._get_unspent_tx_hashes()
+        return [ t[0] for t in entries if t[0] not in unspent_tx_hashes ]
+
+    def _get_unspent_tx_hashes(self) -> Set[bytes]:
+        unspent_tx_hashes: Set[bytes] = set()
+        for account in self.get_accounts():
+            unspent_tx_hashes |= account.get_unspent_tx_hashes()
+        return unspent_tx_hashes
+
     def start(self, network: 'Network') -> None:
         self._network = network
         for account in self.get_accounts():
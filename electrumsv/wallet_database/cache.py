@@ -4,21 +4,28 @@ needs to be authoritatively cached above the database. This also reduces the loc
 there will be no reads or
 """
 
+from array import array
+import bisect
+from collections import OrderedDict
+import itertools
 import threading
 import time
-from typing import cast, Dict, Iterable, List, Optional, Sequence, Tuple
+from typing import (Callable, cast, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence,
+    Set, Tuple)
 
 from bitcoinx import double_sha256, hash_to_hex_str
 
-from ..constants import TxFlags, MAXIMUM_TXDATA_CACHE_SIZE_MB
+from ..constants import DEFAULT_TXOBJECT_CACHE_SIZE_MB, TxFlags, MAXIMUM_TXDATA_CACHE_SIZE_MB
 from ..logs import logs
 from ..transaction import Transaction
 from .tables import (byte_repr, CompletionCallbackType, InvalidDataError, MAGIC_UNTOUCHED_BYTEDATA,
     MissingRowError, TransactionRow, TransactionTable, TxData, TxProof)
-from ..util.cache import LRUCache
+from ..util.cache import CachePolicy, LRUCache, ObjectCache
 
 
 class TransactionCacheEntry:
+    __slots__ = ("metadata", "flags", "time_loaded")
+
     def __init__(self, metadata: TxData, flags: TxFlags, time_loaded: Optional[float]=None) -> None:
         self.metadata = metadata
         self.flags = flags
@@ -28,20 +35,315 @@ class TransactionCacheEntry:
         return f"TransactionCacheEntry({self.metadata}, {TxFlags.to_repr(self.flags)})"
 
 
+# Rough per-object memory costs of a parsed transaction, measured with CPython 3.8. Only the
+# relative sizes matter, as they decide what the transaction object cache holds.
+TRANSACTION_OBJECT_OVERHEAD = 1500
+TRANSACTION_INPUT_OVERHEAD = 500
+TRANSACTION_OUTPUT_OVERHEAD = 350
+
+
+def estimate_transaction_object_size(tx: Transaction, bytedata: bytes) -> int:
+    return (TRANSACTION_OBJECT_OVERHEAD + len(bytedata) +
+        TRANSACTION_INPUT_OVERHEAD * len(tx.inputs) +
+        TRANSACTION_OUTPUT_OVERHEAD * len(tx.outputs))
+
+
+# Stands in for `None` in the integer columns, none of which can legitimately hold it.
+NONE_COLUMN_VALUE = -(1 << 63)
+
+# The flags that entries are grouped by, for lookups that filter on them.
+INDEXED_FLAGS = TxFlags.HasByteData | TxFlags.PrunedByteData | TxFlags.HasHeight | \
+    TxFlags.HasPosition | TxFlags.STATE_MASK
+
+
+class TransactionCacheEntries:
+    """
+    A mapping of transaction hash to cache entry that stores the entry fields in parallel arrays,
+    indexed by a per-transaction slot. This avoids the overhead of an entry object, metadata
+    tuple and boxed field values for every transaction in the wallet.
+
+    Entries are only created when they are asked for, and are copies. Changing one has no effect
+    unless it is set back into the mapping.
+
+    Transactions are also indexed by their combination of indexed flags, and settled transactions
+    by their height, so that the lookups done on every pass of the network's transaction
+    monitoring take time proportional to the matches rather than the wallet. Each slot records
+    its position in its flag bucket, so that it can be removed by moving the last slot in the
+    bucket into its place. The height index is an array of packed height and slot values, kept
+    sorted as new settled transactions are almost always at the highest heights. Keys that are
+    not are set aside, and removed keys are only marked, until the array is next used or enough
+    of it is stale, when it is rebuilt.
+    """
+
+    # The number of removed keys that are tolerated before the height index is rebuilt, beyond
+    # half its size.
+    STALE_SETTLED_KEY_LIMIT = 1000
+
+    def __init__(self) -> None:
+        self._slots: Dict[bytes, int] = {}
+        self._free_slots: List[int] = []
+        self._flags = array('q')
+        self._heights = array('q')
+        self._positions = array('q')
+        self._fees = array('q')
+        self._dates_added = array('q')
+        self._dates_updated = array('q')
+        self._times_loaded = array('d')
+
+        self._slot_hashes: List[Optional[bytes]] = []
+        self._slots_by_flags: Dict[int, array] = {}
+        self._flag_bucket_positions = array('q')
+        self._settled_keys = array('q')
+        self._unsorted_settled_keys = array('q')
+        self._removed_settled_keys: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, tx_hash: object) -> bool:
+        return tx_hash in self._slots
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._slots)
+
+    def __getitem__(self, tx_hash: bytes) -> TransactionCacheEntry:
+        return self._get_entry(self._slots[tx_hash])
+
+    def __setitem__(self, tx_hash: bytes, entry: TransactionCacheEntry) -> None:
+        slot = self._slots.get(tx_hash)
+        old_index_keys: Optional[Tuple[int, int]] = None
+        if slot is None:
+            if len(self._free_slots):
+                slot = self._free_slots.pop()
+            else:
+                slot = len(self._flags)
+                for column in (self._flags, self._heights, self._positions, self._fees,
+                        self._dates_added, self._dates_updated):
+                    column.append(0)
+                self._flag_bucket_positions.append(0)
+                self._times_loaded.append(0.0)
+                self._slot_hashes.append(None)
+            self._slots[tx_hash] = slot
+            self._slot_hashes[slot] = tx_hash
+        else:
+            old_index_keys = self._get_index_keys(slot)
+
+        metadata = entry.metadata
+        self._flags[slot] = entry.flags
+        self._heights[slot] = NONE_COLUMN_VALUE if metadata.height is None else metadata.height
+        self._positions[slot] = NONE_COLUMN_VALUE if metadata.position is None \
+            else metadata.position
+        self._fees[slot] = NONE_COLUMN_VALUE if metadata.fee is None else metadata.fee
+        self._dates_added[slot] = NONE_COLUMN_VALUE if metadata.date_added is None \
+            else metadata.date_added
+        self._dates_updated[slot] = NONE_COLUMN_VALUE if metadata.date_updated is None \
+            else metadata.date_updated
+        self._times_loaded[slot] = entry.time_loaded
+
+        # Most updates do not change what an entry is indexed by, and it is left in place.
+        new_index_keys = self._get_index_keys(slot)
+        if old_index_keys is None:
+            self._index(slot, new_index_keys)
+        else:
+            old_indexed_flags, old_settled_key = old_index_keys
+            new_indexed_flags, new_settled_key = new_index_keys
+            if old_indexed_flags != new_indexed_flags:
+                self._unindex_flags(slot, old_indexed_flags)
+                self._index_flags(slot, new_indexed_flags)
+            if old_settled_key != new_settled_key:
+                self._unindex_settled_key(old_settled_key)
+                self._index_settled_key(new_settled_key)
+
+    def __delitem__(self, tx_hash: bytes) -> None:
+        slot = self._slots.pop(tx_hash)
+        self._release_slot(slot)
+
+    def _release_slot(self, slot: int) -> None:
+        self._unindex(slot, self._get_index_keys(slot))
+        self._slot_hashes[slot] = None
+        self._free_slots.append(slot)
+
+    def _get_index_keys(self, slot: int) -> Tuple[int, int]:
+        # The settled key packs the height above the slot, so that sorting orders by height.
+        flags = self._flags[slot]
+        height = self._heights[slot]
+        settled_key = (height << 32) | slot if flags & TxFlags.StateSettled and height >= 0 \
+            else -1
+        return flags & INDEXED_FLAGS, settled_key
+
+    def _index(self, slot: int, index_keys: Tuple[int, int]) -> None:
+        indexed_flags, settled_key = index_keys
+        self._index_flags(slot, indexed_flags)
+        self._index_settled_key(settled_key)
+
+    def _unindex(self, slot: int, index_keys: Tuple[int, int]) -> None:
+        indexed_flags, settled_key = index_keys
+        self._unindex_flags(slot, indexed_flags)
+        self._unindex_settled_key(settled_key)
+
+    def _index_flags(self, slot: int, indexed_flags: int) -> None:
+        flag_slots = self._slots_by_flags.get(indexed_flags)
+        if flag_slots is None:
+            flag_slots = self._slots_by_flags[indexed_flags] = array('q')
+        self._flag_bucket_positions[slot] = len(flag_slots)
+        flag_slots.append(slot)
+
+    def _unindex_flags(self, slot: int, indexed_flags: int) -> None:
+        flag_slots = self._slots_by_flags[indexed_flags]
+        last_slot = flag_slots.pop()
+        if last_slot != slot:
+            position = self._flag_bucket_positions[slot]
+            flag_slots[position] = last_slot
+            self._flag_bucket_positions[last_slot] = position
+        elif not len(flag_slots):
+            del self._slots_by_flags[indexed_flags]
+
+    def _index_settled_key(self, settled_key: int) -> None:
+        if settled_key == -1:
+            return
+        if settled_key in self._removed_settled_keys:
+            # The key is still in one of the arrays, and only needs to be unmarked.
+            self._removed_settled_keys.remove(settled_key)
+        elif len(self._unsorted_settled_keys) or len(self._settled_keys) and \
+                settled_key < self._settled_keys[-1]:
+            self._unsorted_settled_keys.append(settled_key)
+        else:
+            self._settled_keys.append(settled_key)
+
+    def _unindex_settled_key(self, settled_key: int) -> None:
+        if settled_key == -1:
+            return
+        self._removed_settled_keys.add(settled_key)
+        if len(self._removed_settled_keys) > \
+                self.STALE_SETTLED_KEY_LIMIT + len(self._settled_keys) // 2:
+            self._sort_settled_keys()
+
+    def _sort_settled_keys(self) -> None:
+        removed_keys = self._removed_settled_keys
+        settled_keys = (key for key in self._settled_keys if key not in removed_keys)
+        if len(self._unsorted_settled_keys):
+            unsorted_keys = (key for key in self._unsorted_settled_keys
+                if key not in removed_keys)
+            self._settled_keys = array('q', sorted(itertools.chain(settled_keys, unsorted_keys)))
+            self._unsorted_settled_keys = array('q')
+        else:
+            self._settled_keys = array('q', settled_keys)
+        removed_keys.clear()
+
+    def _get_entry(self, slot: int) -> TransactionCacheEntry:
+        values = [ column[slot] for column in (self._heights, self._positions, self._fees,
+            self._dates_added, self._dates_updated) ]
+        metadata = TxData(*(None if value == NONE_COLUMN_VALUE else value for value in values))
+        return TransactionCacheEntry(metadata, TxFlags(self._flags[slot]),
+            self._times_loaded[slot])
+
+    def get(self, tx_hash: bytes,
+            default: Optional[TransactionCacheEntry]=None) -> Optional[TransactionCacheEntry]:
+        slot = self._slots.get(tx_hash)
+        if slot is None:
+            return default
+        return self._get_entry(slot)
+
+    def get_flags(self, tx_hash: bytes) -> Optional[TxFlags]:
+        slot = self._slots.get(tx_hash)
+        if slot is None:
+            return None
+        return TxFlags(self._flags[slot])
+
+    def pop(self, tx_hash: bytes,
+            default: Optional[TransactionCacheEntry]=None) -> Optional[TransactionCacheEntry]:
+        slot = self._slots.pop(tx_hash, None)
+        if slot is None:
+            return default
+        entry = self._get_entry(slot)
+        self._release_slot(slot)
+        return entry
+
+    def items(self) -> Iterator[Tuple[bytes, TransactionCacheEntry]]:
+        for tx_hash, slot in self._slots.items():
+            yield tx_hash, self._get_entry(slot)
+
+    def select(self, predicate: Callable[[int], bool], examined_flags: Optional[int]=None) \
+            -> Iterator[Tuple[bytes, TransactionCacheEntry]]:
+        """
+        Only create the entries that have flags the predicate accepts. If the caller indicates
+        that the predicate only examines indexed flags, only the matching entries are visited.
+        """
+        if examined_flags is not None and examined_flags & ~INDEXED_FLAGS == 0:
+            for indexed_flags, slots in self._slots_by_flags.items():
+                if predicate(indexed_flags):
+                    for slot in slots:
+                        yield cast(bytes, self._slot_hashes[slot]), self._get_entry(slot)
+            return
+
+        flags_column = self._flags
+        for tx_hash, slot in self._slots.items():
+            if predicate(flags_column[slot]):
+                yield tx_hash, self._get_entry(slot)
+
+    def get_settled_above_height(self, height: int) -> List[Tuple[bytes, TransactionCacheEntry]]:
+        if len(self._unsorted_settled_keys) or len(self._removed_settled_keys):
+            self._sort_settled_keys()
+
+        results = []
+        index = bisect.bisect_right(self._settled_keys, (height << 32) | 0xFFFFFFFF)
+        for key in self._settled_keys[index:]:
+            slot = key & 0xFFFFFFFF
+            results.append((cast(bytes, self._slot_hashes[slot]), self._get_entry(slot)))
+        return results
+
+    def update(self, entries: Mapping[bytes, TransactionCacheEntry]) -> None:
+        for tx_hash, entry in entries.items():
+            self[tx_hash] = entry
+
+
 class TransactionCache:
-    def __init__(self, store: TransactionTable, txdata_cache_size: Optional[int]=None) -> None:
+    # How many rows are read from the store at a time when scanning uncached metadata.
+    METADATA_PAGE_SIZE = 1000
+
+    def __init__(self, store: TransactionTable, txdata_cache_size: Optional[int]=None,
+            metadata_entry_budget: Optional[int]=None,
+            txobject_cache_size: Optional[int]=None) -> None:
+        """
+        If there is no metadata entry budget, the metadata for all transactions is loaded and
+        cached. Otherwise only the unsettled transactions are guaranteed to be cached, and the
+        metadata for settled transactions is faulted in from the store as it is needed, with the
+        least recently used of them evicted once there are more than the budget allows.
+
+        The parsed transactions given out by `get_transaction` are cached separately from their
+        bytedata, up to the estimated memory size `txobject_cache_size`.
+        """
         if txdata_cache_size is None:
             txdata_cache_size = MAXIMUM_TXDATA_CACHE_SIZE_MB * (1024 * 1024)
+        if txobject_cache_size is None:
+            txobject_cache_size = DEFAULT_TXOBJECT_CACHE_SIZE_MB * (1024 * 1024)
 
         self._logger = logs.get_logger("cache-tx")
-        self._cache: Dict[bytes, TransactionCacheEntry] = {}
-        self._bytedata_cache = LRUCache(max_size=txdata_cache_size)
+        self._cache = TransactionCacheEntries()
+        # Scans of the whole history, like exporting it, should not flush the bytedata of the
+        # unsettled transactions from the cache.
+        self._bytedata_cache = LRUCache(max_size=txdata_cache_size,
+            policy=CachePolicy.SEGMENTED_LRU)
+        self._transaction_object_cache = ObjectCache(txobject_cache_size)
         self._store = store
 
         self._lock = threading.RLock()
 
-        self._logger.debug("caching all metadata records")
-        self.get_metadatas()
+        self._metadata_entry_budget = metadata_entry_budget
+        # The cached settled entries that can be evicted, in least to most recently used order.
+        self._evictable: 'OrderedDict[bytes, None]' = OrderedDict()
+        # Entries with changes that have not been written to the store yet cannot be evicted, as
+        # faulting them back in would read stale data. A hash here with no cached entry is a
+        # pending deletion.
+        self._pending_writes: Dict[bytes, int] = {}
+        self.metadata_faults = self.metadata_evictions = 0
+
+        if metadata_entry_budget is None:
+            self._logger.debug("caching all metadata records")
+            self.get_metadatas()
+        else:
+            self._logger.debug("caching unsettled and recent metadata records")
+            self._load_hot_metadata(metadata_entry_budget)
         self._logger.debug("cached %d metadata records", len(self._cache))
 
         if txdata_cache_size > 0:
@@ -49,16 +351,104 @@ class TransactionCache:
             self._logger.debug("attempting to cache unsettled transaction bytedata")
             rows = self._store.read(TxFlags.HasByteData, TxFlags.HasByteData|TxFlags.StateSettled)
             for row in rows:
-                self._bytedata_cache.set(row[0], row[1])
+                self._bytedata_cache.set(row[0], row[1], protect=True)
             self._logger.debug("matched/cached %d unsettled transactions", len(rows))
 
     def set_store(self, store: TransactionTable) -> None:
         self._store = store
 
+    def _load_hot_metadata(self, metadata_entry_budget: int) -> None:
+        for tx_hash, flags, metadata in self._store.read_metadata(TxFlags.Unset,
+                TxFlags.StateSettled):
+            self._cache[tx_hash] = TransactionCacheEntry(metadata, flags)
+
+        # Use what budget there is on the most recently mined of the settled transactions, as
+        # those are the ones most likely to be looked at.
+        if metadata_entry_budget > 0:
+            rows = self._store.read_recent_metadata(TxFlags.StateSettled, TxFlags.StateSettled,
+                metadata_entry_budget)
+            for tx_hash, flags, metadata in reversed(rows):
+                self._cache[tx_hash] = TransactionCacheEntry(metadata, flags)
+                self._evictable[tx_hash] = None
+
+    def _lookup(self, tx_hash: bytes) -> Optional[TransactionCacheEntry]:
+        if self._metadata_entry_budget is None:
+            return self._cache.get(tx_hash)
+
+        with self._lock:
+            entry = self._cache.get(tx_hash)
+            if entry is None:
+                self._fault_in([ tx_hash ])
+                entry = self._cache.get(tx_hash)
+            elif tx_hash in self._evictable:
+                self._evictable.move_to_end(tx_hash)
+            return entry
+
+    def _fault_in(self, tx_hashes: Iterable[bytes]) -> None:
+        if self._metadata_entry_budget is None:
+            return
+
+        missing_tx_hashes = [ tx_hash for tx_hash in tx_hashes
+            if tx_hash not in self._cache and tx_hash not in self._pending_writes ]
+        if not len(missing_tx_hashes):
+            return
+
+        # Evicting first ensures that the entries being faulted in are not evicted before the
+        # caller gets to use them.
+        self._evict()
+        for tx_hash, flags, metadata in self._store.read_metadata(tx_hashes=missing_tx_hashes):
+            self._cache[tx_hash] = TransactionCacheEntry(metadata, flags)
+            self._mark_cached(tx_hash, flags)
+            self.metadata_faults += 1
+
+    def _mark_cached(self, tx_hash: bytes, flags: TxFlags) -> None:
+        if self._metadata_entry_budget is None or tx_hash in self._pending_writes:
+            return
+        if flags & TxFlags.StateSettled:
+            self._evictable[tx_hash] = None
+            self._evictable.move_to_end(tx_hash)
+        else:
+            self._evictable.pop(tx_hash, None)
+
+    def _mark_modified(self, tx_hashes: Iterable[bytes]) -> None:
+        """
+        Pin the given entries in the cache until the store writes that were just queued for
+        them have been applied. This must be called after the writes are queued.
+        """
+        if self._metadata_entry_budget is None:
+            return
+
+        tx_hashes = list(tx_hashes)
+        for tx_hash in tx_hashes:
+            self._pending_writes[tx_hash] = self._pending_writes.get(tx_hash, 0) + 1
+            self._evictable.pop(tx_hash, None)
+
+        # Writes are applied in the order they are queued, so when this no-op write completes
+        # so have the writes for these entries.
+        def _completion_callback(exc_value: Optional[Exception]) -> None:
+            with self._lock:
+                for tx_hash in tx_hashes:
+                    pending_count = self._pending_writes[tx_hash] - 1
+                    if pending_count > 0:
+                        self._pending_writes[tx_hash] = pending_count
+                        continue
+                    del self._pending_writes[tx_hash]
+                    entry = self._cache.get(tx_hash)
+                    if entry is not None:
+                        self._mark_cached(tx_hash, entry.flags)
+                self._evict()
+        self._store._db_context.queue_write(lambda db: None, _completion_callback)
+
+    def _evict(self) -> None:
+        assert self._metadata_entry_budget is not None
+        while len(self._evictable) > self._metadata_entry_budget:
+            tx_hash, _ = self._evictable.popitem(last=False)
+            del self._cache[tx_hash]
+            self.metadata_evictions += 1
+
     def set_maximum_cache_size_for_bytedata(self, maximum_size: int,
             force_resize: bool=False) -> None:
         self._bytedata_cache.set_maximum_size(maximum_size, force_resize)
-
     def _validate_transaction_bytes(self, tx_hash: bytes, bytedata: Optional[bytes]) -> bool:
         if bytedata is None:
             return True
@@ -92,9 +482,12 @@ class TransactionCache:
 
     @staticmethod
     def _validate_new_flags(tx_hash: bytes, flags: TxFlags) -> None:
-        # All current states are expected to have bytedata.
+        # All current states are expected to have bytedata, unless it was pruned once settled.
         if (flags & TxFlags.STATE_MASK) == 0 or (flags & TxFlags.HasByteData) != 0:
             return
+        if flags & (TxFlags.STATE_MASK | TxFlags.PrunedByteData) == \
+                TxFlags.StateSettled | TxFlags.PrunedByteData:
+            return
         tx_id = hash_to_hex_str(tx_hash)
         raise InvalidDataError("setting uncleared state without bytedata "
             f"{tx_id} {TxFlags.to_repr(flags)}")
@@ -105,7 +498,7 @@ class TransactionCache:
         tx_hex = str(tx)
         bytedata = bytes.fromhex(tx_hex)
         date_updated = self._store._get_current_timestamp()
-        if tx_hash in self._cache:
+        if self._lookup(tx_hash) is not None:
             self.update([ (tx_hash, TxData(date_added=date_updated, date_updated=date_updated),
                 bytedata, flags | TxFlags.HasByteData) ], completion_callback=completion_callback)
         else:
@@ -114,6 +507,30 @@ class TransactionCache:
                     bytedata, flags | TxFlags.HasByteData, None) ],
                 completion_callback=completion_callback)
 
+    def add_transactions(self, txs: List[Tuple[bytes, bytes]], flags: TxFlags=TxFlags.Unset,
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        """
+        Add the data for a group of transactions, given as hash and bytes. The transactions that
+        are already known are updated in one store write, which is the usual case for fetched
+        transactions. Any that are not known are added in a preceding write.
+        """
+        date_updated = self._store._get_current_timestamp()
+        metadata = TxData(date_added=date_updated, date_updated=date_updated)
+        with self._lock:
+            inserts: List[TransactionRow] = []
+            updates: List[Tuple[bytes, TxData, Optional[bytes], TxFlags]] = []
+            for tx_hash, bytedata in txs:
+                if self._lookup(tx_hash) is not None:
+                    updates.append((tx_hash, metadata, bytedata, flags | TxFlags.HasByteData))
+                else:
+                    inserts.append(TransactionRow(tx_hash, metadata, bytedata,
+                        flags | TxFlags.HasByteData, None))
+            if len(inserts):
+                self._add(inserts,
+                    completion_callback=None if len(updates) else completion_callback)
+            if len(updates):
+                self._update(updates, completion_callback=completion_callback)
+
     def add(self, inserts: List[TransactionRow],
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
         with self._lock:
@@ -142,8 +559,10 @@ class TransactionCache:
             self._cache[tx_hash] = TransactionCacheEntry(metadata, flags)
             if bytedata is not None:
                 self._bytedata_cache.set(tx_hash, bytedata)
+            self._transaction_object_cache.discard(tx_hash)
             inserts[i] = TransactionRow(tx_hash, metadata, bytedata, flags, description)
         self._store.create(inserts, completion_callback=completion_callback)
+        self._mark_modified(row.tx_hash for row in inserts)
 
     def update(self, updates: List[Tuple[bytes, TxData, Optional[bytes], TxFlags]],
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
@@ -190,6 +609,8 @@ class TransactionCache:
             flags &= ~TxFlags.HasByteData
             if incoming_flags & TxFlags.HasByteData:
                 flags |= TxFlags.HasByteData if incoming_bytedata is not None else TxFlags.Unset
+                if incoming_bytedata is not None:
+                    flags &= ~TxFlags.PrunedByteData
             else:
                 flags |= entry.flags & TxFlags.HasByteData
 
@@ -204,6 +625,7 @@ class TransactionCache:
             self._cache[tx_hash] = new_entry
             if incoming_flags & TxFlags.HasByteData:
                 self._bytedata_cache.set(tx_hash, incoming_bytedata)
+                self._transaction_object_cache.discard(tx_hash)
             elif flags & TxFlags.HasByteData:
                 # Indicate the user is not changing the bytedata, it's a metadata/flags update.
                 incoming_bytedata = MAGIC_UNTOUCHED_BYTEDATA
@@ -213,6 +635,7 @@ class TransactionCache:
         # is that there's no way of reusing a completion context for more than one thing.
         if len(updated_entries):
             self._store.update(updated_entries, completion_callback=completion_callback)
+            self._mark_modified(t[0] for t in updated_entries)
 
     def update_flags(self, tx_hash: bytes, flags: TxFlags, mask: Optional[TxFlags]=None,
             completion_callback: Optional[CompletionCallbackType]=None) -> TxFlags:
@@ -233,8 +656,10 @@ class TransactionCache:
             metadata = entry.metadata
             entry.metadata = TxData(metadata.height, metadata.position, metadata.fee,
                 metadata.date_added, date_updated)
+            self._cache[tx_hash] = entry
             self._store.update_flags([ (tx_hash, flags, mask, date_updated) ],
                 completion_callback=completion_callback)
+            self._mark_modified([ tx_hash ])
         return entry.flags
 
     def update_proof(self, tx_hash: bytes, proof: TxProof,
@@ -246,20 +671,101 @@ class TransactionCache:
             metadata = entry.metadata
             entry.metadata = TxData(metadata.height, metadata.position, metadata.fee,
                 metadata.date_added, date_updated)
+            self._cache[tx_hash] = entry
             self._store.update_proof([ (tx_hash, proof, date_updated) ],
                 completion_callback=completion_callback)
+            self._mark_modified([ tx_hash ])
+
+    def update_verifications(self, verifications: List[Tuple[bytes, int, int, TxProof]],
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        """
+        Settle the given transactions at their verified block height and position, and record
+        their proofs. All of the changes are made in one store write.
+        """
+        with self._lock:
+            date_updated = self._store._get_current_timestamp()
+            entries = dict(self._get_entries(tx_hashes=[ t[0] for t in verifications ]))
+            store_updates = []
+            for tx_hash, height, position, proof in verifications:
+                entry = entries[tx_hash]
+                metadata = TxData(height, position, entry.metadata.fee,
+                    entry.metadata.date_added, date_updated)
+                flags = self._adjust_metadata_flags(metadata, entry.flags & ~TxFlags.STATE_MASK)
+                flags |= TxFlags.StateSettled | TxFlags.HasProofData
+                self._validate_new_flags(tx_hash, flags)
+                self._cache[tx_hash] = TransactionCacheEntry(metadata, flags, entry.time_loaded)
+                store_updates.append((tx_hash, metadata, flags, proof))
+            self._store.update_proofs_and_metadata(store_updates,
+                completion_callback=completion_callback)
+            self._mark_modified(t[0] for t in store_updates)
+
+    def prune(self, tx_hashes: Iterable[bytes],
+            completion_callback: Optional[CompletionCallbackType]=None) -> List[bytes]:
+        """
+        Drop the bytedata of the given settled transactions, keeping their metadata and proofs.
+        Any that are not settled or have no bytedata are skipped. The caller is responsible for
+        only pruning transactions it will not need to process again, and the hashes of those
+        pruned are returned.
+        """
+        with self._lock:
+            date_updated = self._store._get_current_timestamp()
+            store_updates: List[Tuple[bytes, TxData, Optional[bytes], TxFlags]] = []
+            for tx_hash, entry in self._get_entries(TxFlags.StateSettled | TxFlags.HasByteData,
+                    TxFlags.STATE_MASK | TxFlags.HasByteData, list(tx_hashes), False):
+                flags = (entry.flags & ~TxFlags.HasByteData) | TxFlags.PrunedByteData
+                metadata = TxData(entry.metadata.height, entry.metadata.position,
+                    entry.metadata.fee, entry.metadata.date_added, date_updated)
+                self._cache[tx_hash] = TransactionCacheEntry(metadata, flags, entry.time_loaded)
+                self._bytedata_cache.set(tx_hash, None)
+                self._transaction_object_cache.discard(tx_hash)
+                store_updates.append((tx_hash, metadata, None, flags))
+            if len(store_updates):
+                self._store.update(store_updates, completion_callback=completion_callback)
+                self._mark_modified(t[0] for t in store_updates)
+            return [ t[0] for t in store_updates ]
+
+    def unprune(self, tx_hashes: Iterable[bytes],
+            completion_callback: Optional[CompletionCallbackType]=None) -> List[bytes]:
+        """
+        Make the given pruned transactions wanted again, so that they are fetched and processed
+        as if newly seen. They are settled again once their proofs are fetched. The hashes of
+        those that were pruned are returned.
+        """
+        unprune_mask = ~(TxFlags.HasPosition | TxFlags.HasProofData | TxFlags.STATE_MASK |
+            TxFlags.PrunedByteData)
+
+        with self._lock:
+            date_updated = self._store._get_current_timestamp()
+            store_updates: List[Tuple[bytes, TxData, TxFlags]] = []
+            for tx_hash, entry in self._get_entries(TxFlags.PrunedByteData,
+                    TxFlags.PrunedByteData, list(tx_hashes), False):
+                metadata = TxData(height=entry.metadata.height, fee=entry.metadata.fee,
+                    date_added=entry.metadata.date_added, date_updated=date_updated)
+                self._cache[tx_hash] = TransactionCacheEntry(metadata,
+                    entry.flags & unprune_mask, entry.time_loaded)
+                store_updates.append((tx_hash, metadata, entry.flags & unprune_mask))
+            if len(store_updates):
+                self._store.update_metadata(store_updates,
+                    completion_callback=completion_callback)
+                self._mark_modified(t[0] for t in store_updates)
+            return [ t[0] for t in store_updates ]
 
     def delete(self, tx_hash: bytes,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
         with self._lock:
             self._logger.debug("cache_deletion: %s", hash_to_hex_str(tx_hash))
+            self._fault_in([ tx_hash ])
             del self._cache[tx_hash]
             self._bytedata_cache.set(tx_hash, None)
+            self._transaction_object_cache.discard(tx_hash)
             self._store.delete([ tx_hash ], completion_callback=completion_callback)
+            self._mark_modified([ tx_hash ])
 
     def get_flags(self, tx_hash: bytes) -> Optional[TxFlags]:
-        # We cache all metadata, so this can avoid touching the database.
-        entry = self._cache.get(tx_hash)
+        # Unless the entry needs to be faulted in, this can avoid touching the database.
+        if self._metadata_entry_budget is None:
+            return self._cache.get_flags(tx_hash)
+        entry = self._lookup(tx_hash)
         if entry is not None:
             return entry.flags
         return None
@@ -279,8 +785,8 @@ class TransactionCache:
             force_store_fetch: bool=False) -> Optional[TransactionCacheEntry]:
         # We want to hit the cache, but only if we can give them what they want. Generally if
         # something is cached, then all we may lack is the bytedata.
-        if not force_store_fetch and tx_hash in self._cache:
-            entry = self._cache[tx_hash]
+        entry = None if force_store_fetch else self._lookup(tx_hash)
+        if entry is not None:
             # If they filter the entry they request, we only give them a matched result.
             if not self._entry_visible(entry.flags, flags, mask):
                 return None
@@ -303,6 +809,7 @@ class TransactionCache:
                 # flushing we can assume that we will not be clobbering any fresh changes.
                 entry = TransactionCacheEntry(metadata, flags_get)
                 self._cache.update({ tx_hash: entry })
+                self._mark_cached(tx_hash, flags_get)
                 if bytedata is not None:
                     self._bytedata_cache.set(tx_hash, bytedata)
                 self._logger.debug("get_entry/cache_change: %r", (hash_to_hex_str(tx_hash),
@@ -326,13 +833,13 @@ class TransactionCache:
 
     def _get_metadata(self, tx_hash: bytes, flags: Optional[TxFlags]=None,
             mask: Optional[TxFlags]=None) -> Optional[TxData]:
-        if tx_hash in self._cache:
-            entry = self._cache[tx_hash]
+        entry = self._lookup(tx_hash)
+        if entry is not None:
             return entry.metadata if self._entry_visible(entry.flags, flags, mask) else None
         return None
 
     def have_transaction_data(self, tx_hash: bytes) -> bool:
-        entry = self._cache.get(tx_hash)
+        entry = self._lookup(tx_hash)
         return entry is not None and (entry.flags & TxFlags.HasByteData) != 0
 
     def have_transaction_data_cached(self, tx_hash: bytes) -> bool:
@@ -340,11 +847,26 @@ class TransactionCache:
 
     def get_transaction(self, tx_hash: bytes, flags: Optional[TxFlags]=None,
             mask: Optional[TxFlags]=None) -> Optional[Transaction]:
+        """
+        The transaction is shared with other callers through the transaction object cache, and
+        must not be modified. Use `get_transactions` to get a copy that can be.
+        """
         assert mask is None or (mask & TxFlags.HasByteData) != 0, "filter excludes transaction"
-        results = self.get_transactions(flags, mask, [ tx_hash ])
-        if len(results):
-            return results[0][1]
-        return None
+        with self._lock:
+            entry = self._lookup(tx_hash)
+            if entry is None or entry.flags & TxFlags.HasByteData == 0 or \
+                    not self._entry_visible(entry.flags, flags, mask):
+                return None
+            tx = self._transaction_object_cache.get(tx_hash)
+            if tx is not None:
+                return cast(Transaction, tx)
+            bytedata = self.get_transaction_data(tx_hash, flags, mask)
+            if bytedata is None:
+                return None
+            tx = Transaction.from_bytes(bytedata)
+            self._transaction_object_cache.set(tx_hash, tx,
+                estimate_transaction_object_size(tx, bytedata))
+            return tx
 
     def get_transactions(self, flags: Optional[TxFlags]=None, mask: Optional[TxFlags]=None,
             tx_hashes: Optional[Iterable[bytes]]=None) -> List[Tuple[bytes, Transaction]]:
@@ -400,6 +922,7 @@ class TransactionCache:
 
         results = []
         if tx_hashes is not None:
+            self._fault_in(tx_hashes)
             for tx_hash in tx_hashes:
                 entry = self._cache.get(tx_hash)
                 if entry is not None and self._entry_visible(entry.flags, flags, mask):
@@ -411,10 +934,39 @@ class TransactionCache:
                 if wanted_hashes != have_hashes:
                     raise MissingRowError(wanted_hashes - have_hashes)
         else:
-            for tx_hash, entry in self._cache.items():
-                if self._entry_visible(entry.flags, flags, mask):
-                    results.append((tx_hash, entry))
+            results.extend(self._cache.select(
+                lambda entry_flags: self._entry_visible(entry_flags, flags, mask),
+                mask if mask is not None else flags))
+            if self._metadata_entry_budget is not None:
+                results.extend(self._scan_uncached_entries(flags, mask))
+
+        return results
+
+    def _scan_uncached_entries(self, flags: Optional[TxFlags]=None,
+            mask: Optional[TxFlags]=None) -> List[Tuple[bytes, TransactionCacheEntry]]:
+        # All unsettled entries are cached, so there is nothing to find if settled ones are
+        # filtered out. Settled entries always have a position, and either their bytedata or the
+        # flag that it was pruned. Those converted from older wallets have no proof data.
+        if flags is not None and mask is not None:
+            if mask & (TxFlags.StateSettled | TxFlags.HasPosition) & ~flags:
+                return []
+            bytedata_flags = TxFlags.HasByteData | TxFlags.PrunedByteData
+            if mask & bytedata_flags == bytedata_flags and flags & bytedata_flags == 0:
+                return []
 
+        # Any entry that is not cached is settled and has no pending writes, so the store has
+        # the latest version of it. These are not cached, as that would defeat the budget.
+        results = []
+        after_tx_hash = b''
+        while True:
+            rows = self._store.read_metadata_page(flags, mask, after_tx_hash,
+                self.METADATA_PAGE_SIZE)
+            for tx_hash, flags_get, metadata in rows:
+                if tx_hash not in self._cache and tx_hash not in self._pending_writes:
+                    results.append((tx_hash, TransactionCacheEntry(metadata, flags_get)))
+            if len(rows) < self.METADATA_PAGE_SIZE:
+                break
+            after_tx_hash = rows[-1][0]
         return results
 
     def get_metadatas(self, flags: Optional[TxFlags]=None, mask: Optional[TxFlags]=None,
@@ -427,6 +979,10 @@ class TransactionCache:
     def _get_metadatas(self, flags: Optional[TxFlags]=None, mask: Optional[TxFlags]=None,
             tx_hashes: Optional[Sequence[bytes]]=None,
             require_all: bool=True) -> List[Tuple[bytes, TxData]]:
+        if self._metadata_entry_budget is not None:
+            return [ (tx_hash, entry.metadata) for (tx_hash, entry)
+                in self._get_entries(flags, mask, tx_hashes, require_all) ]
+
         if self._cache:
             if tx_hashes is not None:
                 matches = []
@@ -435,8 +991,9 @@ class TransactionCache:
                     if self._entry_visible(entry.flags, flags, mask):
                         matches.append((tx_hash, entry.metadata))
                 return matches
-            return [ (t[0], t[1].metadata) for t in self._cache.items()
-                if self._entry_visible(t[1].flags, flags, mask) ]
+            return [ (t[0], t[1].metadata) for t in self._cache.select(
+                lambda entry_flags: self._entry_visible(entry_flags, flags, mask),
+                mask if mask is not None else flags) ]
 
         store_tx_hashes: Optional[Sequence[bytes]] = None
         if tx_hashes is not None:
@@ -479,44 +1036,54 @@ class TransactionCache:
         return results
 
     def get_height(self, tx_hash: bytes) -> Optional[int]:
-        entry = self._cache.get(tx_hash)
+        entry = self._lookup(tx_hash)
         if entry is not None and entry.flags & (TxFlags.StateSettled|TxFlags.StateCleared):
             return entry.metadata.height
         return None
 
     def get_unsynced_hashes(self) -> List[bytes]:
-        entries = self.get_metadatas(flags=TxFlags.Unset, mask=TxFlags.HasByteData)
+        # Pruned bytedata is not wanted again unless the transaction is unpruned.
+        entries = self.get_metadatas(flags=TxFlags.Unset,
+            mask=TxFlags.HasByteData | TxFlags.PrunedByteData)
         return [ t[0] for t in entries ]
 
     def get_unverified_entries(self, watermark_height: int) \
             -> List[Tuple[bytes, TransactionCacheEntry]]:
-        results = self.get_metadatas(
+        results = self.get_entries(
             flags=TxFlags.HasByteData | TxFlags.HasHeight,
             mask=TxFlags.HasByteData | TxFlags.HasPosition | TxFlags.HasHeight)
-        return [ (tx_hash, self._cache[tx_hash]) for (tx_hash, metadata) in results
-            if 0 < cast(int, metadata.height) <= watermark_height ]
+        return [ (tx_hash, entry) for (tx_hash, entry) in results
+            if 0 < cast(int, entry.metadata.height) <= watermark_height ]
 
     def apply_reorg(self, reorg_height: int,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        fetch_flags = TxFlags.StateSettled
-        fetch_mask = TxFlags.StateSettled
         unverify_mask = ~(TxFlags.HasHeight | TxFlags.HasPosition | TxFlags.HasProofData |
             TxFlags.STATE_MASK)
 
         with self._lock:
             date_updated = self._store._get_current_timestamp()
-            # This does not request bytedata so if all metadata is cached, will not hit the
-            # database.
+            # The settled entries are looked up by height, and unless the metadata is only partly
+            # cached this will not hit the database.
             store_updates = []
-            for (tx_hash, metadata) in self.get_metadatas(fetch_flags, fetch_mask):
-                if cast(int, metadata.height) > reorg_height:
-                    # Update the cached version to match the changes we are going to apply.
-                    entry = self._cache[tx_hash]
+            entries = self._cache.get_settled_above_height(reorg_height)
+            if self._metadata_entry_budget is not None:
+                entries.extend(t for t in self._scan_uncached_entries(TxFlags.StateSettled,
+                    TxFlags.StateSettled) if cast(int, t[1].metadata.height) > reorg_height)
+            for (tx_hash, entry) in entries:
+                metadata = entry.metadata
+                # Update the cached version to match the changes we are going to apply. The
+                # entry may not have been cached, but as it will be unsettled it must be.
+                if entry.flags & TxFlags.PrunedByteData:
+                    # Without the bytedata it cannot be cleared, so it is fetched again instead.
+                    entry.flags &= unverify_mask & ~TxFlags.PrunedByteData
+                else:
                     entry.flags = (entry.flags & unverify_mask) | TxFlags.StateCleared
-                    # TODO(rt12) BACKLOG the real unconfirmed height may be -1 unconf parent
-                    entry.metadata = TxData(height=0, fee=metadata.fee,
-                        date_added=metadata.date_added, date_updated=date_updated)
-                    store_updates.append((tx_hash, entry.metadata, entry.flags))
+                # TODO(rt12) BACKLOG the real unconfirmed height may be -1 unconf parent
+                entry.metadata = TxData(height=0, fee=metadata.fee,
+                    date_added=metadata.date_added, date_updated=date_updated)
+                self._cache[tx_hash] = entry
+                store_updates.append((tx_hash, entry.metadata, entry.flags))
             if len(store_updates):
                 self._store.update_metadata(store_updates,
                     completion_callback=completion_callback)
+                self._mark_modified(t[0] for t in store_updates)
@@ -50,6 +50,15 @@ def update_database(db: sqlite3.Connection) -> None:
     with db:
         if version == 22:
             migrations.migration_0023_add_wallet_events.execute(db)
+            version = 23
+        if version == 23:
+            migrations.migration_0024_add_query_indexes.execute(db)
+            version = 24
+        if version == 24:
+            migrations.migration_0025_add_keyinstance_scripts.execute(db)
+            version = 25
+        if version == 25:
+            migrations.migration_0026_add_keyinstance_script_status.execute(db)
 
     _ensure_matching_migration(db, MIGRATION_CURRENT)
 
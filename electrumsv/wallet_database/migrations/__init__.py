@@ -1,2 +1,5 @@
 from . import migration_0022_create_database
 from . import migration_0023_add_wallet_events
+from . import migration_0024_add_query_indexes
+from . import migration_0025_add_keyinstance_scripts
+from . import migration_0026_add_keyinstance_script_status
@@ -0,0 +1,25 @@
+import json
+import sqlite3
+import time
+
+MIGRATION = 24
+
+def execute(conn: sqlite3.Connection) -> None:
+    # The account-filtered reads join through the keys to the account.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_KeyInstances_account_id "
+        "ON KeyInstances(account_id)")
+    # The unique index leads with the key, so lookups of the transaction alone cannot use it.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_TransactionDeltas_tx_hash "
+        "ON TransactionDeltas(tx_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_TransactionOutputs_keyinstance_id "
+        "ON TransactionOutputs(keyinstance_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_Transactions_flags_block_height "
+        "ON Transactions(flags, block_height)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_PaymentRequests_keyinstance_id "
+        "ON PaymentRequests(keyinstance_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_WalletEvents_account_id "
+        "ON WalletEvents(account_id, date_created)")
+
+    date_updated = int(time.time())
+    conn.execute("UPDATE WalletData SET value=?, date_updated=? WHERE key=?",
+        [json.dumps(MIGRATION),date_updated,"migration"])
@@ -0,0 +1,23 @@
+import json
+import sqlite3
+import time
+
+MIGRATION = 25
+
+def execute(conn: sqlite3.Connection) -> None:
+    # The scripts of each key are derived from the key's public keys, which is expensive enough
+    # that they are stored to avoid deriving them again each time the wallet is opened.
+    conn.execute("CREATE TABLE IF NOT EXISTS KeyInstanceScripts ("
+        "keyinstance_id INTEGER NOT NULL,"
+        "script_type INTEGER NOT NULL,"
+        "script_hash BLOB NOT NULL,"
+        "script_data BLOB NOT NULL,"
+        "date_created INTEGER NOT NULL,"
+        "date_updated INTEGER NOT NULL,"
+        "PRIMARY KEY (keyinstance_id, script_type),"
+        "FOREIGN KEY (keyinstance_id) REFERENCES KeyInstances (keyinstance_id)"
+    ")")
+
+    date_updated = int(time.time())
+    conn.execute("UPDATE WalletData SET value=?, date_updated=? WHERE key=?",
+        [json.dumps(MIGRATION),date_updated,"migration"])
@@ -0,0 +1,14 @@
+import json
+import sqlite3
+import time
+
+MIGRATION = 26
+
+def execute(conn: sqlite3.Connection) -> None:
+    # The status of the history last received from the server for each key script. Keeping it
+    # means that resubscribing to an unchanged key does not need to fetch the history again.
+    conn.execute("ALTER TABLE KeyInstanceScripts ADD COLUMN status BLOB DEFAULT NULL")
+
+    date_updated = int(time.time())
+    conn.execute("UPDATE WalletData SET value=?, date_updated=? WHERE key=?",
+        [json.dumps(MIGRATION),date_updated,"migration"])
@@ -1,15 +1,21 @@
+import asyncio
+from contextlib import contextmanager
 from enum import Enum
 import queue
 import sqlite3
 import threading
 import time
 import traceback
-from typing import Any, Callable, List, NamedTuple, Optional, Tuple
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
+from ..app_state import app_state
 from ..constants import DATABASE_EXT
 from ..logs import logs
 
 
+logger = logs.get_logger("sqlite-support")
+
+
 # TODO(rt12): Remove the special case exception for WAL journal mode and see if the in-memory
 #     databases work now that there's locking preventing concurrent enabling of the WAL mode,
 #     in addition to the backing off of retries at enabling it. I vaguely recall that it perhaps
@@ -60,6 +66,10 @@ class WriteDisabledError(Exception):
     pass
 
 
+class BulkRestoreError(Exception):
+    pass
+
+
 WriteCallbackType = Callable[[sqlite3.Connection], None]
 CompletionCallbackType = Callable[[Optional[Exception]], None]
 class WriteEntryType(NamedTuple):
@@ -69,6 +79,50 @@ class WriteEntryType(NamedTuple):
 
 CompletionEntryType = Tuple[CompletionCallbackType, Optional[Exception]]
 
+
+class AsyncCompletionCallback:
+    """
+    A completion callback that resolves an asyncio future on the given event loop. The write
+    dispatcher calls these directly from the writer thread, rather than relaying them through
+    the completion callback thread, as all they do is schedule the resolution on the loop.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop]=None) -> None:
+        self._loop = app_state.async_.loop if loop is None else loop
+        self.future: "asyncio.Future[None]" = self._loop.create_future()
+
+    def __call__(self, exc_value: Optional[Exception]) -> None:
+        # The loop is closed at shutdown, and this must not raise in the writer thread.
+        try:
+            self._loop.call_soon_threadsafe(self._resolve, exc_value)
+        except RuntimeError:
+            logger.debug("Discarded write completion for closed event loop")
+
+    def _resolve(self, exc_value: Optional[Exception]) -> None:
+        # The awaiting coroutine may have been cancelled and the future along with it.
+        if self.future.done():
+            return
+        if exc_value is None:
+            self.future.set_result(None)
+        else:
+            self.future.set_exception(exc_value)
+
+
+class WriteDispatcherStatistics(NamedTuple):
+    batch_count: int
+    write_count: int
+    failed_write_count: int
+    retried_batch_count: int
+    # The number of writes the next batch is allowed to grow to.
+    batch_size_limit: int
+    maximum_batch_size: int
+    average_batch_size: float
+    # Commit latency in milliseconds.
+    last_commit_ms: float
+    average_commit_ms: float
+    maximum_commit_ms: float
+
+
 class SqliteWriteDispatcher:
     """
     This is a relatively simple write batcher for Sqlite that keeps all the writes on one thread,
@@ -76,12 +130,31 @@ class SqliteWriteDispatcher:
     get notified on completion. If an exception happens in the course of a writer, the exception
     is passed back to the invoker in the completion notification.
 
-    Completion notifications are done in a thread so as to not block the write dispatcher.
+    Writes are grouped into batches, each applied in one transaction. The number of writes in a
+    batch adapts to how long the commits take, growing while commits are fast and shrinking when
+    they exceed the target latency, and a batch is also cut short when the combined size hints
+    exceed the byte budget. If a batch fails, it is split in half and each half is retried so
+    that the failing write can be isolated without penalising the batches that follow it.
 
-    TODO: Allow writes to be wrapped with async logic so that async coroutines can do writes
-    in their natural fashion.
+    Completion notifications are done in a thread so as to not block the write dispatcher. The
+    exception is the `AsyncCompletionCallback` used for writes made from coroutines, which is
+    resolved directly on the event loop.
+
+    In bulk restore mode commits are not synced to disk, foreign keys are only checked when a
+    batch is committed, and batches are as large as the queued writes allow.
     """
 
+    MINIMUM_BATCH_SIZE = 1
+    INITIAL_BATCH_SIZE = 10
+    MAXIMUM_BATCH_SIZE = 5000
+    # The combined size hints of the writes in a batch, beyond which no more writes are added.
+    MAXIMUM_BATCH_BYTES = 8 * 1024 * 1024
+    # The commit time we try to keep batches within.
+    TARGET_COMMIT_MS = 100.0
+    # The batch limits in bulk restore mode, where the commit time does not matter.
+    BULK_RESTORE_BATCH_SIZE = 50000
+    BULK_RESTORE_BATCH_BYTES = 64 * 1024 * 1024
+
     def __init__(self, db_context: "DatabaseContext") -> None:
         self._db_context = db_context
         self._logger = logs.get_logger("sqlite-writer")
@@ -96,37 +169,57 @@ class SqliteWriteDispatcher:
         self._allow_puts = True
         self._is_alive = True
         self._exit_when_empty = False
+        self._bulk_restore = False
+
+        # An entry that did not fit in the last batch and has to start the next one.
+        self._held_entry: Optional[WriteEntryType] = None
+        self._batch_size_limit = self.INITIAL_BATCH_SIZE
+        self._stats_lock = threading.Lock()
+        self._batch_count = 0
+        self._write_count = 0
+        self._failed_write_count = 0
+        self._retried_batch_count = 0
+        self._maximum_batch_size = 0
+        self._last_commit_ms = 0.0
+        self._total_commit_ms = 0.0
+        self._maximum_commit_ms = 0.0
 
         self._writer_thread.start()
         self._callback_thread.start()
 
     def _writer_thread_main(self) -> None:
         self._db: sqlite3.Connection = self._db_context.acquire_connection()
+        applied_bulk_restore = False
+        synchronous = None
 
-        maximum_batch_size = 10
-        write_entries: List[WriteEntryType] = []
-        write_entry_backlog: List[WriteEntryType] = []
+        # Batches that failed are split and retried before anything new is taken from the queue,
+        # in order to preserve the order the writes were made in.
+        retry_batches: List[List[WriteEntryType]] = []
         while self._is_alive:
             self._writer_loop_event.set()
 
-            if len(write_entry_backlog):
-                assert maximum_batch_size == 1
-                write_entries = [ write_entry_backlog.pop(0) ]
+            if len(retry_batches):
+                write_entries = retry_batches.pop()
+            elif self._held_entry is not None:
+                write_entry, self._held_entry = self._held_entry, None
+                write_entries = self._gather_batch(write_entry)
             else:
-                # Block until we have at least one write action. If we already have write
-                # actions at this point, it is because we need to retry after a transaction
-                # was rolled back.
+                # Block until we have at least one write action.
                 try:
-                    write_entry: WriteEntryType = self._writer_queue.get(timeout=0.1)
+                    write_entry = self._writer_queue.get(timeout=0.1)
                 except queue.Empty:
                     if self._exit_when_empty:
                         return
                     continue
-                write_entries = [ write_entry ]
+                write_entries = self._gather_batch(write_entry)
 
-            # Gather the rest of the batch for this transaction.
-            while len(write_entries) < maximum_batch_size and not self._writer_queue.empty():
-                write_entries.append(self._writer_queue.get_nowait())
+            # The synchronous setting cannot be changed within a transaction.
+            bulk_restore = self._bulk_restore
+            if bulk_restore != applied_bulk_restore:
+                if bulk_restore:
+                    synchronous = self._db.execute("PRAGMA synchronous;").fetchone()[0]
+                self._db.execute(f"PRAGMA synchronous={0 if bulk_restore else synchronous};")
+                applied_bulk_restore = bulk_restore
 
             # Using the connection as a context manager, apply the batch as a transaction.
             time_start = time.time()
@@ -136,35 +229,117 @@ class SqliteWriteDispatcher:
                 with self._db:
                     # We have to force a grouped statement transaction with the explicit 'begin'.
                     self._db.execute('begin')
-                    for write_callback, completion_callback, entry_size_hint in write_entries:
+                    if bulk_restore:
+                        self._db.execute("PRAGMA defer_foreign_keys=ON;")
+                    for write_callback, _completion_callback, entry_size_hint in write_entries:
                         write_callback(self._db)
-                        if completion_callback is not None:
-                            completion_callbacks.append((completion_callback, None))
                         total_size_hint += entry_size_hint
                 # The transaction was successfully committed.
             except Exception as e:
                 # Exception: This is caught because we need to relay any exception to the
                 # calling context's completion notification callback.
                 self._logger.exception("Database write failure", exc_info=e)
+                # A commit that fails on deferred foreign keys leaves the transaction open.
+                if bulk_restore and self._db.in_transaction:
+                    self._db.rollback()
                 # The transaction was rolled back.
                 if len(write_entries) > 1:
-                    self._logger.debug("Retrying with batch size of 1")
-                    # We're going to try and reapply the write actions one by one.
-                    maximum_batch_size = 1
-                    write_entry_backlog = write_entries
+                    # Bisect the batch and retry each half, the earlier half first. Any half that
+                    # fails is split again until the failing writes are applied by themselves.
+                    middle = len(write_entries) // 2
+                    self._logger.debug("Retrying batch of %d as batches of %d and %d",
+                        len(write_entries), middle, len(write_entries) - middle)
+                    retry_batches.append(write_entries[middle:])
+                    retry_batches.append(write_entries[:middle])
+                    with self._stats_lock:
+                        self._retried_batch_count += 1
                     continue
-                # We applied the batch actions one by one. If there was an error with this action
+                # We applied the batch action by itself. If there was an error with this action
                 # then we've logged it, so we can discard it for lack of any other option.
+                with self._stats_lock:
+                    self._failed_write_count += 1
                 if write_entries[0][1] is not None:
                     completion_callbacks.append((write_entries[0][1], e))
             else:
+                # The writes are only reported as successful once the commit has succeeded, as
+                # with deferred foreign keys it is the commit that fails.
+                completion_callbacks.extend((write_entry.completion_callback, None)
+                    for write_entry in write_entries
+                    if write_entry.completion_callback is not None)
+                time_ms = (time.time() - time_start) * 1000
+                self._record_batch(len(write_entries), time_ms, bulk_restore)
                 if len(write_entries) > 1:
-                    time_ms = int((time.time() - time_start) * 1000)
                     self._logger.debug("Invoked %d write callbacks (hinted at %d bytes) in %d ms",
                         len(write_entries), total_size_hint, time_ms)
 
             for dispatchable_callback in completion_callbacks:
-                self._callback_queue.put_nowait(dispatchable_callback)
+                if isinstance(dispatchable_callback[0], AsyncCompletionCallback):
+                    dispatchable_callback[0](dispatchable_callback[1])
+                else:
+                    self._callback_queue.put_nowait(dispatchable_callback)
+
+    def _gather_batch(self, write_entry: WriteEntryType) -> List[WriteEntryType]:
+        """
+        Gather the rest of the batch for this transaction. The first entry is always included
+        regardless of it's size, and further entries are only added while both the current
+        batch size limit and the byte budget allow it. An entry that would take the batch over
+        the byte budget is held over to start the next batch.
+        """
+        if self._bulk_restore:
+            batch_size_limit = self.BULK_RESTORE_BATCH_SIZE
+            batch_bytes_limit = self.BULK_RESTORE_BATCH_BYTES
+        else:
+            batch_size_limit = self._batch_size_limit
+            batch_bytes_limit = self.MAXIMUM_BATCH_BYTES
+        write_entries = [ write_entry ]
+        total_size_hint = write_entry.size_hint
+        while len(write_entries) < batch_size_limit:
+            try:
+                next_entry = self._writer_queue.get_nowait()
+            except queue.Empty:
+                break
+            if total_size_hint + next_entry.size_hint > batch_bytes_limit:
+                self._held_entry = next_entry
+                break
+            write_entries.append(next_entry)
+            total_size_hint += next_entry.size_hint
+        return write_entries
+
+    def _record_batch(self, batch_size: int, time_ms: float, bulk_restore: bool=False) -> None:
+        """
+        Update the statistics for a committed batch and adapt the batch size limit. The limit
+        doubles when a full batch commits well within the target latency and halves when a
+        batch goes over it. Batches committed in bulk restore mode do not adapt the limit.
+        """
+        with self._stats_lock:
+            self._batch_count += 1
+            self._write_count += batch_size
+            self._maximum_batch_size = max(self._maximum_batch_size, batch_size)
+            self._last_commit_ms = time_ms
+            self._total_commit_ms += time_ms
+            self._maximum_commit_ms = max(self._maximum_commit_ms, time_ms)
+
+            if bulk_restore:
+                return
+            if time_ms > self.TARGET_COMMIT_MS:
+                self._batch_size_limit = max(self.MINIMUM_BATCH_SIZE, self._batch_size_limit // 2)
+            elif batch_size >= self._batch_size_limit and time_ms < self.TARGET_COMMIT_MS / 2:
+                self._batch_size_limit = min(self.MAXIMUM_BATCH_SIZE, self._batch_size_limit * 2)
+
+    def get_statistics(self) -> WriteDispatcherStatistics:
+        with self._stats_lock:
+            batch_count = self._batch_count
+            return WriteDispatcherStatistics(
+                batch_count=batch_count,
+                write_count=self._write_count,
+                failed_write_count=self._failed_write_count,
+                retried_batch_count=self._retried_batch_count,
+                batch_size_limit=self._batch_size_limit,
+                maximum_batch_size=self._maximum_batch_size,
+                average_batch_size=self._write_count / batch_count if batch_count else 0.0,
+                last_commit_ms=self._last_commit_ms,
+                average_commit_ms=self._total_commit_ms / batch_count if batch_count else 0.0,
+                maximum_commit_ms=self._maximum_commit_ms)
 
     def _callback_thread_main(self) -> None:
         while self._is_alive:
@@ -193,6 +368,13 @@ class SqliteWriteDispatcher:
 
         self._writer_queue.put_nowait(write_entry)
 
+    def get_queue_size(self) -> int:
+        return self._writer_queue.qsize()
+
+    def set_bulk_restore(self, enabled: bool) -> None:
+        # This is picked up by the writer thread when it starts the next batch.
+        self._bulk_restore = enabled
+
     def stop(self) -> None:
         if self._exit_when_empty:
             return
@@ -214,6 +396,16 @@ class SqliteWriteDispatcher:
         return not self._is_alive
 
 
+class ReadPoolStatistics(NamedTuple):
+    hits: int
+    misses: int
+    discards: int
+    # Connections waiting in the pool for reuse.
+    idle_count: int
+    # Connections that have been acquired from the pool and not yet released.
+    active_count: int
+
+
 class JournalModes(Enum):
     DELETE = "DELETE"
     TRUNCATE = "TRUNCATE"
@@ -226,6 +418,10 @@ class JournalModes(Enum):
 class DatabaseContext:
     MEMORY_PATH = ":memory:"
     JOURNAL_MODE = JournalModes.WAL
+    # The number of queued writes beyond which coroutines that throttle will wait for the writer.
+    MAXIMUM_WRITE_BACKLOG = 2000
+    # The number of released read connections that are kept open for reuse, over all threads.
+    MAXIMUM_IDLE_READ_CONNECTIONS = 10
 
     def __init__(self, wallet_path: str) -> None:
         if not self.is_special_path(wallet_path) and not wallet_path.endswith(DATABASE_EXT):
@@ -236,6 +432,19 @@ class DatabaseContext:
 
         self._logger = logs.get_logger("sqlite-context")
         self._lock = threading.Lock()
+
+        # Idle read connections are kept per-thread, so that a connection is only ever reused
+        # by the thread that last had it.
+        self._read_pool_lock = threading.Lock()
+        self._idle_read_connections: Dict[int, List[sqlite3.Connection]] = {}
+        self._idle_read_count = 0
+        self._active_read_count = 0
+        self._read_pool_hits = 0
+        self._read_pool_misses = 0
+        self._read_pool_discards = 0
+
+        self._live_session = False
+        self._bulk_restore = False
         self._write_dispatcher = SqliteWriteDispatcher(self)
 
     def acquire_connection(self) -> sqlite3.Connection:
@@ -261,6 +470,68 @@ class DatabaseContext:
         self._connections.remove(connection)
         connection.close()
 
+    def acquire_read_connection(self) -> sqlite3.Connection:
+        """
+        Get a connection that can only be used for reading. If the current thread released a
+        read connection earlier and it is still pooled, that is reused instead of incurring the
+        cost of opening and configuring a new one.
+        """
+        thread_id = threading.get_ident()
+        with self._read_pool_lock:
+            self._active_read_count += 1
+            idle_connections = self._idle_read_connections.get(thread_id)
+            if idle_connections:
+                self._idle_read_count -= 1
+                self._read_pool_hits += 1
+                return idle_connections.pop()
+            self._read_pool_misses += 1
+
+        try:
+            connection = self._acquire_connection()
+            connection.execute("PRAGMA query_only=ON;")
+        except Exception:
+            with self._read_pool_lock:
+                self._active_read_count -= 1
+            raise
+        return connection
+
+    def release_read_connection(self, connection: sqlite3.Connection) -> None:
+        thread_id = threading.get_ident()
+        with self._read_pool_lock:
+            self._active_read_count -= 1
+            if self._idle_read_count >= self.MAXIMUM_IDLE_READ_CONNECTIONS:
+                self._prune_idle_read_connections()
+            if self._idle_read_count < self.MAXIMUM_IDLE_READ_CONNECTIONS:
+                self._idle_read_connections.setdefault(thread_id, []).append(connection)
+                self._idle_read_count += 1
+                return
+            self._read_pool_discards += 1
+        self.release_connection(connection)
+
+    def _prune_idle_read_connections(self) -> None:
+        # Connections pooled for threads that have since exited can never be reused.
+        live_thread_ids = set(thread.ident for thread in threading.enumerate())
+        for thread_id in list(self._idle_read_connections):
+            if thread_id in live_thread_ids:
+                continue
+            for connection in self._idle_read_connections.pop(thread_id):
+                self._idle_read_count -= 1
+                self._read_pool_discards += 1
+                self.release_connection(connection)
+
+    def _close_idle_read_connections(self) -> None:
+        with self._read_pool_lock:
+            for connections in self._idle_read_connections.values():
+                for connection in connections:
+                    self.release_connection(connection)
+            self._idle_read_connections.clear()
+            self._idle_read_count = 0
+
+    def get_read_pool_statistics(self) -> ReadPoolStatistics:
+        with self._read_pool_lock:
+            return ReadPoolStatistics(self._read_pool_hits, self._read_pool_misses,
+                self._read_pool_discards, self._idle_read_count, self._active_read_count)
+
     def _ensure_journal_mode(self, connection: sqlite3.Connection) -> None:
         with self._lock:
             cursor = connection.execute(f"PRAGMA journal_mode;")
@@ -308,8 +579,110 @@ class DatabaseContext:
         self._write_dispatcher.put(WriteEntryType(write_callback, completion_callback,
             size_hint))
 
+    def queue_write_async(self, write_callback: WriteCallbackType, size_hint: int=0,
+            loop: Optional[asyncio.AbstractEventLoop]=None) -> "asyncio.Future[None]":
+        """
+        Queue a write and get a future that is resolved on the event loop when it is committed,
+        or has an exception set if the write failed. The application's event loop is used if
+        no loop is given.
+        """
+        completion_callback = AsyncCompletionCallback(loop)
+        self.queue_write(write_callback, completion_callback, size_hint)
+        return completion_callback.future
+
+    async def write(self, write_callback: WriteCallbackType, size_hint: int=0) -> None:
+        await self.queue_write_async(write_callback, size_hint, asyncio.get_running_loop())
+
+    async def throttle_writes(self) -> None:
+        """
+        Wait for the writer to work through the writes already queued, if it has fallen too far
+        behind. Coroutines that generate large numbers of writes can call this to avoid
+        swamping the writer.
+        """
+        if self._write_dispatcher.get_queue_size() > self.MAXIMUM_WRITE_BACKLOG:
+            # The writes are applied in order, so when this no-op write is committed all those
+            # before it will have been.
+            await self.write(lambda db: None)
+
+    def get_write_statistics(self) -> WriteDispatcherStatistics:
+        return self._write_dispatcher.get_statistics()
+
+    def set_live_session(self) -> None:
+        """
+        Mark the database as in use by a live wallet, where the writes have to be durable. Bulk
+        restore mode is refused from then on.
+        """
+        with self._lock:
+            if self._bulk_restore:
+                raise BulkRestoreError("database is in bulk restore mode")
+            self._live_session = True
+
+    def is_bulk_restore(self) -> bool:
+        return self._bulk_restore
+
+    def begin_bulk_restore(self) -> None:
+        """
+        Switch to bulk restore mode, where writes are applied as fast as possible at the risk of
+        the database being corrupted if the system crashes before the mode is ended. This is for
+        filling in a database that is not yet in use.
+        """
+        with self._lock:
+            if self._live_session:
+                raise BulkRestoreError("database is in use by a live session")
+            if self._bulk_restore:
+                raise BulkRestoreError("database is already in bulk restore mode")
+            self._bulk_restore = True
+        self._logger.debug("Entering bulk restore mode")
+        self._write_dispatcher.set_bulk_restore(True)
+
+    def end_bulk_restore(self) -> None:
+        """
+        Leave bulk restore mode once the writes made in it have been applied. The database is
+        then checkpointed, which syncs it to disk, and checked for integrity.
+
+        Raises: BulkRestoreError if the database fails the integrity check.
+        """
+        with self._lock:
+            if not self._bulk_restore:
+                raise BulkRestoreError("database is not in bulk restore mode")
+
+        # The writes are applied in order, so when this no-op write is committed all those
+        # before it will have been.
+        with SynchronousWriter() as writer:
+            self.queue_write(lambda db: None, writer.get_callback())
+            writer.succeeded()
+        self._write_dispatcher.set_bulk_restore(False)
+        with self._lock:
+            self._bulk_restore = False
+
+        time_start = time.time()
+        connection = self.acquire_connection()
+        try:
+            busy, _log_pages, _checkpointed_pages = connection.execute(
+                "PRAGMA wal_checkpoint(TRUNCATE);").fetchone()
+            if busy:
+                self._logger.warning("Bulk restore checkpoint was blocked by a reader")
+            problems = [ row[0] for row in connection.execute("PRAGMA integrity_check;") ]
+            problems.extend(f"foreign key {row}" for row in
+                connection.execute("PRAGMA foreign_key_check;"))
+        finally:
+            self.release_connection(connection)
+        if problems != [ "ok" ]:
+            raise BulkRestoreError(f"database failed integrity check: {problems}")
+        self._logger.debug("Left bulk restore mode, checked in %d ms",
+            (time.time() - time_start) * 1000)
+
+    @contextmanager
+    def bulk_restore(self) -> Iterator[None]:
+        self.begin_bulk_restore()
+        try:
+            yield
+        finally:
+            self.end_bulk_restore()
+
     def close(self) -> None:
         self._write_dispatcher.stop()
+        self._close_idle_read_connections()
         # for connection in self._connections:
         #     print(self._debug_texts[connection])
         assert self.is_closed(), f"{len(self._connections)}/{self._write_dispatcher.is_stopped()}"
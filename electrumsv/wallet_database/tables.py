@@ -2,6 +2,7 @@ from io import BytesIO
 import json
 import sqlite3
 import time
+import zlib
 from typing import Any, Dict, Iterable, NamedTuple, Optional, List, Sequence, Tuple
 
 import bitcoinx
@@ -19,8 +20,8 @@ from .sqlite_support import SQLITE_MAX_VARS, DatabaseContext, CompletionCallback
 
 __all__ = [
     "MissingRowError", "DataPackingError", "TransactionTable", "TransactionOutputTable",
-    "TransactionDeltaTable", "MasterKeyTable", "KeyInstanceTable", "WalletDataTable",
-    "AccountTable",
+    "TransactionDeltaTable", "MasterKeyTable", "KeyInstanceTable", "KeyInstanceScriptTable",
+    "WalletDataTable", "AccountTable",
 ]
 
 
@@ -56,10 +57,11 @@ class BaseWalletStore:
     def __init__(self, db_context: DatabaseContext) -> None:
         self._logger = logs.get_logger(self.LOGGER_NAME)
         self._db_context = db_context
-        self._db: sqlite3.Connection = db_context.acquire_connection()
+        # All writes go through the context's writer, so the connection is only used for reads.
+        self._db: sqlite3.Connection = db_context.acquire_read_connection()
 
     def close(self) -> None:
-        self._db_context.release_connection(self._db)
+        self._db_context.release_read_connection(self._db)
         del self._db
 
     def __enter__(self):
@@ -252,17 +254,52 @@ class TransactionTable(BaseWalletStore):
         "date_created, date_updated FROM Transactions WHERE tx_hash=?")
     READ_METADATA_MANY_BASE_SQL = ("SELECT tx_hash, flags, block_height, block_position, "
         "fee_value, date_created, date_updated FROM Transactions")
+    READ_METADATA_PAGE_SQL = READ_METADATA_MANY_BASE_SQL +" WHERE tx_hash>?"
     READ_PROOF_SQL = "SELECT tx_hash, proof_data FROM Transactions"
     UPDATE_DESCRIPTION_SQL = "UPDATE Transactions SET date_updated=?, description=? WHERE tx_hash=?"
     UPDATE_FLAGS_SQL = "UPDATE Transactions SET flags=((flags&?)|?),date_updated=? WHERE tx_hash=?"
     UPDATE_MANY_SQL = ("UPDATE Transactions SET tx_data=?,flags=?,block_height=?,"
         "block_position=?,fee_value=?,date_updated=? WHERE tx_hash=?")
-    UPDATE_METADATA_MANY_SQL = ("UPDATE Transactions SET flags=?,block_height=?,"
+    # The updates that leave the bytedata as it is also need to leave its compression flag.
+    UPDATE_METADATA_MANY_SQL = ("UPDATE Transactions SET "
+        f"flags=((flags&{TxFlags.CompressedByteData.value})|?),block_height=?,"
         "block_position=?,fee_value=?,date_updated=? WHERE tx_hash=?")
     UPDATE_PROOF_SQL = ("UPDATE Transactions SET proof_data=?,date_updated=?,flags=(flags|?) "
         "WHERE tx_hash=?")
+    UPDATE_PROOF_METADATA_MANY_SQL = ("UPDATE Transactions SET "
+        f"flags=((flags&{TxFlags.CompressedByteData.value})|?),block_height=?,"
+        "block_position=?,fee_value=?,date_updated=?,proof_data=? WHERE tx_hash=?")
     DELETE_SQL = "DELETE FROM Transactions WHERE tx_hash=?"
 
+    def __init__(self, db_context: DatabaseContext,
+            compression_threshold: Optional[int]=None) -> None:
+        """
+        If there is a compression threshold, bytedata of at least that size is written zlib
+        compressed when that makes it smaller. Compressed bytedata is always decompressed when it
+        is read, whether this table compresses what it writes or not.
+        """
+        super().__init__(db_context)
+        self._compression_threshold = compression_threshold
+
+    def _pack_bytedata(self, bytedata: bytes, flags: TxFlags) -> Tuple[bytes, TxFlags]:
+        flags &= ~TxFlags.CompressedByteData
+        if self._compression_threshold is not None and \
+                len(bytedata) >= self._compression_threshold:
+            compressed_bytedata = zlib.compress(bytedata)
+            if len(compressed_bytedata) < len(bytedata):
+                return compressed_bytedata, flags | TxFlags.CompressedByteData
+        return bytedata, flags
+
+    @staticmethod
+    def _unpack_flags(flags: int) -> TxFlags:
+        return TxFlags(flags & ~TxFlags.CompressedByteData)
+
+    @staticmethod
+    def _unpack_bytedata(bytedata: Optional[bytes], flags: int) -> Optional[bytes]:
+        if flags & TxFlags.CompressedByteData:
+            return zlib.decompress(bytedata)
+        return bytedata
+
     @staticmethod
     def _apply_flags(data: TxData, flags: TxFlags) -> TxFlags:
         flags &= ~TxFlags.METADATA_FIELD_MASK
@@ -296,6 +333,8 @@ class TransactionTable(BaseWalletStore):
 
     @staticmethod
     def _flag_clause(flags: Optional[int], mask: Optional[int]) -> Tuple[str, List[int]]:
+        if mask is not None:
+            mask &= ~TxFlags.CompressedByteData
         if flags is None:
             if mask is None:
                 return "", []
@@ -348,6 +387,7 @@ class TransactionTable(BaseWalletStore):
             flags &= ~TxFlags.HasByteData
             if bytedata is not None:
                 flags |= TxFlags.HasByteData
+                bytedata, flags = self._pack_bytedata(bytedata, flags)
                 size_hint += len(bytedata)
             flags = self._apply_flags(metadata, flags)
             assert metadata.date_added is not None and metadata.date_updated is not None
@@ -363,15 +403,50 @@ class TransactionTable(BaseWalletStore):
             tx_hashes: Optional[Sequence[bytes]]=None) -> List[Tuple[bytes,
                 Optional[bytes], TxFlags, TxData]]:
         query = self.READ_MANY_BASE_SQL
-        return [ (row[0], row[1], TxFlags(row[2]), TxData(row[3], row[4], row[5], row[6], row[7]))
+        return [ (row[0], self._unpack_bytedata(row[1], row[2]), self._unpack_flags(row[2]),
+            TxData(row[3], row[4], row[5], row[6], row[7]))
             for row in self._get_many_common(query, flags, mask, tx_hashes) ]
 
     def read_metadata(self, flags: Optional[TxFlags]=None, mask: Optional[TxFlags]=None,
             tx_hashes: Optional[Sequence[bytes]]=None) -> List[Tuple[bytes, TxFlags, TxData]]:
         query = self.READ_METADATA_MANY_BASE_SQL
-        return [ (row[0], TxFlags(row[1]), TxData(row[2], row[3], row[4], row[5], row[6]))
+        return [ (row[0], self._unpack_flags(row[1]),
+            TxData(row[2], row[3], row[4], row[5], row[6]))
             for row in self._get_many_common(query, flags, mask, tx_hashes) ]
 
+    def read_metadata_page(self, flags: Optional[TxFlags], mask: Optional[TxFlags],
+            after_tx_hash: bytes, limit: int) -> List[Tuple[bytes, TxFlags, TxData]]:
+        """
+        Read the metadata for up to `limit` matching transactions, ordered by transaction hash
+        and starting after `after_tx_hash`. Passing the hash of the last row of each page as the
+        next `after_tx_hash` pages through the primary key index.
+        """
+        clause, params = self._flag_clause(flags, mask)
+        query = self.READ_METADATA_PAGE_SQL
+        if clause:
+            query += " AND "+ clause
+        query += " ORDER BY tx_hash LIMIT ?"
+        page_params: List[Any] = [ after_tx_hash ]
+        cursor = self._db.execute(query, page_params + params + [ limit ])
+        rows = cursor.fetchall()
+        cursor.close()
+        return [ (row[0], self._unpack_flags(row[1]),
+            TxData(row[2], row[3], row[4], row[5], row[6])) for row in rows ]
+
+    def read_recent_metadata(self, flags: Optional[TxFlags], mask: Optional[TxFlags],
+            limit: int) -> List[Tuple[bytes, TxFlags, TxData]]:
+        "Read the metadata for up to `limit` matching transactions, highest block first."
+        clause, params = self._flag_clause(flags, mask)
+        query = self.READ_METADATA_MANY_BASE_SQL
+        if clause:
+            query += " WHERE "+ clause
+        query += " ORDER BY block_height DESC LIMIT ?"
+        cursor = self._db.execute(query, params + [ limit ])
+        rows = cursor.fetchall()
+        cursor.close()
+        return [ (row[0], self._unpack_flags(row[1]),
+            TxData(row[2], row[3], row[4], row[5], row[6])) for row in rows ]
+
     def read_descriptions(self,
             tx_hashes: Optional[Sequence[bytes]]=None) -> List[Tuple[bytes, str]]:
         query = self.READ_DESCRIPTION_SQL
@@ -403,6 +478,7 @@ class TransactionTable(BaseWalletStore):
                     assert flags & TxFlags.HasByteData == 0, f"{hash_to_hex_str(tx_hash)} no flag"
                 else:
                     assert flags & TxFlags.HasByteData != 0, f"{hash_to_hex_str(tx_hash)} flag"
+                    bytedata, flags = self._pack_bytedata(bytedata, flags)
                     size_hint += len(bytedata)
                 data_rows.append((bytedata, flags, metadata.height, metadata.position,
                     metadata.fee, metadata.date_updated, tx_hash))
@@ -437,8 +513,9 @@ class TransactionTable(BaseWalletStore):
     def update_flags(self, entries: Iterable[Tuple[bytes, TxFlags, TxFlags, int]],
             # tx_hash: bytes, flags: int, mask: int, date_updated: int,
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
-        datas = [ (mask, flags, date_updated, tx_hash)
-            for (tx_hash, flags, mask, date_updated) in entries ]
+        # The compression flag is kept, as the bytedata is not changed.
+        datas = [ (mask | TxFlags.CompressedByteData, flags & ~TxFlags.CompressedByteData,
+            date_updated, tx_hash) for (tx_hash, flags, mask, date_updated) in entries ]
         def _write(db: sqlite3.Connection) -> None:
             tx_ids = [ hash_to_hex_str(entry[0]) for entry in entries ]
             self._logger.debug("update_flags '%s'", tx_ids)
@@ -467,6 +544,20 @@ class TransactionTable(BaseWalletStore):
             db.executemany(self.UPDATE_PROOF_SQL, datas)
         self._db_context.queue_write(_write, completion_callback, size_hint)
 
+    def update_proofs_and_metadata(self, entries: List[Tuple[bytes, TxData, TxFlags, TxProof]],
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        datas = []
+        for tx_hash, metadata, flags, proof in entries:
+            assert type(tx_hash) is bytes
+            flags = self._apply_flags(metadata, flags) | TxFlags.HasProofData
+            datas.append((flags, metadata.height, metadata.position, metadata.fee,
+                metadata.date_updated, self._pack_proof(proof), tx_hash))
+        size_hint = sum(len(t[5]) for t in datas)
+        def _write(db: sqlite3.Connection) -> None:
+            self._logger.debug("updating %d transaction proofs and metadata", len(datas))
+            db.executemany(self.UPDATE_PROOF_METADATA_MANY_SQL, datas)
+        self._db_context.queue_write(_write, completion_callback, size_hint)
+
     def delete(self, tx_hashes: Sequence[bytes],
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
         datas = [(tx_hash,) for tx_hash in tx_hashes]
@@ -640,6 +731,7 @@ class KeyInstanceTable(BaseWalletStore):
 
     DELETE_FK_TXDELTA_SQL = "DELETE FROM TransactionOutputs WHERE tx_hash=?"
     DELETE_FK_TXOUT_SQL = "DELETE FROM TransactionOutputs WHERE tx_hash=?"
+    DELETE_FK_SCRIPTS_SQL = "DELETE FROM KeyInstanceScripts WHERE keyinstance_id=?"
     DELETE_SQL = "DELETE FROM KeyInstances WHERE keyinstance_id=?"
 
     def create(self, entries: Iterable[KeyInstanceRow],
@@ -704,6 +796,71 @@ class KeyInstanceTable(BaseWalletStore):
             db.executemany(self.UPDATE_SCRIPT_TYPE_SQL, datas)
         self._db_context.queue_write(_write, completion_callback)
 
+    def delete(self, key_ids: Iterable[int],
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        datas = [ (key_id,) for key_id in key_ids ]
+        def _write(db: sqlite3.Connection):
+            db.executemany(self.DELETE_FK_SCRIPTS_SQL, datas)
+            db.executemany(self.DELETE_SQL, datas)
+        self._db_context.queue_write(_write, completion_callback)
+
+
+class KeyInstanceScriptRow(NamedTuple):
+    keyinstance_id: int
+    script_type: ScriptType
+    script_hash: bytes
+    script_data: bytes
+
+
+class KeyInstanceScriptTable(BaseWalletStore):
+    LOGGER_NAME = "db-table-keyscript"
+
+    # A script may be derived by more than one caller before the first has stored it.
+    CREATE_SQL = ("INSERT OR IGNORE INTO KeyInstanceScripts "
+        "(keyinstance_id, script_type, script_hash, script_data, date_created, date_updated) "
+        "VALUES (?, ?, ?, ?, ?, ?)")
+    READ_ACCOUNT_SQL = ("SELECT KIS.keyinstance_id, KIS.script_type, KIS.script_hash, "
+        "KIS.script_data FROM KeyInstanceScripts AS KIS "
+        "INNER JOIN KeyInstances AS KI ON KI.keyinstance_id = KIS.keyinstance_id "
+        "WHERE KI.account_id=?")
+    # Only the status of the script type a key has been used with is relevant to it.
+    READ_STATUS_SQL = ("SELECT KIS.keyinstance_id, KIS.status FROM KeyInstanceScripts AS KIS "
+        "INNER JOIN KeyInstances AS KI ON KI.keyinstance_id = KIS.keyinstance_id "
+        "AND KI.script_type = KIS.script_type "
+        "WHERE KI.account_id=? AND KIS.status IS NOT NULL")
+    UPDATE_STATUS_SQL = ("UPDATE KeyInstanceScripts SET date_updated=?, status=? "
+        "WHERE keyinstance_id=? AND script_type=?")
+    DELETE_SQL = "DELETE FROM KeyInstanceScripts WHERE keyinstance_id=?"
+
+    def create(self, entries: Iterable[KeyInstanceScriptRow],
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        timestamp = self._get_current_timestamp()
+        datas = [ (*t, timestamp, timestamp) for t in entries ]
+        size_hint = sum(len(t[3]) for t in datas)
+        def _write(db: sqlite3.Connection):
+            db.executemany(self.CREATE_SQL, datas)
+        self._db_context.queue_write(_write, completion_callback, size_hint)
+
+    def read(self, account_id: int) -> List[KeyInstanceScriptRow]:
+        cursor = self._db.execute(self.READ_ACCOUNT_SQL, [ account_id ])
+        rows = cursor.fetchall()
+        cursor.close()
+        return [ KeyInstanceScriptRow(*t) for t in rows ]
+
+    def read_statuses(self, account_id: int) -> List[Tuple[int, bytes]]:
+        cursor = self._db.execute(self.READ_STATUS_SQL, [ account_id ])
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def update_statuses(self, entries: Iterable[Tuple[Optional[bytes], int, int]],
+            completion_callback: Optional[CompletionCallbackType]=None) -> None:
+        timestamp = self._get_current_timestamp()
+        datas = [ (timestamp, *entry) for entry in entries ]
+        def _write(db: sqlite3.Connection):
+            db.executemany(self.UPDATE_STATUS_SQL, datas)
+        self._db_context.queue_write(_write, completion_callback)
+
     def delete(self, key_ids: Iterable[int],
             completion_callback: Optional[CompletionCallbackType]=None) -> None:
         datas = [ (key_id,) for key_id in key_ids ]